@@ -1,35 +1,103 @@
 """
 USB AutoLocker - 单文件版本
-检测特定USB设备断开连接后自动锁屏，适用于Windows平台
+检测特定USB设备断开连接后自动锁屏，适用于Windows平台（Linux 下通过 netlink uevent 监听）
 """
+from __future__ import annotations
+
+import argparse
+import asyncio
+import heapq
+import hmac
+import importlib
+import io
 import json
+import math
 import os
 import re
 import sys
 import time
+import queue
+import select
+import socket
+import secrets
+import struct
+import tempfile
 import threading
 import subprocess
 import ctypes
-import winreg
-import tkinter as tk
-from dataclasses import dataclass, asdict
-from typing import List, Optional, Callable
-
-import wmi
-import pythoncom
-from pystray import Icon, Menu, MenuItem
-from PIL import Image, ImageDraw
-from pynput import keyboard
-import win32event
-import win32api
-import winerror
-import customtkinter as ctk
+from bisect import bisect_left
+from collections import deque
+from dataclasses import MISSING, dataclass, asdict, field
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Callable
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class LazyModule:
+    """首次访问属性时才导入的模块代理
+
+    GUI 依赖（Tk、customtkinter、PIL、pystray、pynput）导入较慢，且 pystray/pynput 在导入时
+    就需要图形会话；推迟到弹窗、托盘、设置窗口第一次使用时再加载，设备监控无需等待它们。
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+tk = LazyModule("tkinter")
+ctk = LazyModule("customtkinter")
+Image = LazyModule("PIL.Image")
+ImageDraw = LazyModule("PIL.ImageDraw")
+pystray = LazyModule("pystray")
+keyboard = LazyModule("pynput.keyboard")
+GUI_MODULES = ("tkinter", "customtkinter", "PIL", "pystray", "pynput")
+
+# Windows 专用模块，其他平台上置为 None
+try:
+    import winreg
+    import wmi
+    import pythoncom
+    import win32event
+    import win32api
+    import winerror
+except ImportError:
+    winreg = wmi = pythoncom = win32event = win32api = winerror = None
+
+IS_WINDOWS = sys.platform == "win32"
+
+
+def com_initialize():
+    """在当前线程初始化 COM（非 Windows 平台为空操作）"""
+    if pythoncom is not None:
+        pythoncom.CoInitialize()
+
+
+def com_uninitialize():
+    if pythoncom is not None:
+        pythoncom.CoUninitialize()
 
 
 # ==================== 单实例检查 ====================
 
 def check_single_instance(mutex_name="USB_AutoLocker_Mutex"):
     """确保单实例运行"""
+    if not IS_WINDOWS:
+        # 非 Windows 平台使用文件锁
+        import fcntl
+        handle = open(os.path.join(tempfile.gettempdir(), f"{mutex_name}.lock"), "w")
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            print("USB AutoLocker 已经在运行中！")
+            sys.exit(0)
+        return handle
     handle = win32event.CreateMutex(None, False, mutex_name)
     if win32api.GetLastError() == winerror.ERROR_ALREADY_EXISTS:
         ctypes.windll.user32.MessageBoxW(0, "USB AutoLocker 已经在运行中！", "提示", 0x40)
@@ -47,11 +115,231 @@ except Exception:
         pass
 
 
+# ==================== 指标 ====================
+
+class Counter:
+    """单调递增计数器"""
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+    """固定桶直方图：observe 只做一次二分查找和原地累加，不创建新对象"""
+    __slots__ = ("bounds", "counts", "sum", "count", "_lock")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最后一个桶为 +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self) -> tuple:
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+class MetricsRegistry:
+    """指标注册表
+
+    指标（含标签组合）都在启动时创建，热路径上只调用 inc/observe，可以在生产环境常开。
+    导出为 Prometheus 文本格式：定期写文件（metrics_file）或在 127.0.0.1:metrics_port 提供 /metrics。
+    """
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, prefix: str = "usb_autolocker"):
+        self.prefix = prefix
+        self.families: Dict[str, dict] = {}  # 名称 -> {"type", "help", "series": [(标签文本, 指标)]}
+        self._export_started = False
+
+    def _register(self, kind: str, name: str, help_text: str, metric, labels: dict):
+        family = self.families.setdefault(f"{self.prefix}_{name}", {"type": kind, "help": help_text, "series": []})
+        label_text = ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                              for k, v in labels.items())
+        family["series"].append((label_text, metric))
+        return metric
+
+    def counter(self, name: str, help_text: str, **labels) -> Counter:
+        return self._register("counter", name, help_text, Counter(), labels)
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = LATENCY_BUCKETS, **labels) -> Histogram:
+        return self._register("histogram", name, help_text, Histogram(tuple(buckets)), labels)
+
+    def render(self) -> str:
+        lines = []
+        for name, family in self.families.items():
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['type']}")
+            for label_text, metric in family["series"]:
+                if family["type"] == "counter":
+                    lines.append(f"{name}{{{label_text}}} {metric.value}" if label_text else f"{name} {metric.value}")
+                    continue
+                counts, total, count = metric.snapshot()
+                prefix = f"{label_text}," if label_text else ""
+                cumulative = 0
+                for bound, n in zip(metric.bounds + (math.inf,), counts):
+                    cumulative += n
+                    le = "+Inf" if bound == math.inf else repr(bound)
+                    lines.append(f'{name}_bucket{{{prefix}le="{le}"}} {cumulative}')
+                suffix = f"{{{label_text}}}" if label_text else ""
+                lines.append(f"{name}_sum{suffix} {total}")
+                lines.append(f"{name}_count{suffix} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """先写临时文件再替换，采集方不会读到一半的内容"""
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def serve(self, port: int):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # 只有开启端点时才需要
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def start_export(self, config_manager: "ConfigManager"):
+        """按配置开启指标导出，进程内只开启一次"""
+        config = config_manager.config
+        if self._export_started or not (config.metrics_file or config.metrics_port):
+            return
+        self._export_started = True
+        if config.metrics_port:
+            try:
+                self.serve(config.metrics_port)
+                print(f"指标端点: http://127.0.0.1:{config.metrics_port}/metrics")
+            except OSError as e:
+                print(f"指标端点启动失败: {e}")
+        if config.metrics_file:
+            path = os.path.join(os.path.dirname(os.path.abspath(config_manager.config_path)), config.metrics_file)
+
+            def write_loop():
+                while True:
+                    try:
+                        self.write(path)
+                    except OSError as e:
+                        print(f"指标文件写入失败: {e}")
+                    time.sleep(max(1.0, config.metrics_interval_seconds))
+
+            threading.Thread(target=write_loop, daemon=True).start()
+
+
+class AppMetrics(MetricsRegistry):
+    """本程序的全部指标"""
+
+    def __init__(self):
+        super().__init__()
+        self.device_events = {a: self.counter("device_events_total", "收到的原始 USB 设备事件", action=a)
+                              for a in ("add", "remove")}
+        self.decisions = {d: self.counter("presence_decisions_total", "在位状态机输出的判定", decision=d)
+                          for d in ("removed", "inserted", "flapping")}
+        self.countdowns = self.counter("countdowns_total", "开始的锁屏倒计时")
+        self.cancels = {r: self.counter("countdown_cancels_total", "被取消的锁屏倒计时", reason=r)
+                        for r in ("keyboard", "reinsert", "remote", "disabled", "shutdown")}
+        self.locks = self.counter("locks_total", "执行的锁屏调用")
+        self.lock_failures = self.counter("lock_failures_total", "锁屏后端调用失败（改用下一个后端）")
+        self.wmi_errors = {o: self.counter("wmi_errors_total", "WMI 调用失败", operation=o)
+                           for o in ("health_check", "call")}
+        self.backend_errors = self.counter("backend_errors_total", "设备事件后端出错后重建订阅")
+        self.event_batches = self.counter("event_batches_total", "按批处理的设备事件批次")
+        self.coalesced_events = self.counter("coalesced_events_total", "合并为同一设备净变化而未单独判定的事件")
+        self.ingest_overflows = self.counter("ingest_overflows_total", "事件队列溢出后改为全量核对在位状态")
+        self.config_saves = {r: self.counter("config_saves_total", "配置文件保存", result=r) for r in ("ok", "error", "invalid")}
+        self.config_load_errors = self.counter("config_load_errors_total", "配置文件读取失败或校验不通过")
+        self.config_reloads = self.counter("config_reloads_total", "检测到外部修改并热加载的配置")
+        self.forwarded = self.counter("forwarded_events_total", "已送达收集端的事件")
+        self.forward_spooled = self.counter("forward_spooled_events_total", "收集端不可达时写入本地暂存的事件")
+        self.forward_dropped = self.counter("forward_dropped_events_total", "暂存或内存队列超出上限而丢弃的事件")
+        self.forward_errors = self.counter("forward_errors_total", "发送到收集端失败的批次")
+        self.audit_records = self.counter("audit_records_total", "写入审计日志的记录")
+        self.audit_dropped = self.counter("audit_dropped_total", "写入线程跟不上、内存队列超出上限而丢弃的审计记录")
+        self.audit_rotations = self.counter("audit_rotations_total", "审计日志段轮转压缩")
+        self.event_dispatch = self.histogram("event_dispatch_seconds", "设备事件从收到到回调处理完成的耗时")
+        self.scan_duration = self.histogram("scan_duration_seconds", "全量 USB 设备枚举耗时")
+        self.lock_call = self.histogram("lock_call_duration_seconds", "锁屏调用耗时")
+        self.lock_drift = self.histogram("lock_drift_seconds", "锁屏流水线（含锁屏前动作）完成时刻晚于倒计时截止时间的时长")
+        self.popup_paint = self.histogram("popup_paint_seconds", "倒计时弹窗从 show 到首次绘制的耗时")
+        self._hooks: Dict[str, tuple] = {}
+        self._hooks_lock = threading.Lock()
+
+    def hook(self, name: str) -> tuple:
+        """锁屏前钩子的 (耗时直方图, 按结果的计数)，按钩子名称在首次使用时登记"""
+        with self._hooks_lock:
+            metrics = self._hooks.get(name)
+            if metrics is None:
+                metrics = self._hooks[name] = (
+                    self.histogram("lock_hook_duration_seconds", "锁屏前钩子从开始到完成的耗时", hook=name),
+                    {r: self.counter("lock_hook_results_total", "锁屏前钩子的结果", hook=name, result=r)
+                     for r in ("ok", "error", "timeout")})
+            return metrics
+
+
+METRICS = AppMetrics()
+
+
 # ==================== 配置管理 ====================
 
 CONFIG_FILE = os.path.join(os.path.dirname(__file__), "config.json")
 
 
+@dataclass(frozen=True)
+class DeviceRule:
+    """一把密钥设备的匹配规则"""
+    vid: str
+    pid: str
+    name: str = ""
+
+    @property
+    def key(self) -> str:
+        return f"{self.vid}&{self.pid}".upper()
+
+    @property
+    def label(self) -> str:
+        return f"{self.name} ({self.key})" if self.name else self.key
+
+
+POLICIES = ("any", "all", "quorum")
+VID_PATTERN = re.compile(r"VID_[0-9A-F]{4}")
+PID_PATTERN = re.compile(r"PID_[0-9A-F]{4}")
+
+
+class ConfigError(ValueError):
+    """配置内容不合法"""
+
+
 @dataclass
 class AppConfig:
     """应用配置数据类"""
@@ -62,6 +350,119 @@ class AppConfig:
     auto_start: bool = False
     enabled: bool = True
     unlock_on_reconnect: bool = True  # 插回USB设备时是否取消锁屏
+    backend: str = "auto"  # 设备事件后端: auto / wmi / udev / broker（经本机设备代理）
+    control_port: int = 47631  # 守护进程控制套接字端口（仅监听 127.0.0.1）
+    broker_port: int = 47632  # 设备代理端口（仅监听 127.0.0.1），代理与各会话共用
+    extra_devices: List[dict] = field(default_factory=list)  # 额外密钥: [{"vid": ..., "pid": ..., "name": ...}]
+    policy: str = "any"  # 多密钥策略: any（任一在位）/ all（全部在位）/ quorum（至少 quorum 把在位）
+    quorum: int = 1
+    remove_debounce_ms: int = 0  # 拔出需持续多久才生效，0 表示立即（不推迟真实拔出）
+    insert_debounce_ms: int = 300  # 插入需稳定多久才生效，期间再次拔出视为抖动
+    flap_limit: int = 3  # flap_window_seconds 内拔出超过该次数时立即锁屏，0 关闭
+    flap_window_seconds: float = 10.0
+    trace_file: str = ""  # 事件追踪文件（相对配置文件目录），为空时不记录
+    metrics_file: str = ""  # Prometheus 文本格式的指标文件（相对配置文件目录），为空时不写
+    metrics_port: int = 0  # 指标端点 127.0.0.1:端口/metrics，0 表示不开启
+    metrics_interval_seconds: float = 15.0  # 指标文件写入间隔
+    forward_url: str = ""  # 事件转发目标: http(s)://host:port/path 或 tcp://host:port，为空时不转发
+    forward_batch_size: int = 100
+    forward_interval_seconds: float = 2.0  # 未攒满一批时的最长等待
+    forward_spool_dir: str = "spool"  # 收集端不可达时的本地暂存目录（相对配置文件目录）
+    forward_spool_max_bytes: int = 10 * 1024 * 1024
+    lock_backends: List[str] = field(default_factory=list)  # 依次尝试的锁屏后端，为空时按平台: windows,rundll32 / loginctl,xdg-screensaver
+    lock_hooks: list = field(default_factory=list)  # 锁屏前动作: "pause-media" / "displays-off" / "notify" / {"command": [...], "name": ...}
+    lock_hook_deadline_ms: int = 200  # 锁屏前动作的总时限，到时不论是否完成都立即锁屏
+    audit_dir: str = ""  # 审计日志目录（相对配置文件目录，如 "audit"），为空时不记录
+    audit_max_bytes: int = 4 * 1024 * 1024  # 当前段超过该大小时轮转压缩
+    audit_rotate_hours: float = 24.0  # 当前段跨越该时长时轮转压缩
+    audit_retention_days: int = 400  # 超过该天数的段被删除，0 表示永久保留
+
+    def get_device_rules(self) -> List[DeviceRule]:
+        """主密钥 + 额外密钥，按 VID/PID 去重"""
+        rules = {}
+        for item in [{"vid": self.device_vid, "pid": self.device_pid, "name": self.device_name}] + list(self.extra_devices):
+            if not item.get("vid") or not item.get("pid"):
+                continue
+            rule = DeviceRule(vid=str(item["vid"]).upper(), pid=str(item["pid"]).upper(), name=item.get("name", ""))
+            rules.setdefault(rule.key, rule)
+        return list(rules.values())
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "AppConfig":
+        """按字段默认值的类型校验并构造配置，不合法时抛出 ConfigError（列出全部问题）"""
+        if not isinstance(data, dict):
+            raise ConfigError("配置文件顶层必须是 JSON 对象")
+        errors, values = [], {}
+        for key, value in data.items():
+            f = cls.__dataclass_fields__.get(key)
+            if f is None:
+                print(f"忽略未知配置项: {key}")
+                continue
+            expected = type(f.default if f.default is not MISSING else f.default_factory())
+            if expected is float and type(value) is int:
+                value = float(value)
+            if type(value) is not expected:
+                errors.append(f"{key} 应为 {expected.__name__}，实际为 {type(value).__name__}")
+                continue
+            values[key] = value
+        if errors:
+            raise ConfigError("；".join(errors))
+        config = cls(**values)
+        errors = config.validate()
+        if errors:
+            raise ConfigError("；".join(errors))
+        return config
+
+    def validate(self) -> List[str]:
+        """检查取值范围，返回问题列表"""
+        errors = []
+        devices = [("device", self.device_vid, self.device_pid)]
+        for i, item in enumerate(self.extra_devices):
+            if not isinstance(item, dict):
+                errors.append(f"extra_devices[{i}] 应为对象")
+                continue
+            devices.append((f"extra_devices[{i}]", str(item.get("vid", "")), str(item.get("pid", ""))))
+        for name, vid, pid in devices:
+            if not VID_PATTERN.fullmatch(vid.upper()):
+                errors.append(f"{name} 的 VID 格式应为 VID_XXXX: {vid!r}")
+            if not PID_PATTERN.fullmatch(pid.upper()):
+                errors.append(f"{name} 的 PID 格式应为 PID_XXXX: {pid!r}")
+        if not 0 <= self.countdown_seconds <= 3600:
+            errors.append(f"countdown_seconds 超出范围 0-3600: {self.countdown_seconds}")
+        if self.backend != "auto" and self.backend not in BACKENDS:
+            errors.append(f"未知的 backend: {self.backend}")
+        if self.policy not in POLICIES:
+            errors.append(f"policy 应为 {'/'.join(POLICIES)}: {self.policy}")
+        if self.quorum < 1:
+            errors.append(f"quorum 至少为 1: {self.quorum}")
+        for key in ("remove_debounce_ms", "insert_debounce_ms", "flap_limit", "audit_retention_days"):
+            if getattr(self, key) < 0:
+                errors.append(f"{key} 不能为负数")
+        if self.forward_url and not self.forward_url.startswith(("http://", "https://", "tcp://")):
+            errors.append(f"forward_url 应以 http://、https:// 或 tcp:// 开头: {self.forward_url}")
+        if self.forward_batch_size < 1:
+            errors.append("forward_batch_size 至少为 1")
+        if self.audit_max_bytes < 4096:
+            errors.append(f"audit_max_bytes 至少为 4096: {self.audit_max_bytes}")
+        for key in ("flap_window_seconds", "metrics_interval_seconds", "forward_interval_seconds", "audit_rotate_hours"):
+            if getattr(self, key) <= 0:
+                errors.append(f"{key} 必须大于 0")
+        for name in self.lock_backends:
+            if name not in LOCK_BACKENDS:
+                errors.append(f"未知的锁屏后端: {name}")
+        for i, spec in enumerate(self.lock_hooks):
+            if isinstance(spec, dict):
+                command = spec.get("command")
+                if not isinstance(command, list) or not command or not all(isinstance(arg, str) for arg in command):
+                    errors.append(f"lock_hooks[{i}].command 应为非空的字符串列表")
+            elif spec not in LOCK_HOOKS:
+                errors.append(f"lock_hooks[{i}] 未知的锁屏前动作: {spec!r}")
+        if not 0 <= self.lock_hook_deadline_ms <= 5000:
+            errors.append(f"lock_hook_deadline_ms 超出范围 0-5000: {self.lock_hook_deadline_ms}")
+        for key in ("control_port", "metrics_port", "broker_port"):
+            if not 0 <= getattr(self, key) <= 65535:
+                errors.append(f"{key} 超出端口范围: {getattr(self, key)}")
+        return errors
 
     def get_device_id_pattern(self) -> str:
         return f"%{self.device_vid}&{self.device_pid}%"
@@ -71,38 +472,241 @@ class AppConfig:
 
 
 class ConfigManager:
-    """配置文件管理器"""
+    """配置文件管理器
+
+    写入先落到临时文件、fsync 后原子替换，崩溃时不会留下写了一半的配置；写入后读回校验通过才
+    更新 .bak 备份。update() 只改内存，SAVE_DELAY 内的多次修改合并为一次写入。
+    读取和写入按同样的规则校验字段类型和取值：update() 遇到不合法的修改抛出 ConfigError、配置不变，
+    save() 拒绝写入不合法的配置；启动时文件不合法则改用 .bak，运行中则保留当前配置。
+    watch() 每 WATCH_INTERVAL 秒比较文件的 mtime/大小，外部修改通过校验后热加载并通知订阅者。
+    """
+    SAVE_DELAY = 0.5
+    WATCH_INTERVAL = 2.0
 
     def __init__(self, config_path: str = CONFIG_FILE):
         self.config_path = config_path
+        self.backup_path = f"{config_path}.bak"
+        self._lock = threading.RLock()
+        self._save_timer: Optional[threading.Timer] = None
+        self._stamp: Optional[tuple] = None  # 最近一次读写时文件的 (mtime_ns, size)
+        self._listeners: List[Callable[[AppConfig], None]] = []
+        self._watching = False
+        self.config: Optional[AppConfig] = None
         self.config = self.load()
 
+    def _file_stamp(self) -> Optional[tuple]:
+        try:
+            st = os.stat(self.config_path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    @staticmethod
+    def _read(path: str) -> AppConfig:
+        with open(path, 'r', encoding='utf-8') as f:
+            return AppConfig.from_dict(json.load(f))
+
+    @staticmethod
+    def _atomic_write(path: str, text: str):
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
     def load(self) -> AppConfig:
-        if os.path.exists(self.config_path):
+        """读取配置文件；文件自上次读写后没有变化时直接返回当前配置"""
+        with self._lock:
+            stamp = self._file_stamp()
+            if stamp is None:
+                return self.config or AppConfig()
+            if stamp == self._stamp and self.config is not None:
+                return self.config
             try:
-                with open(self.config_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                return AppConfig(**data)
-            except (json.JSONDecodeError, TypeError) as e:
-                print(f"配置文件读取失败，使用默认配置: {e}")
-        return AppConfig()
+                config = self._read(self.config_path)
+            except (OSError, ValueError) as e:  # JSON 错误和 ConfigError 都是 ValueError
+                METRICS.config_load_errors.inc()
+                print(f"配置文件无效: {e}")
+                return self._fallback()
+            self._stamp = stamp
+            if not os.path.exists(self.backup_path):
+                self._write_backup(config)
+            return config
+
+    def _fallback(self) -> AppConfig:
+        if self.config is not None:
+            print("保留当前配置")
+            return self.config
+        try:
+            config = self._read(self.backup_path)
+            print(f"改用上次有效配置的备份 {self.backup_path}")
+            return config
+        except (OSError, ValueError):
+            print("没有可用的备份，使用默认配置")
+            return AppConfig()
+
+    def _write_backup(self, config: AppConfig):
+        try:
+            self._atomic_write(self.backup_path, json.dumps(asdict(config), indent=2, ensure_ascii=False))
+        except OSError as e:
+            print(f"配置备份失败: {e}")
 
     def save(self, config: Optional[AppConfig] = None) -> bool:
-        if config:
+        """立即写入（取消尚未执行的合并写入）；配置不合法时不写入，返回 False"""
+        with self._lock:
+            try:
+                AppConfig.from_dict(asdict(config or self.config))
+            except ConfigError as e:
+                METRICS.config_saves["invalid"].inc()
+                print(f"配置不合法，未保存: {e}")
+                return False
+            if config:
+                self.config = config
+            if self._save_timer:
+                self._save_timer.cancel()
+                self._save_timer = None
+            text = json.dumps(asdict(self.config), indent=2, ensure_ascii=False)
+            try:
+                self._atomic_write(self.config_path, text)
+                self._stamp = self._file_stamp()
+                self._write_backup(self._read(self.config_path))  # .bak 只取自能被成功读回的配置
+                METRICS.config_saves["ok"].inc()
+                return True
+            except Exception as e:
+                METRICS.config_saves["error"].inc()
+                print(f"配置保存失败: {e}")
+                return False
+
+    def update(self, **kwargs) -> None:
+        """修改内存中的配置，并安排在 SAVE_DELAY 后写入；期间的其他修改合并到同一次写入
+
+        修改后的配置不合法时抛出 ConfigError（列出全部问题），当前配置保持不变。
+        """
+        with self._lock:
+            changes = {key: value for key, value in kwargs.items() if hasattr(self.config, key)}
+            AppConfig.from_dict({**asdict(self.config), **changes})
+            for key, value in changes.items():
+                setattr(self.config, key, value)
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(self.SAVE_DELAY, self.flush)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def flush(self) -> bool:
+        """立即写入尚未落盘的修改"""
+        with self._lock:
+            if self._save_timer is None:
+                return True
+            return self.save()
+
+    def watch(self, on_reload: Callable[[AppConfig], None]):
+        """订阅配置文件的外部修改"""
+        with self._lock:
+            self._listeners.append(on_reload)
+            if self._watching:
+                return
+            self._watching = True
+        threading.Thread(target=self._watch_loop, daemon=True).start()
+
+    def _watch_loop(self):
+        while True:
+            time.sleep(self.WATCH_INTERVAL)
+            try:
+                self.check_reload()
+            except Exception as e:
+                print(f"配置热加载失败: {e}")
+
+    def check_reload(self, notify: bool = True) -> bool:
+        """文件被外部修改且通过校验时替换当前配置并通知订阅者"""
+        with self._lock:
+            stamp = self._file_stamp()
+            if stamp is None or stamp == self._stamp or self._save_timer is not None:
+                return False  # 未变化，或本进程有待写入的修改（以本进程为准）
+            self._stamp = stamp  # 不合法的文件也只报告一次
+            try:
+                config = self._read(self.config_path)
+            except (OSError, ValueError) as e:
+                METRICS.config_load_errors.inc()
+                print(f"配置文件被修改但无效，保留当前配置: {e}")
+                return False
+            if config == self.config:
+                return False
             self.config = config
+            self._write_backup(config)
+            listeners = list(self._listeners)
+        METRICS.config_reloads.inc()
+        print("检测到配置文件变化，已重新加载")
+        for listener in listeners if notify else []:
+            listener(config)
+        return True
+
+
+# ==================== WMI 连接 ====================
+
+class WMIConnectionManager:
+    """按线程复用 WMI 连接
+
+    COM 对象不能跨单元使用，因此每个线程持有一条连接。连接空闲超过 HEALTH_CHECK_INTERVAL
+    后再次取用时先做一次轻量查询，调用失败（如 WMI 服务重启）则丢弃并在下次取用时重连。
+    """
+    HEALTH_CHECK_INTERVAL = 30.0
+    HEALTH_CHECK_WQL = "SELECT Caption FROM Win32_OperatingSystem"
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reconnects = 0
+
+    def get(self):
+        conn = getattr(self._local, "conn", None)
+        now = time.monotonic()
+        if conn is not None and now - self._local.last_used > self.HEALTH_CHECK_INTERVAL:
+            try:
+                conn.query(self.HEALTH_CHECK_WQL)
+            except Exception as e:
+                METRICS.wmi_errors["health_check"].inc()
+                print(f"WMI 连接失效，重新连接: {e}")
+                conn = None
+                with self._lock:
+                    self.reconnects += 1
+        if conn is None:
+            conn = wmi.WMI()
+            self._local.conn = conn
+            with self._lock:
+                self.created += 1
+        self._local.last_used = now
+        return conn
+
+    def run(self, func: Callable):
+        """用当前线程的连接执行 func(conn)，失败时重连并重试一次"""
         try:
-            with open(self.config_path, 'w', encoding='utf-8') as f:
-                json.dump(asdict(self.config), f, indent=2, ensure_ascii=False)
-            return True
+            return func(self.get())
         except Exception as e:
-            print(f"配置保存失败: {e}")
-            return False
+            METRICS.wmi_errors["call"].inc()
+            print(f"WMI 调用失败，重新连接后重试: {e}")
+            self.invalidate()
+            with self._lock:
+                self.reconnects += 1
+            return func(self.get())
 
-    def update(self, **kwargs) -> None:
-        for key, value in kwargs.items():
-            if hasattr(self.config, key):
-                setattr(self.config, key, value)
-        self.save()
+    def invalidate(self):
+        """丢弃当前线程的连接（线程退出、CoUninitialize 之前也应调用）"""
+        self._local.conn = None
+
+
+WMI_CONNECTIONS = WMIConnectionManager()
+
+
+def run_loop_with_com(loop: asyncio.AbstractEventLoop):
+    """事件循环线程的入口：在位查询、reconfigure 和代理的全量查询都会在这个线程上调用 WMI，先初始化 COM"""
+    com_initialize()
+    try:
+        loop.run_forever()
+    finally:
+        WMI_CONNECTIONS.invalidate()
+        com_uninitialize()
 
 
 # ==================== USB 扫描 ====================
@@ -124,40 +728,268 @@ class USBDevice:
         return f"{self.vid}&{self.pid}"
 
 
+class DeviceInventory:
+    """USB 设备清单缓存
+
+    全量同步一次后由插拔事件增量维护，按实例 ID 和 VID/PID 建立索引。
+    同步期间到达的事件先记入日志，同步完成后重放，避免被旧的枚举结果覆盖。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_instance: Dict[str, USBDevice] = {}
+        self._by_vid_pid: Dict[str, Dict[str, USBDevice]] = {}
+        self._snapshot: Optional[List[USBDevice]] = None
+        self._journal: Optional[list] = None
+        self.synced = False
+        self.tracking = False  # 监控器运行中才能保证增量更新不丢事件
+
+    @property
+    def is_live(self) -> bool:
+        return self.synced and self.tracking
+
+    def _add(self, device: USBDevice):
+        self._remove(device.device_id)
+        self._by_instance[device.device_id] = device
+        self._by_vid_pid.setdefault(device.vid_pid.upper(), {})[device.device_id] = device
+
+    def _remove(self, device_id: str):
+        device = self._by_instance.pop(device_id, None)
+        if device:
+            instances = self._by_vid_pid.get(device.vid_pid.upper())
+            if instances is not None:
+                instances.pop(device_id, None)
+                if not instances:
+                    del self._by_vid_pid[device.vid_pid.upper()]
+
+    def apply(self, action: str, device: USBDevice):
+        """应用一次插拔事件"""
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append((action, device))
+            if action == "add":
+                self._add(device)
+            else:
+                self._remove(device.device_id)
+            self._snapshot = None
+
+    def begin_resync(self):
+        with self._lock:
+            self._journal = []
+
+    def finish_resync(self, devices: List[USBDevice]):
+        with self._lock:
+            journal, self._journal = self._journal or [], None
+            self._by_instance.clear()
+            self._by_vid_pid.clear()
+            for device in devices:
+                self._add(device)
+            for action, device in journal:
+                if action == "add":
+                    self._add(device)
+                else:
+                    self._remove(device.device_id)
+            self._snapshot = None
+            self.synced = True
+
+    def cancel_resync(self):
+        with self._lock:
+            self._journal = None
+
+    def invalidate(self):
+        with self._lock:
+            self.synced = False
+            self._snapshot = None
+
+    def snapshot(self) -> List[USBDevice]:
+        """按 VID/PID 去重的设备列表（只读，清单未变化时直接复用）"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = [next(iter(instances.values())) for instances in self._by_vid_pid.values()]
+                self._snapshot = snapshot
+        return snapshot
+
+    def find(self, vid: str, pid: str) -> Optional[USBDevice]:
+        instances = self._by_vid_pid.get(f"{vid}&{pid}".upper())
+        if not instances:
+            return None
+        try:
+            return next(iter(instances.values()))
+        except (StopIteration, RuntimeError):
+            return None  # 与写入并发时视为不存在，调用方可重试
+
+    def get(self, device_id: str) -> Optional[USBDevice]:
+        return self._by_instance.get(device_id)
+
+
 class USBScanner:
     """USB 设备扫描器"""
     VID_PID_PATTERN = re.compile(r'VID_([0-9A-Fa-f]{4})&PID_([0-9A-Fa-f]{4})', re.IGNORECASE)
+    SYSFS_USB_DEVICES = "/sys/bus/usb/devices"
+    USB_ENTITY_WQL = "SELECT DeviceID, Name, Description FROM Win32_PnPEntity WHERE DeviceID LIKE 'USB%'"
+    SCAN_TIMEOUT = 30.0
+    inventory = DeviceInventory()
+    _executor: Optional[ThreadPoolExecutor] = None
+    _executor_lock = threading.Lock()
+    _scan: Optional["DeviceScan"] = None
 
     @classmethod
-    def scan_devices(cls) -> List[USBDevice]:
-        devices = []
-        seen = set()
-        try:
-            c = wmi.WMI()
-            for device in c.Win32_PnPEntity():
-                device_id = device.DeviceID or ""
-                if not device_id.startswith("USB\\"):
-                    continue
-                match = cls.VID_PID_PATTERN.search(device_id)
-                if match:
-                    vid = f"VID_{match.group(1).upper()}"
-                    pid = f"PID_{match.group(2).upper()}"
-                    vid_pid = f"{vid}&{pid}"
-                    if vid_pid in seen:
-                        continue
-                    seen.add(vid_pid)
-                    name = device.Name or device.Description or "未知设备"
-                    devices.append(USBDevice(vid=vid, pid=pid, name=name, device_id=device_id))
+    def parse_vid_pid(cls, device_id: str) -> Optional[tuple]:
+        """从 DeviceID 中解析 (VID_XXXX, PID_XXXX)"""
+        match = cls.VID_PID_PATTERN.search(device_id)
+        if not match:
+            return None
+        return f"VID_{match.group(1).upper()}", f"PID_{match.group(2).upper()}"
+
+    @classmethod
+    def enumerate_devices(cls) -> List[USBDevice]:
+        """全量枚举所有 USB 设备实例（不去重，也不读写缓存）"""
+        return list(cls.iter_devices())
+
+    @classmethod
+    def iter_devices(cls, cancel: Optional[threading.Event] = None, timeout: Optional[float] = None) -> Iterator[USBDevice]:
+        """逐个交出 USB 设备实例（不去重，也不读写缓存）
+
+        cancel 被置位时在下一个设备处结束；超过 timeout 秒抛出 TimeoutError。两者都只能在设备之间
+        检查，单次卡住的 WMI 调用无法打断。
+        """
+        start = time.perf_counter()
+        deadline = None if timeout is None else start + timeout
+        try:
+            for device in cls._iter_sysfs() if wmi is None else cls._iter_wmi():
+                if cancel is not None and cancel.is_set():
+                    return
+                if deadline is not None and time.perf_counter() > deadline:
+                    raise TimeoutError(f"USB 扫描超过 {timeout:g} 秒")
+                yield device
+        finally:
+            METRICS.scan_duration.observe(time.perf_counter() - start)
+
+    @classmethod
+    def _iter_wmi(cls) -> Iterator[USBDevice]:
+        # 查询只返回 USB 实体；每个实体的属性在读取时才经 COM 取回，这部分开销随迭代分摊
+        for device in WMI_CONNECTIONS.run(lambda c: c.query(cls.USB_ENTITY_WQL)):
+            device_id = device.DeviceID or ""
+            if not device_id.startswith("USB\\"):
+                continue  # LIKE 'USB%' 也会匹配 USBSTOR 等
+            parsed = cls.parse_vid_pid(device_id)
+            if parsed:
+                name = device.Name or device.Description or "未知设备"
+                yield USBDevice(vid=parsed[0], pid=parsed[1], name=name, device_id=device_id)
+
+    @classmethod
+    def _iter_sysfs(cls) -> Iterator[USBDevice]:
+        """Linux 下通过 sysfs 枚举 USB 设备"""
+        for entry in sorted(os.listdir(cls.SYSFS_USB_DEVICES)):
+            path = os.path.join(cls.SYSFS_USB_DEVICES, entry)
+            try:
+                with open(os.path.join(path, "idVendor")) as f:
+                    vid = f"VID_{f.read().strip().upper()}"
+                with open(os.path.join(path, "idProduct")) as f:
+                    pid = f"PID_{f.read().strip().upper()}"
+            except OSError:
+                continue  # 接口节点没有 idVendor
+            yield USBDevice(vid=vid, pid=pid, name=cls.read_sysfs_name(path), device_id=f"USB\\{vid}&{pid}\\{entry}")
+
+    @staticmethod
+    def read_sysfs_name(path: str) -> str:
+        try:
+            with open(os.path.join(path, "product"), encoding="utf-8", errors="replace") as f:
+                return f.read().strip() or "未知设备"
+        except OSError:
+            return "未知设备"
+
+    @classmethod
+    def resync(cls) -> List[USBDevice]:
+        """全量重新同步设备清单"""
+        cls.inventory.begin_resync()
+        try:
+            devices = cls.enumerate_devices()
         except Exception as e:
+            cls.inventory.cancel_resync()
             print(f"USB 扫描失败: {e}")
-        return devices
+            return []
+        cls.inventory.finish_resync(devices)
+        return cls.inventory.snapshot()
+
+    @classmethod
+    def scan_devices(cls, refresh: bool = False) -> List[USBDevice]:
+        """返回设备列表；清单缓存有效时直接读取快照，refresh=True 强制全量同步"""
+        if refresh or not cls.inventory.is_live:
+            return cls.resync()
+        return cls.inventory.snapshot()
 
     @classmethod
     def find_device(cls, vid: str, pid: str) -> Optional[USBDevice]:
-        for device in cls.scan_devices():
-            if device.vid.upper() == vid.upper() and device.pid.upper() == pid.upper():
-                return device
-        return None
+        if not cls.inventory.is_live:
+            cls.resync()
+        return cls.inventory.find(vid, pid)
+
+    @classmethod
+    def last_known(cls) -> List[USBDevice]:
+        """上次扫描或事件维护得到的设备列表，可能已过期，用于在扫描完成前先行显示"""
+        return cls.inventory.snapshot()
+
+    @classmethod
+    def _get_executor(cls) -> "ThreadPoolExecutor":
+        with cls._executor_lock:
+            if cls._executor is None:
+                from concurrent.futures import ThreadPoolExecutor  # 导入较慢（会带入 logging），首次扫描时再加载
+                cls._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="usb-scan", initializer=com_initialize)
+            return cls._executor
+
+    @classmethod
+    def submit_scan(cls, refresh: bool = False) -> Future:
+        """在常驻扫描线程上执行 scan_devices，复用该线程的 COM 初始化和 WMI 连接"""
+        return cls._get_executor().submit(cls.scan_devices, refresh)
+
+    @classmethod
+    def start_scan(cls, timeout: float = SCAN_TIMEOUT) -> "DeviceScan":
+        """在常驻扫描线程上开始一次流式扫描；已有扫描在进行时直接返回它，不再排队新的扫描"""
+        executor = cls._get_executor()
+        with cls._executor_lock:
+            if cls._scan is not None and not cls._scan.finished.is_set():
+                return cls._scan
+            cls._scan = scan = DeviceScan(timeout)
+        executor.submit(scan.run)
+        return scan
+
+
+class DeviceScan:
+    """一次流式扫描
+
+    找到的设备依次追加到 devices（只追加，其他线程可随时读取已找到的部分），结束后 finished 置位，
+    state 为 done / cancelled / timeout / failed。只有完整结束的扫描才用来同步设备清单。
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.devices: List[USBDevice] = []
+        self.state = "running"
+        self.error: Optional[Exception] = None
+        self.finished = threading.Event()
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def run(self):
+        USBScanner.inventory.begin_resync()
+        try:
+            for device in USBScanner.iter_devices(self._cancel, self.timeout):
+                self.devices.append(device)
+            self.state = "cancelled" if self._cancel.is_set() else "done"
+        except TimeoutError as e:
+            self.state, self.error = "timeout", e
+        except Exception as e:
+            self.state, self.error = "failed", e
+            print(f"USB 扫描失败: {e}")
+        if self.state == "done":
+            USBScanner.inventory.finish_resync(self.devices)
+        else:
+            USBScanner.inventory.cancel_resync()
+        self.finished.set()
 
 
 # ==================== 开机自启 ====================
@@ -236,129 +1068,3180 @@ class AutoStartManager:
             winreg.CloseKey(key)
             return True
         except Exception as e:
-            print(f"禁用开机自启失败: {e}")
-            return False
+            print(f"禁用开机自启失败: {e}")
+            return False
+
+    @classmethod
+    def set_enabled(cls, enabled: bool) -> bool:
+        """设置开机自启状态"""
+        return cls.enable() if enabled else cls.disable()
+
+    @classmethod
+    def update_path_if_needed(cls) -> None:
+        """如果路径变化，更新注册表（用于程序移动后）"""
+        current = cls.get_current_path()
+        if current is not None:
+            expected = cls.get_exe_path()
+            if current != expected:
+                print(f"检测到路径变化，更新自启动路径...")
+                cls.enable()
+
+
+# ==================== USB 监控 ====================
+
+@dataclass
+class DeviceEvent:
+    """原始设备事件"""
+    action: str  # "add" / "remove"
+    device_id: str
+    vid: str = ""
+    pid: str = ""
+    name: str = ""
+    timestamp: float = field(default_factory=time.monotonic)
+
+    @property
+    def vid_pid(self) -> str:
+        return f"{self.vid}&{self.pid}"
+
+    @classmethod
+    def from_device_id(cls, action: str, device_id: str, name: str = "") -> Optional["DeviceEvent"]:
+        parsed = USBScanner.parse_vid_pid(device_id)
+        if not parsed:
+            return None
+        return cls(action=action, device_id=device_id, vid=parsed[0], pid=parsed[1], name=name)
+
+    def to_device(self) -> USBDevice:
+        return USBDevice(vid=self.vid, pid=self.pid, name=self.name or "未知设备", device_id=self.device_id)
+
+
+class DeviceEventBackend:
+    """设备事件后端接口
+
+    open/wait/close 均在监控线程内调用；wake 可从任意线程调用，用于打断阻塞的 wait。
+    covers_all_devices 为 False 的后端只投递密钥的事件，不能用来增量维护设备清单。
+    """
+    name = "base"
+    covers_all_devices = True
+
+    def configure(self, config: AppConfig) -> None:
+        """启动前和就地修改配置时调用，早于 find_instances"""
+        pass
+
+    def open(self, config: AppConfig) -> None:
+        pass
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[DeviceEvent]:
+        """阻塞等待下一个事件，超时或被唤醒时返回 None"""
+        raise NotImplementedError
+
+    def wake(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def find_instances(self, vid: str, pid: str) -> List[str]:
+        """返回当前在位的指定 VID/PID 设备实例 ID"""
+        raise NotImplementedError
+
+    def attach(self, loop: asyncio.AbstractEventLoop, config: AppConfig,
+               on_event: Callable[[DeviceEvent], None], on_error: Callable[[Exception], None]) -> None:
+        """在事件循环上接收事件（AsyncCore 使用）
+
+        on_event 可从任意线程调用，由它负责排队和唤醒事件循环（AsyncCore.ingest）；on_error 经
+        call_soon_threadsafe 交给事件循环。默认实现用一个读取线程执行 open/wait/close；
+        能提供文件描述符或进程内队列的后端应改为直接注册到事件循环。open 失败时直接抛出。
+        """
+        opened = threading.Event()
+        failure: List[Exception] = []
+        self._reader_stop = stop = threading.Event()
+
+        def reader():
+            try:
+                self.open(config)
+            except Exception as e:
+                failure.append(e)
+                self.close()
+                return
+            finally:
+                opened.set()
+            try:
+                while not stop.is_set():
+                    event = self.wait(None)
+                    if event and not stop.is_set():
+                        on_event(event)
+            except Exception as e:
+                if not stop.is_set():
+                    loop.call_soon_threadsafe(on_error, e)
+            finally:
+                self.close()
+
+        threading.Thread(target=reader, daemon=True, name=f"{self.name}-reader").start()
+        opened.wait()
+        if failure:
+            raise failure[0]
+
+    def detach(self) -> None:
+        """停止向事件循环投递事件并关闭事件源"""
+        stop = getattr(self, "_reader_stop", None)
+        if stop:
+            stop.set()
+            self.wake()
+
+    def is_present(self, vid: str, pid: str) -> bool:
+        return bool(self.find_instances(vid, pid))
+
+
+class WMIBackend(DeviceEventBackend):
+    """基于 WMI 实例事件的后端（Windows）
+
+    创建和删除事件合并为一个 __InstanceOperationEvent 订阅，按事件类分派，
+    NextEvent 阻塞等待，空闲时每 IDLE_WAIT_MS 才醒来一次以便响应 stop。
+    订阅覆盖全部 USB 设备，用于增量维护设备清单，目标设备由 USBMonitor 过滤。
+    """
+    name = "wmi"
+    IDLE_WAIT_MS = 1000
+    EVENT_ACTIONS = {"creation": "add", "deletion": "remove"}
+
+    def __init__(self):
+        self.watcher = None
+        self._com_ready = False
+
+    def open(self, config: AppConfig) -> None:
+        if not self._com_ready:
+            com_initialize()
+            self._com_ready = True
+        c = WMI_CONNECTIONS.get()
+        print(f"开始监听设备 {config.get_device_id_pattern()}...")
+
+        query = ("SELECT * FROM __InstanceOperationEvent WITHIN 1 "
+                 "WHERE (__CLASS = '__InstanceCreationEvent' OR __CLASS = '__InstanceDeletionEvent') "
+                 "AND TargetInstance ISA 'Win32_PnPEntity' AND TargetInstance.DeviceID LIKE 'USB%'")
+        self.watcher = c.watch_for(raw_wql=query)
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[DeviceEvent]:
+        timeout_ms = self.IDLE_WAIT_MS if timeout is None else min(self.IDLE_WAIT_MS, max(0, int(timeout * 1000)))
+        try:
+            event = self.watcher(timeout_ms=timeout_ms)
+        except wmi.x_wmi_timed_out:
+            return None
+        action = self.EVENT_ACTIONS.get(getattr(event, "event_type", None))
+        if not event or not action:
+            return None
+        return DeviceEvent.from_device_id(action, event.DeviceID or "", event.Name or event.Description or "")
+
+    def close(self) -> None:
+        self.watcher = None
+        WMI_CONNECTIONS.invalidate()
+        if self._com_ready:
+            com_uninitialize()
+            self._com_ready = False
+
+    def find_instances(self, vid: str, pid: str) -> List[str]:
+        wql = f"SELECT DeviceID FROM Win32_PnPEntity WHERE DeviceID LIKE 'USB\\{vid}&{pid}%'"
+        return WMI_CONNECTIONS.run(lambda c: [r.DeviceID for r in c.query(wql)])
+
+
+class UdevBackend(DeviceEventBackend):
+    """基于内核 netlink uevent 的后端（Linux），事件由内核推送，无需轮询"""
+    name = "udev"
+    NETLINK_KOBJECT_UEVENT = 15
+    KERNEL_GROUP = 1
+
+    def __init__(self):
+        self.sock: Optional[socket.socket] = None
+        self._wake_r = self._wake_w = -1  # 唤醒管道随 open 创建、随 close 关闭
+        self._wake_lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def open(self, config: AppConfig) -> None:
+        with self._wake_lock:
+            if self._wake_r < 0:
+                self._wake_r, self._wake_w = os.pipe()
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, self.NETLINK_KOBJECT_UEVENT)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.sock.bind((0, self.KERNEL_GROUP))
+        print(f"开始监听设备 {config.device_vid}&{config.device_pid} (netlink)...")
+
+    @staticmethod
+    def parse_uevent(data: bytes) -> Optional[DeviceEvent]:
+        """解析内核 uevent 报文，只关心 usb_device 的 add/remove"""
+        parts = data.split(b"\0")
+        if b"@" not in parts[0]:
+            return None  # libudev 格式或其他报文
+        props = {}
+        for part in parts[1:]:
+            key, sep, value = part.partition(b"=")
+            if sep:
+                props[key.decode(errors="replace")] = value.decode(errors="replace")
+        action = props.get("ACTION")
+        if action not in ("add", "remove"):
+            return None
+        if props.get("SUBSYSTEM") != "usb" or props.get("DEVTYPE") != "usb_device":
+            return None
+        product = props.get("PRODUCT", "").split("/")
+        if len(product) < 2:
+            return None
+        try:
+            vid = f"VID_{int(product[0], 16):04X}"
+            pid = f"PID_{int(product[1], 16):04X}"
+        except ValueError:
+            return None
+        devpath = props.get("DEVPATH", "")
+        name = USBScanner.read_sysfs_name(f"/sys{devpath}") if action == "add" else ""
+        return DeviceEvent(action=action, device_id=f"USB\\{vid}&{pid}\\{os.path.basename(devpath)}", vid=vid, pid=pid, name=name)
+
+    def attach(self, loop, config, on_event, on_error) -> None:
+        """netlink 套接字直接注册到事件循环，不需要读取线程；每次可读时读空已到达的报文"""
+        self.open(config)
+        sock = self.sock
+        sock.setblocking(False)
+
+        def readable():
+            while True:
+                try:
+                    data = sock.recv(65536)
+                except BlockingIOError:
+                    return
+                except OSError as e:
+                    self.detach()
+                    on_error(e)
+                    return
+                event = self.parse_uevent(data)
+                if event:
+                    on_event(event)
+
+        loop.add_reader(sock.fileno(), readable)
+        self._loop = loop
+
+    def detach(self) -> None:
+        loop, self._loop = self._loop, None
+        if loop and self.sock:
+            loop.remove_reader(self.sock.fileno())
+        self.close()
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[DeviceEvent]:
+        readable, _, _ = select.select([self.sock, self._wake_r], [], [], timeout)
+        if self._wake_r in readable:
+            os.read(self._wake_r, 64)
+        if self.sock not in readable:
+            return None
+        return self.parse_uevent(self.sock.recv(65536))
+
+    def wake(self) -> None:
+        with self._wake_lock:
+            if self._wake_w >= 0:
+                os.write(self._wake_w, b"x")
+
+    def close(self) -> None:
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+        with self._wake_lock:
+            for fd in (self._wake_r, self._wake_w):
+                if fd >= 0:
+                    os.close(fd)
+            self._wake_r = self._wake_w = -1
+
+    def find_instances(self, vid: str, pid: str) -> List[str]:
+        return [d.device_id for d in USBScanner.enumerate_devices() if d.vid == vid.upper() and d.pid == pid.upper()]
+
+
+class FakeBackend(DeviceEventBackend):
+    """进程内模拟后端，用于在无硬件的环境下驱动监控器"""
+    name = "fake"
+
+    def __init__(self, present: Optional[List[str]] = None):
+        self.events: "queue.Queue[Optional[DeviceEvent]]" = queue.Queue()
+        self.present: Dict[str, str] = {}  # device_id -> vid_pid
+        self._deliver: Optional[Callable[[DeviceEvent], None]] = None
+        for vid_pid in present or []:
+            self.present[f"USB\\{vid_pid}\\FAKE"] = vid_pid.upper()
+
+    def inject(self, action: str, vid: str, pid: str, device_id: Optional[str] = None) -> DeviceEvent:
+        """注入一个模拟事件"""
+        vid, pid = vid.upper(), pid.upper()
+        device_id = device_id or f"USB\\{vid}&{pid}\\FAKE"
+        if action == "add":
+            self.present[device_id] = f"{vid}&{pid}"
+        else:
+            self.present.pop(device_id, None)
+        event = DeviceEvent(action=action, device_id=device_id, vid=vid, pid=pid)
+        deliver = self._deliver
+        if deliver:
+            deliver(event)
+        else:
+            self.events.put(event)
+        return event
+
+    def attach(self, loop, config, on_event, on_error) -> None:
+        """注入的事件直接交给 on_event"""
+        self._deliver = on_event
+        while True:  # 接入前已注入的事件
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if event:
+                self._deliver(event)
+
+    def detach(self) -> None:
+        self._deliver = None
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[DeviceEvent]:
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def wake(self) -> None:
+        self.events.put(None)
+
+    def find_instances(self, vid: str, pid: str) -> List[str]:
+        key = f"{vid}&{pid}".upper()
+        return [device_id for device_id, vid_pid in list(self.present.items()) if vid_pid == key]
+
+
+class _TcpRowOwnerPid(ctypes.Structure):
+    """MIB_TCPROW_OWNER_PID，地址和端口均为网络字节序"""
+    _fields_ = [("state", ctypes.c_ulong), ("local_addr", ctypes.c_ulong), ("local_port", ctypes.c_ulong),
+                ("remote_addr", ctypes.c_ulong), ("remote_port", ctypes.c_ulong), ("pid", ctypes.c_ulong)]
+
+
+def _windows_tcp_peer_pid(local_port: int, peer_port: int) -> Optional[int]:
+    """在 TCP 连接表中找到对端那一侧（本地端口 peer_port、远端端口 local_port）的进程 ID"""
+    iphlpapi = ctypes.windll.iphlpapi
+    size = ctypes.c_ulong(0)
+    for _ in range(3):  # 两次调用之间连接表可能变大
+        buffer = ctypes.create_string_buffer(size.value or 1)
+        # TCP_TABLE_OWNER_PID_ALL = 5；122 = ERROR_INSUFFICIENT_BUFFER
+        result = iphlpapi.GetExtendedTcpTable(buffer, ctypes.byref(size), False, socket.AF_INET, 5, 0)
+        if result == 0:
+            break
+        if result != 122:
+            return None
+    else:
+        return None
+    count = ctypes.c_ulong.from_buffer(buffer).value
+    rows = (_TcpRowOwnerPid * count).from_buffer(buffer, ctypes.sizeof(ctypes.c_ulong))
+    for row in rows:
+        if socket.ntohs(row.local_port & 0xFFFF) == peer_port and socket.ntohs(row.remote_port & 0xFFFF) == local_port:
+            return row.pid
+    return None
+
+
+def loopback_peer_owner(sock: socket.socket) -> Optional[int]:
+    """本机 TCP 连接对端进程的属主：Linux 为 uid，Windows 为会话 ID（0 都表示系统：root / 服务会话）；查不到返回 None"""
+    local_port, peer_port = sock.getsockname()[1], sock.getpeername()[1]
+    if IS_WINDOWS:
+        pid = _windows_tcp_peer_pid(local_port, peer_port)
+        session = ctypes.c_ulong(0)
+        if pid is None or not ctypes.windll.kernel32.ProcessIdToSessionId(pid, ctypes.byref(session)):
+            return None
+        return session.value
+    for table in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(table, 'r', encoding='ascii') as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    if (int(fields[1].rsplit(":", 1)[1], 16) == peer_port
+                            and int(fields[2].rsplit(":", 1)[1], 16) == local_port):
+                        return int(fields[7])
+        except (OSError, ValueError, IndexError, StopIteration):
+            continue
+    return None
+
+
+def local_owner() -> int:
+    """本进程的属主，与 loopback_peer_owner 的取值含义相同"""
+    if IS_WINDOWS:
+        session = ctypes.c_ulong(0)
+        ctypes.windll.kernel32.ProcessIdToSessionId(os.getpid(), ctypes.byref(session))
+        return session.value
+    return os.getuid()
+
+
+class BrokerBackend(DeviceEventBackend):
+    """经本机设备代理（--broker）接收事件的后端，同一主机上的多个用户会话共享一个设备事件源
+
+    按配置中的密钥订阅，代理只推送这些 VID/PID 的事件。订阅时代理先回复在位快照，之后的在位查询
+    由本地副本回答；修改密钥后重新订阅，按新快照补出差异事件。尚未被快照覆盖的密钥（启动时、
+    reconfigure 时）改用一次性连接向代理查询。代理断开时 wait 抛出异常，由监控器按常规重建订阅并全量核对。
+
+    127.0.0.1 上的端口谁都能抢先监听，所以每次连接后先核对对端进程的属主（对端凭据）：只信任以系统身份
+    运行的代理（Linux 的 root、Windows 服务所在的会话 0）或与本会话同属一个用户/会话的代理。
+    其他用户冒充的代理会被拒绝，监控器报告未接入并按重建节奏重试，不会采信伪造的在位事件。
+    """
+    name = "broker"
+    covers_all_devices = False
+    CONNECT_TIMEOUT = 2.0
+
+    def __init__(self):
+        self.port = AppConfig.broker_port
+        self.keys: List[str] = []
+        self.present: Dict[str, set] = {}  # vid_pid -> 在位实例 ID
+        self.synced: set = set()  # 已由快照覆盖、可直接回答的密钥
+        self.sock: Optional[socket.socket] = None
+        self._buffer = b""
+        self._pending: "deque[DeviceEvent]" = deque()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _send(sock: socket.socket, request: dict):
+        sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+
+    @staticmethod
+    def _read_line(sock: socket.socket, buffer: bytes = b"") -> tuple:
+        """阻塞读取一行，返回 (行, 剩余数据)"""
+        while b"\n" not in buffer:
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionError("设备代理已断开")
+            buffer += data
+        line, _, rest = buffer.partition(b"\n")
+        return line, rest
+
+    def configure(self, config: AppConfig) -> None:
+        self.port = config.broker_port
+        keys = sorted(rule.key for rule in config.get_device_rules())
+        with self._lock:
+            changed, self.keys = keys != self.keys, keys
+            sock = self.sock
+        if changed and sock:
+            try:
+                self._send(sock, {"cmd": "subscribe", "keys": keys})
+            except OSError:
+                pass  # 读取端会发现断开并重建订阅
+
+    def _verify_peer(self, sock: socket.socket):
+        """核对回复方的属主，冒充的代理抛出 ConnectionRefusedError
+
+        须在读到第一行回复之后核对：连接还在对方的监听队列里时查到的属主并不可靠，被 accept 后才是回复进程的属主。
+        """
+        try:
+            owner = loopback_peer_owner(sock)
+        except OSError:
+            owner = None
+        if owner not in (0, local_owner()):
+            who = "无法确认" if owner is None else f"{'会话' if IS_WINDOWS else 'uid'} {owner}"
+            raise ConnectionRefusedError(f"127.0.0.1:{self.port} 上的进程属主{who}，不是系统或本用户，不是可信的设备代理")
+
+    def query(self, keys: List[str]) -> Dict[str, List[str]]:
+        """用一次性连接查询密钥的在位实例"""
+        with socket.create_connection(("127.0.0.1", self.port), timeout=self.CONNECT_TIMEOUT) as sock:
+            self._send(sock, {"cmd": "query", "keys": keys})
+            line, _ = self._read_line(sock)
+            self._verify_peer(sock)
+        return json.loads(line)["present"]
+
+    def open(self, config: AppConfig) -> None:
+        self.configure(config)
+        sock = socket.create_connection(("127.0.0.1", self.port), timeout=self.CONNECT_TIMEOUT)
+        try:
+            self._send(sock, {"cmd": "subscribe", "keys": self.keys})
+            line, self._buffer = self._read_line(sock)
+            self._verify_peer(sock)
+            message = json.loads(line)
+        except (OSError, ValueError):
+            sock.close()
+            raise
+        sock.settimeout(None)
+        self._pending.clear()
+        with self._lock:
+            self.sock = sock
+        self._apply_snapshot(message.get("present", {}), emit=False)  # 与之前的差异由监控器全量核对
+        print(f"已连接设备代理 127.0.0.1:{self.port}，订阅 {len(self.keys)} 个密钥")
+
+    def _apply_snapshot(self, present: Dict[str, List[str]], emit: bool):
+        with self._lock:
+            for key, device_ids in present.items():
+                new, old = set(device_ids), self.present.get(key, set())
+                if emit:
+                    vid, _, pid = key.partition("&")
+                    for device_id in sorted(new - old):
+                        self._pending.append(DeviceEvent(action="add", device_id=device_id, vid=vid, pid=pid))
+                    for device_id in sorted(old - new):
+                        self._pending.append(DeviceEvent(action="remove", device_id=device_id, vid=vid, pid=pid))
+                self.present[key] = new
+            self.synced = set(present)
+
+    def _handle(self, line: bytes):
+        message = json.loads(line)
+        kind = message.get("event")
+        if kind == "snapshot":  # 重新订阅的回复
+            self._apply_snapshot(message.get("present", {}), emit=True)
+        elif kind == "device":
+            event = DeviceEvent(action=message["action"], device_id=message["device_id"],
+                                vid=message["vid"], pid=message["pid"], name=message.get("name", ""))
+            with self._lock:
+                instances = self.present.setdefault(event.vid_pid, set())
+                if event.action == "add":
+                    instances.add(event.device_id)
+                else:
+                    instances.discard(event.device_id)
+            self._pending.append(event)
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[DeviceEvent]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._pending:
+                return self._pending.popleft()
+            if b"\n" in self._buffer:
+                line, _, self._buffer = self._buffer.partition(b"\n")
+                self._handle(line)
+                continue
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            readable, _, _ = select.select([self.sock, self._wake_r], [], [], remaining)
+            if self._wake_r in readable:
+                self._wake_r.recv(64)
+                return None
+            if self.sock not in readable:
+                return None
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("设备代理已断开")
+            self._buffer += data
+
+    def wake(self) -> None:
+        self._wake_w.send(b"x")
+
+    def close(self) -> None:
+        with self._lock:
+            sock, self.sock = self.sock, None
+            self.synced = set()  # 断开期间改为向代理查询
+        if sock:
+            sock.close()
+        self._buffer = b""
+
+    def find_instances(self, vid: str, pid: str) -> List[str]:
+        key = f"{vid}&{pid}".upper()
+        with self._lock:
+            if key in self.synced:
+                return sorted(self.present.get(key, ()))
+        device_ids = self.query([key]).get(key, [])
+        with self._lock:
+            if key not in self.synced:
+                self.present[key] = set(device_ids)
+        return device_ids
+
+
+BACKENDS = {"wmi": WMIBackend, "udev": UdevBackend, "fake": FakeBackend, "broker": BrokerBackend}
+
+
+def create_backend(name: str = "auto") -> DeviceEventBackend:
+    """按名称创建设备事件后端，auto 时根据平台选择"""
+    if name == "auto":
+        name = "wmi" if IS_WINDOWS else "udev"
+    if name not in BACKENDS:
+        raise ValueError(f"未知的设备事件后端: {name}")
+    return BACKENDS[name]()
+
+
+class KeyPolicy:
+    """多密钥锁屏策略
+
+    规则按 VID/PID 建立哈希索引，事件匹配为 O(1)；在位密钥数不低于 required 时视为"已连接"。
+    """
+
+    def __init__(self, rules: List[DeviceRule], mode: str = "any", quorum: int = 1):
+        if mode not in POLICIES:
+            print(f"未知的密钥策略 {mode}，使用 any")
+            mode = "any"
+        self.mode = mode
+        self.index: Dict[str, DeviceRule] = {rule.key: rule for rule in rules}
+        if mode == "all":
+            self.required = len(self.index)
+        elif mode == "quorum":
+            self.required = max(1, min(quorum, len(self.index)))
+        else:
+            self.required = 1
+
+    @classmethod
+    def from_config(cls, config: AppConfig) -> "KeyPolicy":
+        return cls(config.get_device_rules(), config.policy, config.quorum)
+
+    def match(self, vid_pid: str) -> Optional[DeviceRule]:
+        return self.index.get(vid_pid.upper())
+
+    def satisfied(self, present_count: int) -> bool:
+        return present_count >= self.required
+
+    def describe(self) -> str:
+        return f"{self.mode} ({self.required}/{len(self.index)})"
+
+
+class PresenceStateMachine:
+    """密钥在位状态机：位于原始插拔事件与回调之间，负责去抖和抖动（flap）检测
+
+    时间由调用方传入，不读系统时钟，同一事件序列回放总是得到同样的输出。
+    - 拔出默认在前沿立即生效；配置了 remove_debounce 时需持续该时长
+    - 插入需稳定 insert_debounce 才生效，期间再次拔出则两者都不上报
+    - flap_window 内原始拔出超过 flap_limit 次时输出 "flapping"（立即锁屏），随后按未在位处理，
+      直到插入稳定生效前不再重复升级
+    observe()/poll() 返回期间产生的动作列表："removed" / "inserted" / "flapping"。
+    """
+
+    def __init__(self, present: bool, remove_debounce: float = 0.0, insert_debounce: float = 0.3,
+                 flap_limit: int = 3, flap_window: float = 10.0):
+        self.stable = present  # 已上报的状态
+        self.raw = present  # 最近一次观察到的原始状态
+        self.remove_debounce = remove_debounce
+        self.insert_debounce = insert_debounce
+        self.flap_limit = flap_limit
+        self.flap_window = flap_window
+        self.pending_at: Optional[float] = None  # 原始状态与上报状态不一致时，生效的时刻
+        self.removals: deque = deque()
+        self.escalated = False
+
+    @classmethod
+    def from_config(cls, config: AppConfig, present: bool) -> "PresenceStateMachine":
+        machine = cls(present)
+        machine.configure(config)
+        return machine
+
+    def configure(self, config: AppConfig):
+        """更新窗口参数，保留当前状态和进行中的去抖窗口"""
+        self.remove_debounce = config.remove_debounce_ms / 1000.0
+        self.insert_debounce = config.insert_debounce_ms / 1000.0
+        self.flap_limit = config.flap_limit
+        self.flap_window = config.flap_window_seconds
+
+    def next_deadline(self) -> Optional[float]:
+        return self.pending_at
+
+    def poll(self, now: float) -> List[str]:
+        """处理到期的去抖窗口"""
+        if self.pending_at is None or now < self.pending_at:
+            return []
+        self.pending_at = None
+        self.stable = self.raw
+        if self.stable:
+            self.escalated = False
+        return ["inserted" if self.stable else "removed"]
+
+    def observe(self, present: bool, now: float) -> List[str]:
+        actions = self.poll(now)
+        if present == self.raw:
+            return actions
+        self.raw = present
+        if not present and self.flap_limit > 0 and not self.escalated:
+            self.removals.append(now)
+            while self.removals and now - self.removals[0] > self.flap_window:
+                self.removals.popleft()
+            if len(self.removals) > self.flap_limit:
+                self.removals.clear()
+                self.pending_at = None
+                self.stable = False
+                self.escalated = True
+                actions.append("flapping")
+                return actions
+        if present == self.stable:
+            self.pending_at = None  # 抖动在窗口内恢复，不上报
+            return actions
+        self.pending_at = now + (self.insert_debounce if present else self.remove_debounce)
+        return actions + self.poll(now)
+
+    @classmethod
+    def replay(cls, samples: List[tuple], present: bool = True, **kwargs) -> List[tuple]:
+        """回放 [(时间, 是否在位), ...]，返回 [(生效时间, 动作), ...]"""
+        machine = cls(present, **kwargs)
+        out = []
+        for now, sample in samples:
+            deadline = machine.next_deadline()
+            if deadline is not None and deadline <= now:
+                out.extend((deadline, action) for action in machine.poll(deadline))
+            out.extend((now, action) for action in machine.observe(sample, now))
+        deadline = machine.next_deadline()
+        if deadline is not None:
+            out.extend((deadline, action) for action in machine.poll(deadline))
+        return out
+
+
+class USBMonitor:
+    """USB 设备监控器
+
+    事件处理与 reconfigure() 共用一把锁：修改配置时在运行中的订阅上原子替换匹配规则，
+    期间到达的事件留在后端队列里，替换完成后按新规则处理，不会丢失。
+    已到达的事件按批处理（process_batch），每批最多 BATCH_LIMIT 个。
+    """
+    BATCH_LIMIT = 512
+    REOPEN_DELAY = 2.0
+
+    def __init__(self, config_manager: ConfigManager, backend: Optional[DeviceEventBackend] = None):
+        self.config_manager = config_manager
+        self.backend = backend or create_backend(config_manager.config.backend)
+        self.policy = KeyPolicy.from_config(config_manager.config)
+        self.present_instances: Dict[str, set] = {}  # 规则 key -> 在位实例 ID
+        self.present_count = 0
+        self.device_present = False
+        self.presence = PresenceStateMachine.from_config(config_manager.config, False)
+        self.running = False
+        self.thread: Optional[threading.Thread] = None
+        self.on_device_removed: Optional[Callable] = None
+        self.on_device_inserted: Optional[Callable] = None
+        self.on_device_flapping: Optional[Callable] = None
+        self.clock: Callable[[], float] = time.monotonic  # 回放时替换为追踪文件中的时间
+        self.trace: Optional[TraceWriter] = None
+        self._lock = threading.RLock()
+
+    def _query_instances(self, policy: KeyPolicy) -> Dict[str, set]:
+        present: Dict[str, set] = {}
+        for rule in policy.index.values():
+            try:
+                instances = self.backend.find_instances(rule.vid, rule.pid)
+            except Exception as e:
+                print(f"设备检测失败: {e}")
+                instances = []
+            present[rule.key] = set(instances)
+        return present
+
+    def check_device_presence(self) -> bool:
+        """按当前策略全量检查各密钥是否在位，并重建在位实例表"""
+        with self._lock:
+            self.present_instances = self._query_instances(self.policy)
+            self.present_count = sum(1 for instances in self.present_instances.values() if instances)
+            return self.policy.satisfied(self.present_count)
+
+    def present_device_ids(self) -> List[str]:
+        return sorted(device_id for instances in self.present_instances.values() for device_id in instances)
+
+    def _record(self, event: DeviceEvent):
+        METRICS.device_events[event.action].inc()
+        if self.trace:
+            self.trace.event(event)
+        if self.backend.covers_all_devices:
+            USBScanner.inventory.apply(event.action, event.to_device())
+
+    def _apply(self, event: DeviceEvent) -> bool:
+        """把事件计入在位实例表（调用方持锁），与密钥无关时返回 False"""
+        rule = self.policy.match(event.vid_pid)
+        if rule is None:
+            return False
+        instances = self.present_instances.setdefault(rule.key, set())
+        was_present = bool(instances)
+        if event.action == "add":
+            instances.add(event.device_id)
+        else:
+            instances.discard(event.device_id)
+        if bool(instances) != was_present:
+            self.present_count += 1 if instances else -1
+            print(f"密钥{'插入' if instances else '拔出'}: {rule.label}，在位 {self.present_count}/{len(self.policy.index)}")
+        return True
+
+    def _handle_event(self, event: DeviceEvent):
+        self._record(event)
+        with self._lock:
+            if self._apply(event):
+                self._update_presence(event.timestamp)
+
+    def process(self, event: DeviceEvent):
+        """处理一个后端事件（监控线程或核心事件循环调用）"""
+        self._handle_event(event)
+        if self.clock is time.monotonic:  # 回放时事件时间是虚拟的
+            METRICS.event_dispatch.observe(time.monotonic() - event.timestamp)
+
+    def process_batch(self, events: List[DeviceEvent]):
+        """处理一批事件：按设备实例合并为净变化，整批只交给状态机判定一次
+
+        扩展坞重连、集线器复位时一秒内有几十个事件，其中与密钥相关的只有少数；同一实例在批内的
+        插拔互相抵消，只按最后一个事件计入。批内的瞬时拔插因此不计入抖动检测。
+        """
+        if len(events) == 1:
+            self.process(events[0])
+            return
+        METRICS.event_batches.inc()
+        for event in events:
+            self._record(event)
+        net: Dict[str, DeviceEvent] = {}
+        for event in events:
+            net.pop(event.device_id, None)
+            net[event.device_id] = event  # 保持按最后一次出现排序
+        METRICS.coalesced_events.inc(len(events) - len(net))
+        with self._lock:
+            matched = [event for event in net.values() if self._apply(event)]
+            if matched:
+                self._update_presence(max(event.timestamp for event in matched))
+        if self.clock is time.monotonic:
+            METRICS.event_dispatch.observe(time.monotonic() - events[0].timestamp)
+
+    def poll_due(self):
+        """执行已到期的去抖判定"""
+        with self._lock:
+            now, due = self.clock(), self.presence.next_deadline()
+            # 去抖到期的判定以到期时刻记录，不受线程唤醒的早晚影响
+            self._dispatch(self.presence.poll(now), now if due is None else min(due, now))
+
+    def resync(self):
+        """事件源重建后全量核对在位状态"""
+        with self._lock:
+            self.check_device_presence()
+            if self.trace:
+                self.trace.snapshot(self.present_device_ids(), self.clock())
+            self._update_presence()
+
+    def _update_presence(self, now: Optional[float] = None):
+        now = self.clock() if now is None else now
+        self._dispatch(self.presence.observe(self.policy.satisfied(self.present_count), now), now)
+
+    def _dispatch(self, actions: List[str], now: float):
+        for action in actions:
+            METRICS.decisions[action].inc()
+            if self.trace:
+                self.trace.decision(action, now, self.present_count)
+            if action == "removed":
+                print("检测到设备拔出！")
+                self.device_present = False
+                if self.on_device_removed:
+                    self.on_device_removed()
+            elif action == "inserted":
+                print("检测到设备插入！")
+                self.device_present = True
+                if self.on_device_inserted:
+                    self.on_device_inserted()
+            elif action == "flapping":
+                print("密钥频繁插拔，立即锁屏！")
+                self.device_present = False
+                if self.on_device_flapping:
+                    self.on_device_flapping()
+                elif self.on_device_removed:
+                    self.on_device_removed()
+
+    def _monitor_loop(self):
+        try:
+            self.backend.open(self.config_manager.config)
+        except Exception as e:
+            print(f"监听启动失败 ({self.backend.name}): {e}")
+            self.backend.close()
+            self.running = False
+            return
+        try:
+            while self.running:
+                deadline = self.presence.next_deadline()
+                timeout = None if deadline is None else max(0.0, deadline - self.clock())
+                batch: List[DeviceEvent] = []
+                try:
+                    event = self.backend.wait(timeout)
+                    while event is not None:  # 一并取出已到达的事件
+                        batch.append(event)
+                        if len(batch) >= self.BATCH_LIMIT:
+                            break
+                        event = self.backend.wait(0)
+                except Exception as e:
+                    METRICS.backend_errors.inc()
+                    print(f"监听错误: {e}")
+                    if batch and self.running:
+                        self.process_batch(batch)  # 出错前已取到的事件照常处理，其余由重建后的全量核对补齐
+                    self._reopen_backend()
+                    continue
+                if not self.running:
+                    break
+                if batch:
+                    self.process_batch(batch)
+                self.poll_due()
+        finally:
+            self.backend.close()
+
+    def _reopen_backend(self):
+        """事件源出错（如 WMI 服务重启）后重建订阅，并重新核对在位状态"""
+        while self.running:
+            self.backend.close()
+            time.sleep(self.REOPEN_DELAY)
+            try:
+                self.backend.open(self.config_manager.config)
+            except Exception as e:
+                print(f"重建监听失败: {e}")
+                continue
+            self.resync()
+            return
+
+    def start(self):
+        if self.running:
+            return
+        self.prepare()
+        self.running = True
+        self.thread = threading.Thread(target=self._monitor_loop, daemon=True)
+        self.thread.start()
+
+    def prepare(self):
+        """按当前配置核对初始在位状态、建立状态机并打开追踪，不启动监听"""
+        self.policy = KeyPolicy.from_config(self.config_manager.config)
+        self.backend.configure(self.config_manager.config)
+        self.device_present = self.check_device_presence()
+        self.presence = PresenceStateMachine.from_config(self.config_manager.config, self.device_present)
+        print(f"初始设备状态: {'已连接' if self.device_present else '未连接'}，策略 {self.policy.describe()}")
+        config = self.config_manager.config
+        if self.trace is None and config.trace_file:
+            path = os.path.join(os.path.dirname(os.path.abspath(self.config_manager.config_path)), config.trace_file)
+            try:
+                self.trace = TraceWriter.open(path)
+            except OSError as e:
+                print(f"无法打开追踪文件 {path}: {e}")
+        if self.trace:
+            now = self.clock()
+            self.trace.config(config, now)
+            self.trace.snapshot(self.present_device_ids(), now)
+        USBScanner.inventory.tracking = self.backend.covers_all_devices
+
+    def stop(self):
+        self.running = False
+        self.backend.wake()
+        if self.thread:
+            self.thread.join(timeout=2)
+            self.thread = None
+        self.release()
+
+    def release(self):
+        # 停止期间的插拔事件无法跟踪，清单需要重新全量同步
+        USBScanner.inventory.tracking = False
+        USBScanner.inventory.invalidate()
+        if self.trace and self.trace.path:
+            self.trace.close()
+            self.trace = None
+
+    def reconfigure(self):
+        """就地应用新配置（密钥、策略、去抖参数）
+
+        不停止监听：在锁内重新核对新规则下的在位实例并替换策略，再把新的在位结论交给状态机。
+        新配置若未满足（如改成了未插入的密钥）会按拔出处理，而不是像重启那样静默接受。
+        倒计时时长由调用方在下次倒计时读取；事件后端的切换仍需重启程序。
+        """
+        if not self.running:
+            self.start()
+            return
+        config = self.config_manager.config
+        policy = KeyPolicy.from_config(config)
+        self.backend.configure(config)
+        with self._lock:
+            self.present_instances = self._query_instances(policy)
+            self.present_count = sum(1 for instances in self.present_instances.values() if instances)
+            self.policy = policy
+            self.presence.configure(config)
+            if self.trace:
+                now = self.clock()
+                self.trace.config(config, now)
+                self.trace.snapshot(self.present_device_ids(), now)
+            self._update_presence()
+        print(f"已应用新配置，策略 {policy.describe()}，在位 {self.present_count}/{len(policy.index)}")
+
+
+# ==================== 锁屏 ====================
+
+class LockBackend:
+    """锁屏后端：lock() 执行一次锁屏，失败时抛出异常，由流水线改用下一个后端"""
+    name = "base"
+
+    def lock(self) -> None:
+        raise NotImplementedError
+
+
+class WindowsLockBackend(LockBackend):
+    name = "windows"
+
+    def lock(self) -> None:
+        # 使用 ctypes 直接调用 Windows API（更可靠）
+        if not ctypes.windll.user32.LockWorkStation():
+            raise ctypes.WinError()
+
+
+class Rundll32LockBackend(LockBackend):
+    name = "rundll32"
+
+    def lock(self) -> None:
+        subprocess.run("rundll32.exe user32.dll,LockWorkStation", shell=True, check=True, timeout=5)
+
+
+class LoginctlLockBackend(LockBackend):
+    """systemd-logind：锁定当前会话"""
+    name = "loginctl"
+
+    def lock(self) -> None:
+        subprocess.run(["loginctl", "lock-session"], check=True, timeout=5, capture_output=True)
+
+
+class ScreensaverLockBackend(LockBackend):
+    """没有 logind 会话时（如部分 X11 桌面）通过屏幕保护程序锁屏"""
+    name = "xdg-screensaver"
+
+    def lock(self) -> None:
+        subprocess.run(["xdg-screensaver", "lock"], check=True, timeout=5, capture_output=True)
+
+
+LOCK_BACKENDS = {cls.name: cls for cls in (WindowsLockBackend, Rundll32LockBackend, LoginctlLockBackend, ScreensaverLockBackend)}
+DEFAULT_LOCK_BACKENDS = ("windows", "rundll32") if IS_WINDOWS else ("loginctl", "xdg-screensaver")
+
+
+class LockHook:
+    """锁屏前动作：run(timeout) 在独立线程上执行，应在 timeout 秒内返回，失败时抛出异常"""
+    name = "hook"
+
+    def run(self, timeout: float) -> None:
+        raise NotImplementedError
+
+
+class PauseMediaHook(LockHook):
+    """暂停正在播放的媒体"""
+    name = "pause-media"
+    WM_APPCOMMAND = 0x0319
+    APPCOMMAND_MEDIA_PAUSE = 47
+
+    def run(self, timeout: float) -> None:
+        if not IS_WINDOWS:
+            subprocess.run(["playerctl", "--all-players", "pause"], check=True, timeout=timeout, capture_output=True)
+            return
+        # 交给任务栏窗口的默认处理，由系统转给当前的媒体会话；PAUSE 不会把已暂停的媒体切回播放
+        user32 = ctypes.windll.user32
+        hwnd = user32.FindWindowW("Shell_TrayWnd", None)
+        user32.SendMessageTimeoutW(hwnd, self.WM_APPCOMMAND, hwnd, self.APPCOMMAND_MEDIA_PAUSE << 16,
+                                   0x0002, int(timeout * 1000), None)  # SMTO_ABORTIFHUNG
+
+
+class DisplaysOffHook(LockHook):
+    """关闭显示器（全部显示器；系统不提供只关副屏的接口）"""
+    name = "displays-off"
+
+    def run(self, timeout: float) -> None:
+        if not IS_WINDOWS:
+            subprocess.run(["xset", "dpms", "force", "off"], check=True, timeout=timeout, capture_output=True)
+            return
+        # HWND_BROADCAST / WM_SYSCOMMAND / SC_MONITORPOWER，2 为关闭；Post 不等待各窗口处理
+        ctypes.windll.user32.PostMessageW(0xFFFF, 0x0112, 0xF170, 2)
+
+
+class NotifyHook(LockHook):
+    """发送桌面通知；GUI 进程把托盘通知登记为 sender，守护进程在 Linux 上使用 notify-send"""
+    name = "notify"
+    sender: Optional[Callable[[str, str], None]] = None
+    MESSAGE = "USB 密钥已拔出，正在锁屏"
+
+    def run(self, timeout: float) -> None:
+        if NotifyHook.sender:
+            NotifyHook.sender(self.MESSAGE, "USB AutoLocker")
+        elif not IS_WINDOWS:
+            subprocess.run(["notify-send", "USB AutoLocker", self.MESSAGE], check=True, timeout=timeout, capture_output=True)
+        else:
+            raise RuntimeError("没有可用的通知方式（守护进程模式下没有托盘）")
+
+
+class CommandHook(LockHook):
+    """运行配置中的命令，超时后结束进程"""
+
+    def __init__(self, command: List[str], name: str = ""):
+        self.command = [str(arg) for arg in command]
+        self.name = name or f"command:{os.path.basename(self.command[0])}"
+
+    def run(self, timeout: float) -> None:
+        subprocess.run(self.command, check=True, timeout=timeout, capture_output=True)
+
+
+LOCK_HOOKS = {cls.name: cls for cls in (PauseMediaHook, DisplaysOffHook, NotifyHook)}
+
+
+def create_lock_hook(spec) -> LockHook:
+    """按配置项创建钩子：内置钩子名称，或 {"command": [...], "name": ...}"""
+    if isinstance(spec, dict):
+        return CommandHook(spec["command"], spec.get("name", ""))
+    if spec not in LOCK_HOOKS:
+        raise ValueError(f"未知的锁屏前动作: {spec}")
+    return LOCK_HOOKS[spec]()
+
+
+class LockPipeline:
+    """锁屏动作流水线
+
+    先并发执行锁屏前钩子，最多等待 hook_deadline 秒，之后不论钩子是否完成都立即锁屏；超时的钩子
+    留在后台线程里跑完（线程无法强制结束，命令钩子由 timeout 结束进程），结果不再影响本次锁屏。
+    锁屏后端按顺序尝试，第一个成功的为准。可直接作为 lock_action 调用。
+    """
+
+    def __init__(self, backends: List[LockBackend], hooks: Optional[List[LockHook]] = None, hook_deadline: float = 0.2):
+        self.backends = backends
+        self.hooks = hooks or []
+        self.hook_deadline = hook_deadline
+        self.history: "deque[dict]" = deque(maxlen=100)
+        self._lock = threading.Lock()
+        self._finished = threading.Condition(self._lock)
+
+    @classmethod
+    def from_config(cls, config: AppConfig) -> "LockPipeline":
+        pipeline = cls([])
+        pipeline.configure(config)
+        return pipeline
+
+    def configure(self, config: AppConfig):
+        """按配置重建后端与钩子（配置热加载时调用）"""
+        self.backends = [LOCK_BACKENDS[name]() for name in config.lock_backends or DEFAULT_LOCK_BACKENDS]
+        self.hooks = [create_lock_hook(spec) for spec in config.lock_hooks]
+        self.hook_deadline = config.lock_hook_deadline_ms / 1000.0
+
+    def __call__(self):
+        self.lock()
+
+    def lock(self) -> dict:
+        print("执行锁屏...")
+        METRICS.locks.inc()
+        start = time.perf_counter()
+        hooks = self._run_hooks(start)
+        lock_start = time.perf_counter()
+        report = {"hooks": hooks, "hook_wait_ms": (lock_start - start) * 1000, "backend": None}
+        for backend in self.backends:
+            try:
+                backend.lock()
+            except Exception as e:
+                METRICS.lock_failures.inc()
+                print(f"锁屏失败（{backend.name}）: {e}")
+                continue
+            report["backend"] = backend.name
+            break
+        else:
+            print("所有锁屏后端都失败了")
+        METRICS.lock_call.observe(time.perf_counter() - lock_start)
+        report["lock_ms"] = (time.perf_counter() - lock_start) * 1000
+        self.history.append(report)
+        return report
+
+    def _run_hooks(self, start: float) -> List[dict]:
+        records = []
+        for hook in self.hooks:
+            record = {"name": hook.name, "result": "pending", "ms": None}
+            records.append(record)
+            threading.Thread(target=self._run_hook, args=(hook, record, start), daemon=True, name=f"lock-hook-{hook.name}").start()
+        deadline = start + self.hook_deadline
+        with self._lock:
+            while any(r["result"] == "pending" for r in records):
+                left = deadline - time.perf_counter()
+                if left <= 0:
+                    break
+                self._finished.wait(left)
+            for record in records:
+                if record["result"] == "pending":
+                    record["result"] = "timeout"
+                    METRICS.hook(record["name"])[1]["timeout"].inc()
+                    print(f"锁屏前动作 {record['name']} 超过 {self.hook_deadline * 1000:.0f} ms，不再等待")
+        return records
+
+    def _run_hook(self, hook: LockHook, record: dict, start: float):
+        try:
+            hook.run(max(0.05, self.hook_deadline))
+            result = "ok"
+        except Exception as e:
+            result = "error"
+            print(f"锁屏前动作 {hook.name} 失败: {e}")
+        elapsed = time.perf_counter() - start
+        duration, results = METRICS.hook(hook.name)
+        duration.observe(elapsed)  # 超时的钩子也按实际完成时间记录
+        with self._lock:
+            if record["result"] == "pending":  # 已判为超时的不再改写
+                record["result"], record["ms"] = result, elapsed * 1000
+                results[result].inc()
+            self._finished.notify_all()
+
+    def stats(self) -> Dict[str, dict]:
+        """最近 history 中每个钩子的次数、超时/失败次数和耗时"""
+        stats: Dict[str, dict] = {}
+        for report in list(self.history):
+            for record in report["hooks"]:
+                s = stats.setdefault(record["name"], {"runs": 0, "timeouts": 0, "errors": 0, "max_ms": 0.0, "total_ms": 0.0})
+                s["runs"] += 1
+                s["timeouts"] += record["result"] == "timeout"
+                s["errors"] += record["result"] == "error"
+                if record["ms"] is not None:
+                    s["max_ms"] = max(s["max_ms"], record["ms"])
+                    s["total_ms"] += record["ms"]
+        for s in stats.values():
+            finished = s["runs"] - s["timeouts"]
+            s["mean_ms"] = s.pop("total_ms") / finished if finished else None
+        return stats
+
+
+# ==================== 守护进程 ====================
+
+CONTROL_COMMANDS = ("status", "enable", "disable", "reload", "cancel", "watch")
+
+
+def control_token_path(config_path: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(config_path)), "control.token")
+
+
+class LockDaemon:
+    """无界面守护进程：设备监控 + 锁屏，经 127.0.0.1 控制套接字管理，不加载 GUI 模块"""
+
+    def __init__(self, config_manager: ConfigManager, usb_monitor: Optional[USBMonitor] = None,
+                 lock_action: Optional[Callable[[], None]] = None, timer_factory: Callable[..., threading.Timer] = threading.Timer):
+        self.config_manager = config_manager
+        self.usb_monitor = usb_monitor or USBMonitor(config_manager)
+        self.lock_action = lock_action or LockPipeline.from_config(config_manager.config)
+        self.timer_factory = timer_factory
+        self.is_enabled = config_manager.config.enabled
+        self.token = ""
+        self.started_at = time.time()
+        self.port = 0
+        self._lock = threading.Lock()
+        self._countdown: Optional[threading.Timer] = None
+        self._countdown_deadline = 0.0
+        self._countdown_seq = 0
+        self.lock_history: "deque[dict]" = deque(maxlen=100)  # 倒计时锁屏的计划与实际完成时刻
+        self._watchers: List[socket.socket] = []
+        self._outbox: "queue.Queue[Optional[dict]]" = queue.Queue()
+        self._server: Optional[socket.socket] = None
+        self._stopped = threading.Event()
+        self.forwarder: Optional[EventForwarder] = None
+        self.audit: Optional[AuditLog] = None
+        self.armed = False  # 事件源已接入；为 False 时拔出不会被发现
+
+    # ---------- 设备事件与倒计时 ----------
+
+    def _on_device_removed(self):
+        self._broadcast({"event": "removed"})
+        if not self.is_enabled:
+            print("自动锁屏已禁用，跳过")
+            return
+        seconds = self.config_manager.config.countdown_seconds
+        with self._lock:
+            if self._countdown:
+                print("已在倒计时中，跳过")
+                return
+            self._countdown_seq += 1
+            self._countdown_deadline = time.monotonic() + seconds
+            self._countdown = self.timer_factory(seconds, self._on_countdown_complete, args=(self._countdown_seq,))
+            self._countdown.daemon = True
+            self._countdown.start()
+        METRICS.countdowns.inc()
+        print(f"触发锁屏倒计时 ({seconds}秒)...")
+        self._broadcast({"event": "countdown", "seconds": seconds})
+
+    def _on_device_inserted(self):
+        self._broadcast({"event": "inserted"})
+        if self.config_manager.config.unlock_on_reconnect and self.cancel_countdown("reinsert"):
+            print("设备重新插入，取消锁屏倒计时")
+
+    def _on_device_flapping(self):
+        """密钥频繁插拔：跳过倒计时立即锁屏"""
+        if not self.is_enabled:
+            print("自动锁屏已禁用，跳过")
+            return
+        with self._lock:
+            timer, self._countdown = self._countdown, None
+        if timer:
+            timer.cancel()
+        self._broadcast({"event": "flapping"})
+        self._lock_screen()
+
+    def _on_countdown_complete(self, seq: int):
+        with self._lock:
+            if self._countdown is None or seq != self._countdown_seq:
+                return  # 已被取消或已被新的倒计时取代
+            self._countdown = None
+            scheduled = self._countdown_deadline
+        self._lock_screen({"event": "locked"}, scheduled=scheduled)
+
+    def _lock_screen(self, event: Optional[dict] = None, scheduled: Optional[float] = None):
+        """执行锁屏流水线，event 为锁屏时要广播的事件，scheduled 为倒计时截止时刻"""
+        if event:
+            self._broadcast(event)
+        try:
+            self.lock_action()
+        finally:
+            self._record_lock(scheduled)
+
+    def _record_lock(self, scheduled: Optional[float]):
+        """锁屏流水线结束后记录计划与实际时刻（墙上时间），偏差计入 lock_drift"""
+        if scheduled is None or self.usb_monitor.clock is not time.monotonic:  # 回放时定时器走虚拟时间
+            return
+        actual = time.monotonic()
+        METRICS.lock_drift.observe(max(0.0, actual - scheduled))
+        offset = time.time() - actual
+        record = {"scheduled": scheduled + offset, "actual": actual + offset, "drift_ms": (actual - scheduled) * 1000}
+        self.lock_history.append(record)
+        print(f"锁屏时间偏差 {record['drift_ms']:+.1f} ms")
+
+    def cancel_countdown(self, reason: str = "remote") -> bool:
+        with self._lock:
+            timer, self._countdown = self._countdown, None
+        if not timer:
+            return False
+        timer.cancel()
+        METRICS.cancels[reason].inc()
+        self._broadcast({"event": "cancelled", "reason": reason})
+        return True
+
+    def set_enabled(self, enabled: bool):
+        self.is_enabled = enabled
+        self.config_manager.update(enabled=enabled)
+        if not enabled:
+            self.cancel_countdown("disabled")
+        print(f"自动锁屏{'已启用' if enabled else '已禁用'}")
+
+    def reload(self):
+        """重新读取配置文件（未变化或不合法时沿用当前配置）并就地应用"""
+        self.config_manager.check_reload(notify=False)
+        self._on_config_reloaded(self.config_manager.config)
+
+    def _on_config_reloaded(self, config: AppConfig):
+        self.is_enabled = config.enabled
+        if not self.is_enabled:
+            self.cancel_countdown("disabled")
+        if isinstance(self.lock_action, LockPipeline):
+            self.lock_action.configure(config)
+        self.usb_monitor.reconfigure()
+
+    def status(self) -> dict:
+        with self._lock:
+            remaining = max(0.0, self._countdown_deadline - time.monotonic()) if self._countdown else None
+        status = {
+            "enabled": self.is_enabled,
+            "armed": self.armed,
+            "device_present": self.usb_monitor.device_present,
+            "policy": self.usb_monitor.policy.describe(),
+            "countdown_remaining": remaining,
+            "pid": os.getpid(),
+            "uptime": time.time() - self.started_at,
+            "watchers": len(self._watchers),
+            "lock_history": list(self.lock_history),
+        }
+        if isinstance(self.lock_action, LockPipeline):
+            status["lock_hooks"] = self.lock_action.stats()
+        try:
+            import resource
+            status["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        except ImportError:
+            pass  # Windows 没有 resource 模块
+        return status
+
+    def handle_command(self, cmd: str) -> dict:
+        if cmd == "status":
+            return dict(ok=True, **self.status())
+        if cmd in ("enable", "disable"):
+            self.set_enabled(cmd == "enable")
+            return {"ok": True, "enabled": self.is_enabled}
+        if cmd == "reload":
+            self.reload()
+            return {"ok": True}
+        if cmd == "cancel":
+            return {"ok": True, "cancelled": self.cancel_countdown()}
+        return {"ok": False, "error": f"未知命令: {cmd}"}
+
+    # ---------- 控制套接字 ----------
+
+    def _write_token(self):
+        self.token = secrets.token_hex(16)
+        path = control_token_path(self.config_manager.config_path)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(self.token)
+
+    def _serve(self):
+        while not self._stopped.is_set():
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+
+    def _handle_connection(self, conn: socket.socket):
+        def reply(payload: dict):
+            conn.sendall((json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8"))
+
+        with conn:
+            conn.settimeout(5)
+            try:
+                for line in conn.makefile("r", encoding="utf-8"):
+                    try:
+                        request = json.loads(line)
+                    except json.JSONDecodeError:
+                        reply({"ok": False, "error": "请求不是合法的 JSON"})
+                        continue
+                    if not hmac.compare_digest(str(request.get("token", "")), self.token):
+                        reply({"ok": False, "error": "令牌无效"})
+                        return
+                    if request.get("cmd") == "watch":
+                        reply({"ok": True})
+                        self._watch(conn)
+                        return
+                    reply(self.handle_command(request.get("cmd", "")))
+            except (OSError, ValueError):
+                pass  # 客户端断开或超时
+
+    def _watch(self, conn: socket.socket):
+        """登记事件订阅，连接保持到客户端断开"""
+        conn.settimeout(1)  # 同时作为推送线程 sendall 的超时
+        with self._lock:
+            self._watchers.append(conn)
+        try:
+            while not self._stopped.is_set():
+                try:
+                    if not conn.recv(1024):
+                        break
+                except socket.timeout:
+                    continue
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                if conn in self._watchers:
+                    self._watchers.remove(conn)
+
+    def _broadcast(self, event: dict):
+        """事件先入队，由推送线程发送，慢客户端不会拖住监控线程；未打开控制套接字时没有推送线程，不入队"""
+        if self._server:
+            self._outbox.put(event)
+        if self.forwarder:
+            self.forwarder.emit(**event)
+        if self.audit:
+            self.audit.emit(**event)
+
+    def _push_loop(self):
+        while True:
+            event = self._outbox.get()
+            if event is None:
+                return
+            data = (json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8")
+            with self._lock:
+                watchers = list(self._watchers)
+            for conn in watchers:
+                try:
+                    conn.sendall(data)
+                except OSError:
+                    with self._lock:
+                        if conn in self._watchers:
+                            self._watchers.remove(conn)
+
+    # ---------- 生命周期 ----------
+
+    def start(self):
+        self._write_token()
+        self._server = socket.create_server(("127.0.0.1", self.config_manager.config.control_port))
+        self.port = self._server.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+        threading.Thread(target=self._push_loop, daemon=True).start()
+        METRICS.start_export(self.config_manager)
+        self.forwarder = EventForwarder.from_config(self.config_manager)
+        self.audit = AuditLog.from_config(self.config_manager)
+        self.config_manager.watch(self._on_config_reloaded)
+        self.arm()
+        print(f"守护进程已启动，控制端口 127.0.0.1:{self.port}")
+
+    def arm(self):
+        """接上监控回调并开始监控，不打开控制套接字"""
+        self.usb_monitor.on_device_removed = self._on_device_removed
+        self.usb_monitor.on_device_inserted = self._on_device_inserted
+        self.usb_monitor.on_device_flapping = self._on_device_flapping
+        self.usb_monitor.start()
+        self.armed = True
+
+    def stop(self):
+        self._stopped.set()
+        self.cancel_countdown("shutdown")
+        self.config_manager.flush()
+        self.usb_monitor.stop()
+        if self._server:
+            self._server.close()
+        self._outbox.put(None)
+        if self.forwarder:
+            self.forwarder.close()
+        if self.audit:
+            self.audit.close()
+
+    def run(self):
+        self.start()
+        try:
+            while not self._stopped.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+class DaemonClient:
+    """守护进程控制客户端"""
+
+    def __init__(self, config_manager: ConfigManager):
+        self.port = config_manager.config.control_port
+        self.token_path = control_token_path(config_manager.config_path)
+        self._watch_sock: Optional[socket.socket] = None
+
+    def _request(self, cmd: str) -> bytes:
+        with open(self.token_path, 'r', encoding='utf-8') as f:
+            token = f.read().strip()
+        return (json.dumps({"cmd": cmd, "token": token}) + "\n").encode("utf-8")
+
+    def send(self, cmd: str, timeout: float = 2.0) -> dict:
+        with socket.create_connection(("127.0.0.1", self.port), timeout=timeout) as sock:
+            sock.sendall(self._request(cmd))
+            return json.loads(sock.makefile("r", encoding="utf-8").readline())
+
+    def is_running(self) -> bool:
+        if not os.path.exists(self.token_path):
+            return False
+        try:
+            return bool(self.send("status", timeout=0.5).get("ok"))
+        except (OSError, ValueError):
+            return False
+
+    def watch(self):
+        """订阅守护进程事件，逐个产出事件字典；连接断开或 close_watch 后结束"""
+        with socket.create_connection(("127.0.0.1", self.port), timeout=2.0) as sock:
+            sock.sendall(self._request("watch"))
+            sock.settimeout(None)
+            self._watch_sock = sock
+            reader = sock.makefile("r", encoding="utf-8")
+            if not json.loads(reader.readline()).get("ok"):
+                return
+            for line in reader:
+                yield json.loads(line)
+
+    def close_watch(self):
+        sock, self._watch_sock = self._watch_sock, None
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class EventStreamMonitor:
+    """与 USBMonitor 接口相同的监控器，事件来自锁屏核心（守护进程或同进程的 AsyncCore）广播的事件流
+
+    receive() 在产生事件的线程上调用；设置了 deliver 时事件交给它转到界面线程（见 TkDispatcher），
+    再由界面线程调用 handle() 分派回调，否则就地分派。
+    """
+
+    def __init__(self):
+        self.device_present = True
+        self.running = False
+        self.deliver: Optional[Callable[[dict], None]] = None
+        self.on_device_removed: Optional[Callable] = None
+        self.on_device_inserted: Optional[Callable] = None
+        self.on_device_flapping: Optional[Callable] = None
+        self.on_countdown_cancelled: Optional[Callable] = None
+        self.on_config_reloaded: Optional[Callable] = None
+        self.on_resync: Optional[Callable] = None
+
+    def receive(self, event: dict):
+        if self.deliver:
+            self.deliver(event)
+        else:
+            self.handle(event)
+
+    def handle(self, event: dict):
+        self._dispatch(event.get("event"))
+
+    def _dispatch(self, event: Optional[str]):
+        if event == "removed":
+            self.device_present = False
+        elif event == "countdown" and self.on_device_removed:
+            self.on_device_removed()
+        elif event == "inserted":
+            self.device_present = True
+            if self.on_device_inserted:
+                self.on_device_inserted()
+        elif event == "flapping":
+            self.device_present = False
+            if self.on_device_flapping:
+                self.on_device_flapping()
+        elif event == "cancelled" and self.on_countdown_cancelled:
+            self.on_countdown_cancelled()
+        elif event == "reloaded" and self.on_config_reloaded:
+            self.on_config_reloaded()
+        elif event == "resync" and self.on_resync:
+            self.on_resync()
+
+
+class DaemonMonitor(EventStreamMonitor):
+    """GUI 客户端模式下的监控器，事件来自守护进程"""
+
+    def __init__(self, client: DaemonClient):
+        super().__init__()
+        self.client = client
+        self.thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def _watch_loop(self):
+        while not self._stop.is_set():
+            try:
+                for event in self.client.watch():
+                    self.receive(event)
+            except (OSError, ValueError) as e:
+                print(f"守护进程连接断开: {e}")
+            self._stop.wait(2)
+
+    def start(self):
+        if self.running:
+            return
+        try:
+            self.device_present = self.client.send("status").get("device_present", True)
+        except (OSError, ValueError) as e:
+            print(f"守护进程通信失败: {e}")
+        self.running = True
+        self._stop.clear()
+        self.thread = threading.Thread(target=self._watch_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self._stop.set()
+        self.client.close_watch()
+        if self.thread:
+            self.thread.join(timeout=2)
+            self.thread = None
+
+    def reconfigure(self):
+        """配置已由设置窗口写入文件，通知守护进程重新加载"""
+        try:
+            self.client.send("reload")
+        except (OSError, ValueError) as e:
+            print(f"守护进程通信失败: {e}")
+
+
+# ==================== 事件追踪 ====================
+
+@dataclass
+class TraceRecord:
+    """追踪文件中的一条记录"""
+    kind: str  # config / snapshot / event / decision
+    timestamp: float  # 单调时钟
+    data: dict
+
+
+class TraceWriter:
+    """紧凑的只追加二进制事件追踪
+
+    文件以 TRACE_MAGIC 开头，之后每条记录为 <类型 u8, 单调时间 f64, 负载长度 u16> + 负载。
+    设备实例 ID 首次出现时写入字符串表，之后的事件只引用 u16 编号，一条事件约 14 字节。
+    每条记录写完即 flush，进程崩溃时已记录的内容不会丢失。
+    """
+    MAGIC = b"ALTRACE1"
+    HEADER = struct.Struct("<BdH")
+    EVENT = struct.Struct("<BH")  # 动作编号, 字符串编号
+    DECISION = struct.Struct("<BH")  # 判定编号, 在位密钥数
+    STRING = struct.Struct("<H")
+    KINDS = {"config": 1, "snapshot": 2, "string": 3, "event": 4, "decision": 5}
+    ACTIONS = ("add", "remove")
+    DECISIONS = ("removed", "inserted", "flapping")
+
+    def __init__(self, fp, path: Optional[str] = None):
+        self.fp = fp
+        self.path = path
+        self.strings: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        if fp.tell() == 0:
+            fp.write(self.MAGIC)
+
+    @classmethod
+    def open(cls, path: str) -> "TraceWriter":
+        return cls(open(path, "ab"), path)
+
+    def _write(self, kind: str, timestamp: float, payload: bytes):
+        self.fp.write(self.HEADER.pack(self.KINDS[kind], timestamp, len(payload)) + payload)
+
+    def _string_id(self, text: str, timestamp: float) -> int:
+        sid = self.strings.get(text)
+        if sid is None:
+            sid = self.strings[text] = len(self.strings)
+            self._write("string", timestamp, self.STRING.pack(sid) + text.encode("utf-8"))
+        return sid
+
+    def config(self, config: AppConfig, timestamp: float):
+        """每次开始监控时写入配置和墙钟时间；字符串表随之重新开始"""
+        with self._lock:
+            self.strings.clear()
+            payload = dict(asdict(config), wall_time=time.time())
+            self._write("config", timestamp, json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+            self.fp.flush()
+
+    def snapshot(self, device_ids: List[str], timestamp: float):
+        with self._lock:
+            self._write("snapshot", timestamp, json.dumps(device_ids).encode("utf-8"))
+            self.fp.flush()
+
+    def event(self, event: DeviceEvent):
+        with self._lock:
+            sid = self._string_id(event.device_id, event.timestamp)
+            self._write("event", event.timestamp, self.EVENT.pack(self.ACTIONS.index(event.action), sid))
+            self.fp.flush()
+
+    def decision(self, action: str, timestamp: float, present_count: int):
+        with self._lock:
+            self._write("decision", timestamp, self.DECISION.pack(self.DECISIONS.index(action), present_count))
+            self.fp.flush()
+
+    def close(self):
+        with self._lock:
+            self.fp.close()
+
+
+def read_trace(source) -> List[TraceRecord]:
+    """读取追踪文件（路径或二进制文件对象），末尾不完整的记录被忽略"""
+    data = source.getvalue() if isinstance(source, io.BytesIO) else open(source, "rb").read()
+    if not data.startswith(TraceWriter.MAGIC):
+        raise ValueError("不是 USB AutoLocker 追踪文件")
+    kinds = {code: name for name, code in TraceWriter.KINDS.items()}
+    records, strings = [], {}
+    offset, header = len(TraceWriter.MAGIC), TraceWriter.HEADER
+    while offset + header.size <= len(data):
+        code, timestamp, length = header.unpack_from(data, offset)
+        payload = data[offset + header.size:offset + header.size + length]
+        if len(payload) < length:
+            break
+        offset += header.size + length
+        kind = kinds.get(code)
+        if kind == "string":
+            strings[TraceWriter.STRING.unpack_from(payload)[0]] = payload[TraceWriter.STRING.size:].decode("utf-8")
+        elif kind == "config":
+            strings = {}
+            records.append(TraceRecord(kind, timestamp, json.loads(payload)))
+        elif kind == "snapshot":
+            records.append(TraceRecord(kind, timestamp, {"device_ids": json.loads(payload)}))
+        elif kind == "event":
+            action, sid = TraceWriter.EVENT.unpack(payload)
+            records.append(TraceRecord(kind, timestamp, {"action": TraceWriter.ACTIONS[action], "device_id": strings.get(sid, "")}))
+        elif kind == "decision":
+            action, count = TraceWriter.DECISION.unpack(payload)
+            records.append(TraceRecord(kind, timestamp, {"action": TraceWriter.DECISIONS[action], "present_count": count}))
+    return records
+
+
+class TraceReplayBackend(DeviceEventBackend):
+    """按追踪文件回放设备事件的后端
+
+    时间是虚拟的：clock() 返回追踪中的时间，wait 的超时和 timer() 创建的定时器都在虚拟时间轴上推进。
+    speed 为 0 时尽快回放，为 1 时按原速（同时按真实时间等待）。回放结束后 finished 被置位。
+    追踪中途的配置记录（重新配置或重新启动）先应用随后的快照，再交给 on_config。
+    """
+    name = "replay"
+
+    def __init__(self, records: List[TraceRecord], speed: float = 0.0):
+        self.speed = speed
+        self.present: Dict[str, str] = {}  # device_id -> vid_pid
+        self.pending = deque(records)
+        self.on_config: Optional[Callable[[dict], None]] = None
+        self.now = self.pending[0].timestamp if self.pending else 0.0
+        # 开始监控时的配置和快照决定初始配置与在位状态
+        while self.pending and self.pending[0].kind in ("config", "snapshot", "decision") and self.pending[0].timestamp <= self.now:
+            record = self.pending.popleft()
+            if record.kind == "snapshot":
+                self._apply_snapshot(record)
+        self.timers: list = []  # (到期时间, 序号, 定时器)
+        self._seq = 0
+        self.finished = threading.Event()
+        self._woken = threading.Event()
+
+    def _apply_snapshot(self, record: TraceRecord):
+        self.present = {}
+        for device_id in record.data["device_ids"]:
+            parsed = USBScanner.parse_vid_pid(device_id)
+            if parsed:
+                self.present[device_id] = f"{parsed[0]}&{parsed[1]}"
+
+    def clock(self) -> float:
+        return self.now
+
+    def timer(self, interval: float, function: Callable, args: tuple = ()) -> "_VirtualTimer":
+        return _VirtualTimer(self, interval, function, args)
+
+    def _advance(self, target: float) -> bool:
+        """把虚拟时间推进到 target；原速回放时等待相应的真实时间，被 wake 打断时返回 False"""
+        if self.speed > 0 and target > self.now:
+            if self._woken.wait((target - self.now) / self.speed):
+                return False
+        self.now = max(self.now, target)
+        return True
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[DeviceEvent]:
+        limit = math.inf if timeout is None else self.now + timeout
+        while True:
+            if self._woken.is_set():
+                self._woken.clear()
+                return None
+            while self.timers and self.timers[0][2].cancelled:
+                heapq.heappop(self.timers)
+            next_event = self.pending[0].timestamp if self.pending else math.inf
+            next_timer = self.timers[0][0] if self.timers else math.inf
+            target = min(next_event, next_timer, limit)
+            if target == math.inf:
+                self.finished.set()
+                self._woken.wait()
+                continue
+            if not self._advance(target):
+                continue
+            if next_timer <= min(next_event, limit):
+                heapq.heappop(self.timers)[2].run()
+                continue
+            if next_event > limit:
+                return None
+            record = self.pending.popleft()
+            if record.kind == "decision":
+                continue
+            if record.kind == "snapshot":
+                self._apply_snapshot(record)
+                continue
+            if record.kind == "config":
+                if self.pending and self.pending[0].kind == "snapshot" and self.pending[0].timestamp == record.timestamp:
+                    self._apply_snapshot(self.pending.popleft())
+                if self.on_config:
+                    self.on_config(record.data)
+                continue
+            event = DeviceEvent.from_device_id(record.data["action"], record.data["device_id"])
+            if event is None:
+                continue
+            event.timestamp = record.timestamp
+            if event.action == "add":
+                self.present[event.device_id] = event.vid_pid
+            else:
+                self.present.pop(event.device_id, None)
+            return event
+
+    def wake(self) -> None:
+        self._woken.set()
+
+    def find_instances(self, vid: str, pid: str) -> List[str]:
+        key = f"{vid}&{pid}".upper()
+        return [device_id for device_id, vid_pid in list(self.present.items()) if vid_pid == key]
+
+
+class _VirtualTimer:
+    """与 threading.Timer 接口相同、在回放虚拟时间轴上到期的定时器，在监控线程内执行"""
+
+    def __init__(self, backend: TraceReplayBackend, interval: float, function: Callable, args: tuple = ()):
+        self.backend = backend
+        self.interval = interval
+        self.function = function
+        self.args = args
+        self.daemon = True
+        self.cancelled = False
+
+    def start(self):
+        self.backend._seq += 1
+        heapq.heappush(self.backend.timers, (self.backend.now + self.interval, self.backend._seq, self))
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        if not self.cancelled:
+            self.function(*self.args)
+
+
+REPLAY_POLL_SECONDS = 0.5  # 等待回放结束时检查监控线程存活的间隔
+
+
+def replay_trace(source, speed: float = 0.0, overrides: Optional[dict] = None, tolerance: float = 0.05) -> dict:
+    """把追踪回放给 USBMonitor 和守护进程的回调，锁屏动作只做记录
+
+    overrides 可覆盖追踪中记录的配置（如去抖参数），用于评估配置修改对历史流量的影响。
+    返回回放得到的判定、锁屏时刻，以及与追踪中原始判定的差异；实时运行时判定可能因线程调度
+    晚几毫秒记录，时间相差不超过 tolerance 秒视为一致。
+    """
+    records = read_trace(source)
+    configs = [r for r in records if r.kind == "config"]
+    if not configs:
+        raise ValueError("追踪中没有配置记录")
+    fields = set(AppConfig.__dataclass_fields__)
+
+    def to_config(recorded: dict) -> AppConfig:
+        data = {k: v for k, v in recorded.items() if k in fields}
+        data.update(overrides or {}, trace_file="", metrics_file="", metrics_port=0, forward_url="")
+        return AppConfig(**data)
+
+    backend = TraceReplayBackend(records, speed)
+    output = io.BytesIO()
+    locks: List[float] = []
+    with tempfile.TemporaryDirectory() as workdir:
+        config_manager = ConfigManager(os.path.join(workdir, "config.json"))
+        config_manager.config = to_config(configs[0].data)
+        monitor = USBMonitor(config_manager, backend=backend)
+        monitor.clock = backend.clock
+
+        def on_config(recorded: dict):
+            config_manager.config = to_config(recorded)
+            monitor.reconfigure()
+
+        backend.on_config = on_config
+        monitor.trace = TraceWriter(output)
+        # 只 arm 不 start：没有控制套接字，事件不入推送队列
+        daemon = LockDaemon(config_manager, usb_monitor=monitor, lock_action=lambda: locks.append(backend.now),
+                            timer_factory=backend.timer)
+        daemon.arm()
+        try:
+            while not backend.finished.wait(REPLAY_POLL_SECONDS):
+                if monitor.thread is None or not monitor.thread.is_alive():
+                    raise RuntimeError("监控线程已退出，回放中止")
+        finally:
+            monitor.stop()
+
+    def decisions(items: List[TraceRecord]) -> List[tuple]:
+        return [(round(r.timestamp, 6), r.data["action"]) for r in items if r.kind == "decision"]
+
+    replayed, recorded = decisions(read_trace(output)), decisions(records)
+    mismatches = [(i, a, b) for i, (a, b) in enumerate(zip(recorded, replayed))
+                  if a[1] != b[1] or abs(a[0] - b[0]) > tolerance]
+    if len(recorded) != len(replayed):
+        mismatches.append((min(len(recorded), len(replayed)), recorded[len(replayed):], replayed[len(recorded):]))
+    return {
+        "events": sum(1 for r in records if r.kind == "event"),
+        "decisions": replayed,
+        "locks": locks,
+        "recorded_decisions": len(recorded),
+        "mismatches": mismatches,
+    }
+
+
+# ==================== 事件转发 ====================
+
+class TCPTransport:
+    """TCP 传输：每批一行 {"batch": id, "events": [...]}，收集端回复 {"ack": id} 才算送达"""
+
+    def __init__(self, host: str, port: int, timeout: float):
+        self.address = (host, port)
+        self.timeout = timeout
+        self.sock: Optional[socket.socket] = None
+        self.reader = None
+
+    def send(self, batch_id: str, records: List[dict]):
+        try:
+            if self.sock is None:
+                self.sock = socket.create_connection(self.address, timeout=self.timeout)
+                self.reader = self.sock.makefile("rb")
+            line = json.dumps({"batch": batch_id, "events": records}, ensure_ascii=False) + "\n"
+            self.sock.sendall(line.encode("utf-8"))
+            reply = self.reader.readline()
+            if not reply:
+                raise ConnectionError("收集端关闭了连接")
+            if json.loads(reply).get("ack") != batch_id:
+                raise ValueError(f"收集端确认不匹配: {reply!r}")
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = self.reader = None
+
+
+class HTTPTransport:
+    """HTTP 传输：每批 POST 一次 NDJSON，2xx 即送达"""
+
+    def __init__(self, url: str, timeout: float):
+        from urllib.parse import urlsplit
+        self.url = urlsplit(url)
+        self.timeout = timeout
+
+    def send(self, batch_id: str, records: List[dict]):
+        import http.client  # 只有开启 HTTP 转发时才需要
+        cls = http.client.HTTPSConnection if self.url.scheme == "https" else http.client.HTTPConnection
+        conn = cls(self.url.hostname, self.url.port, timeout=self.timeout)
+        try:
+            body = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode("utf-8")
+            conn.request("POST", self.url.path or "/", body=body,
+                         headers={"Content-Type": "application/x-ndjson", "X-Batch-Id": batch_id})
+            response = conn.getresponse()
+            response.read()
+            if not 200 <= response.status < 300:
+                raise ConnectionError(f"收集端返回 HTTP {response.status}")
+        finally:
+            conn.close()
+
+    def close(self):
+        pass
+
+
+class EventForwarder:
+    """把锁屏相关事件批量转发到集中收集端（SIEM）
+
+    emit() 只把事件追加到内存队列，不做任何 I/O，监控线程不会被阻塞。转发线程攒满
+    batch_size 条或等待 interval 秒后发出一批，同一时间只有一批在途，收到确认才发下一批。
+    收集端不可达时批次写入本地暂存目录（总大小受限，超出时丢弃最旧的），恢复后先按顺序
+    补发暂存再发新事件，因此收集端看到的顺序与产生顺序一致。投递语义为至少一次：确认丢失
+    时同一批会重发，收集端可按 (session, seq) 去重。
+    """
+    MEMORY_LIMIT = 10000
+    SEND_TIMEOUT = 5.0
+    MAX_BACKOFF = 60.0
+
+    def __init__(self, url: str, spool_dir: str, batch_size: int = 100, interval: float = 2.0,
+                 spool_max_bytes: int = 10 * 1024 * 1024):
+        if url.startswith("tcp://"):
+            host, _, port = url[len("tcp://"):].rstrip("/").rpartition(":")
+            self.transport = TCPTransport(host, int(port), self.SEND_TIMEOUT)
+        else:
+            self.transport = HTTPTransport(url, self.SEND_TIMEOUT)
+        self.url = url
+        self.batch_size = batch_size
+        self.interval = interval
+        self.spool_dir = spool_dir
+        self.spool_max_bytes = spool_max_bytes
+        os.makedirs(spool_dir, exist_ok=True)
+        self.session = secrets.token_hex(6)
+        self.seq = 0
+        self.host = socket.gethostname()
+        self.user = os.environ.get("USERNAME") or os.environ.get("USER", "")
+        self._pending: deque = deque()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._online = True
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        self._spool_files: deque = deque()  # (文件名, 字节数, 事件数)，按产生顺序
+        for name in sorted(os.listdir(spool_dir)):
+            if name.endswith(".jsonl"):
+                path = os.path.join(spool_dir, name)
+                with open(path, "rb") as f:
+                    self._spool_files.append((name, os.path.getsize(path), sum(1 for _ in f)))
+        self._spool_seq = 0
+        self.thread = threading.Thread(target=self._run, daemon=True, name="event-forwarder")
+        self.thread.start()
+
+    @classmethod
+    def from_config(cls, config_manager: ConfigManager) -> Optional["EventForwarder"]:
+        config = config_manager.config
+        if not config.forward_url:
+            return None
+        spool_dir = os.path.join(os.path.dirname(os.path.abspath(config_manager.config_path)), config.forward_spool_dir)
+        print(f"事件转发到 {config.forward_url}")
+        return cls(config.forward_url, spool_dir, config.forward_batch_size, config.forward_interval_seconds,
+                   config.forward_spool_max_bytes)
+
+    def emit(self, event: str, **fields):
+        """记录一个事件（任意线程调用，立即返回）"""
+        with self._cond:
+            self.seq += 1
+            record = dict(fields, event=event, time=time.time(), host=self.host, user=self.user,
+                          session=self.session, seq=self.seq)
+            if len(self._pending) >= self.MEMORY_LIMIT:
+                self._pending.popleft()
+                METRICS.forward_dropped.inc()
+            self._pending.append(record)
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    @property
+    def spooled(self) -> int:
+        return sum(count for _, _, count in self._spool_files)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopping and len(self._pending) < self.batch_size:
+                    self._cond.wait(self.interval)
+                stopping = self._stopping
+                batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+            # 暂存先于新事件发送，保证顺序
+            if self._drain_spool() and batch:
+                if not self._send(batch):
+                    self._spool(batch)
+            elif batch:
+                self._spool(batch)
+            if stopping and not self._pending:
+                self.transport.close()
+                return
+
+    def _send(self, records: List[dict]) -> bool:
+        if time.monotonic() < self._retry_at:
+            return False
+        try:
+            self.transport.send(f"{records[0]['session']}:{records[0]['seq']}", records)
+        except (OSError, ValueError) as e:
+            METRICS.forward_errors.inc()
+            self._backoff = min(self.MAX_BACKOFF, max(1.0, self._backoff * 2))
+            self._retry_at = time.monotonic() + self._backoff
+            if self._online:
+                print(f"事件转发失败，暂存到本地: {e}")
+                self._online = False
+            return False
+        if not self._online:
+            print("收集端已恢复，补发暂存事件")
+            self._online = True
+        self._backoff = 0.0
+        METRICS.forwarded.inc(len(records))
+        return True
+
+    def _drain_spool(self) -> bool:
+        """按顺序补发暂存批次，全部送达时返回 True"""
+        while self._spool_files:
+            name, size, _ = self._spool_files[0]
+            path = os.path.join(self.spool_dir, name)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    records = [json.loads(line) for line in f if line.strip()]
+            except (OSError, ValueError) as e:
+                print(f"暂存文件损坏，已跳过 {name}: {e}")
+                records = []
+            if records and not self._send(records):
+                return False
+            self._spool_files.popleft()
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return True
+
+    def _spool(self, records: List[dict]):
+        self._spool_seq += 1
+        name = f"{time.time_ns():020d}-{self._spool_seq:06d}.jsonl"
+        data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode("utf-8")
+        path = os.path.join(self.spool_dir, name)
+        try:
+            with open(f"{path}.tmp", "wb") as f:
+                f.write(data)
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            print(f"事件暂存失败: {e}")
+            METRICS.forward_dropped.inc(len(records))
+            return
+        METRICS.forward_spooled.inc(len(records))
+        self._spool_files.append((name, len(data), len(records)))
+        total = sum(size for _, size, _ in self._spool_files)
+        while total > self.spool_max_bytes and len(self._spool_files) > 1:
+            old, size, count = self._spool_files.popleft()
+            total -= size
+            METRICS.forward_dropped.inc(count)
+            try:
+                os.remove(os.path.join(self.spool_dir, old))
+            except OSError:
+                pass
+
+    def close(self, timeout: float = 2.0):
+        """尽量送出内存中的事件，送不出的写入暂存"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self.thread.join(timeout)
+
+
+# ==================== 审计日志 ====================
+
+def parse_time_arg(text: str, now: Optional[float] = None) -> float:
+    """命令行时间参数：ISO 日期/时间（本地时区），或相对现在的 30m、12h、7d"""
+    from datetime import datetime
+    now = time.time() if now is None else now
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([smhd])", text.strip())
+    if match:
+        return now - float(match.group(1)) * {"s": 1, "m": 60, "h": 3600, "d": 86400}[match.group(2)]
+    return datetime.fromisoformat(text.strip()).timestamp()
+
+
+class AuditLog:
+    """只追加的结构化审计日志：异步批量写入，轮转为分块 gzip 段并维护稀疏时间索引"""
+    MEMORY_LIMIT = 10000
+    BLOCK_RECORDS = 256
+    FLUSH_DELAY = 0.1
+    CURRENT = "current.jsonl"
+    INDEX = "index.jsonl"
+
+    def __init__(self, directory: str, max_bytes: int = 4 * 1024 * 1024, rotate_seconds: float = 86400.0,
+                 retention_seconds: float = 0.0):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.retention_seconds = retention_seconds
+        self.host = socket.gethostname()
+        self.user = self._current_user()
+        self.clock: Callable[[], float] = time.time  # 基准测试生成历史数据时替换
+        self._pending: deque = deque()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._fp = None
+        self._size = 0
+        self._start: Optional[float] = None  # 当前段第一条记录的时间
+        self._next_rotate_size = max_bytes  # 轮转失败后推迟到再写满一段
+        self._open_current()
+        self.thread = threading.Thread(target=self._run, daemon=True, name="audit-log")
+        self.thread.start()
+
+    @staticmethod
+    def _current_user() -> str:
+        import getpass  # 环境变量之外还会查询账户数据库，审计记录不能缺用户名
+        try:
+            return getpass.getuser()
+        except Exception:
+            return ""
+
+    @staticmethod
+    def directory_for(config_manager: ConfigManager) -> str:
+        return os.path.join(os.path.dirname(os.path.abspath(config_manager.config_path)), config_manager.config.audit_dir)
+
+    @classmethod
+    def from_config(cls, config_manager: ConfigManager) -> Optional["AuditLog"]:
+        config = config_manager.config
+        if not config.audit_dir:
+            return None
+        try:
+            return cls(cls.directory_for(config_manager), config.audit_max_bytes, config.audit_rotate_hours * 3600,
+                       config.audit_retention_days * 86400)
+        except OSError as e:
+            print(f"无法打开审计日志: {e}")
+            return None
+
+    def emit(self, event: str, **fields):
+        """记录一个事件（任意线程调用，立即返回）"""
+        record = dict(fields, event=event, time=round(self.clock(), 6), user=self.user, host=self.host)
+        with self._cond:
+            if len(self._pending) >= self.MEMORY_LIMIT:
+                self._pending.popleft()
+                METRICS.audit_dropped.inc()
+            self._pending.append(record)
+            if len(self._pending) == 1:
+                self._cond.notify()
+
+    # ---------- 写入线程 ----------
+
+    def _open_current(self):
+        path = os.path.join(self.directory, self.CURRENT)
+        self._fp = open(path, "ab")
+        self._size = self._fp.tell()
+        self._start = None
+        if self._size:
+            with open(path, "rb") as f:
+                first = f.readline()
+                f.seek(-1, os.SEEK_END)
+                torn = f.read(1) != b"\n"
+            try:
+                self._start = json.loads(first)["time"]
+            except (ValueError, KeyError, TypeError):
+                self._start = self.clock()
+            if torn:  # 上次写到一半崩溃，另起一行，半条记录在读取时跳过
+                self._fp.write(b"\n")
+                self._size += 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                self._cond.wait_for(lambda: self._stopping, self.FLUSH_DELAY)  # 突发时一批只 fsync 一次
+                batch = list(self._pending)
+                self._pending.clear()
+                stopping = self._stopping
+            if batch:
+                try:
+                    self._write(batch)
+                except OSError as e:
+                    print(f"审计日志写入失败: {e}")
+            if stopping:
+                self._fp.close()
+                return
+
+    def _write(self, batch: List[dict]):
+        for record in batch:
+            if self._start is not None and (self._size >= self._next_rotate_size
+                                            or record["time"] - self._start >= self.rotate_seconds):
+                self._rotate(record["time"])
+            line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+            self._fp.write(line)
+            self._size += len(line)
+            if self._start is None:
+                self._start = record["time"]
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        METRICS.audit_records.inc(len(batch))
+
+    def _rotate(self, now: float):
+        import gzip  # 只在轮转时需要
+        self._fp.close()
+        current = os.path.join(self.directory, self.CURRENT)
+        try:
+            with open(current, "rb") as f:
+                lines = [line for line in f if line.endswith(b"\n")]
+            entries = []
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                    entries.append((float(record["time"]), str(record["event"]), str(record.get("user", "")), line))
+                except (ValueError, KeyError, TypeError):
+                    continue  # 崩溃留下的半条记录
+            if entries:
+                self._write_segment(entries, gzip)
+            os.remove(current)
+            METRICS.audit_rotations.inc()
+            self._next_rotate_size = self.max_bytes
+            self._prune(now)
+        except OSError as e:
+            print(f"审计日志轮转失败，继续写入当前段: {e}")
+            self._next_rotate_size = self._size + self.max_bytes
+        self._open_current()
+
+    def _write_segment(self, entries: List[tuple], gzip):
+        """写临时文件 → 追加索引 → 改名；中途崩溃后重启会重新轮转出同名段，索引按文件名去重"""
+        start = entries[0][0]
+        stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime(start))
+        name = f"audit-{stamp}.{int(start * 1e6) % 1000000:06d}.jsonl.gz"
+        path = os.path.join(self.directory, name)
+        groups: Dict[str, List[tuple]] = {}
+        for entry in entries:
+            groups.setdefault(entry[1], []).append(entry)
+        blocks = []
+        with open(f"{path}.tmp", "wb") as f:
+            for event, group in sorted(groups.items()):
+                for i in range(0, len(group), self.BLOCK_RECORDS):
+                    chunk = group[i:i + self.BLOCK_RECORDS]
+                    data = gzip.compress(b"".join(line for _, _, _, line in chunk), mtime=0)
+                    users = sorted({user for _, _, user, _ in chunk})
+                    blocks.append([min(t for t, _, _, _ in chunk), max(t for t, _, _, _ in chunk), f.tell(), len(data),
+                                   len(chunk), event, users])
+                    f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        entry = {"file": name, "start": start, "end": max(block[1] for block in blocks), "count": len(entries),
+                 "events": {event: len(group) for event, group in groups.items()}, "blocks": blocks}
+        with open(os.path.join(self.directory, self.INDEX), "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+
+    def _prune(self, now: float):
+        """删除超过保留期的段，并重写索引（同时去掉重复行）"""
+        if not self.retention_seconds:
+            return
+        index = self.read_index(self.directory)
+        keep = [entry for entry in index if entry["end"] >= now - self.retention_seconds]
+        if len(keep) == len(index):
+            return
+        path = os.path.join(self.directory, self.INDEX)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(entry, ensure_ascii=False) + "\n" for entry in keep)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+        kept = {entry["file"] for entry in keep}
+        for entry in index:
+            if entry["file"] not in kept:
+                try:
+                    os.remove(os.path.join(self.directory, entry["file"]))
+                except OSError:
+                    pass
+
+    def close(self, timeout: float = 2.0):
+        """写完内存中的记录后停止写入线程"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self.thread.join(timeout)
+
+    # ---------- 查询 ----------
+
+    @classmethod
+    def read_index(cls, directory: str) -> List[dict]:
+        """读取稀疏索引，按文件名去重（后写的为准），按时间排序"""
+        entries: Dict[str, dict] = {}
+        try:
+            with open(os.path.join(directory, cls.INDEX), encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        entries[entry["file"]] = entry
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except FileNotFoundError:
+            pass
+        return sorted(entries.values(), key=lambda entry: entry["start"])
+
+    @classmethod
+    def query(cls, directory: str, start: Optional[float] = None, end: Optional[float] = None,
+              events: Optional[List[str]] = None, user: Optional[str] = None,
+              stats: Optional[dict] = None) -> Iterator[dict]:
+        """按时间范围 [start, end]、事件类型和用户查询，按时间顺序逐条返回
+
+        段之间时间不重叠，段内命中的记录合并后按时间排序。stats 传入字典时累计读取与跳过的块数。
+        """
+        import zlib
+        lo = -math.inf if start is None else start
+        hi = math.inf if end is None else end
+        wanted = set(events) if events else None
+        stats = stats if stats is not None else {}
+        for key in ("blocks_read", "blocks_skipped", "bytes_read"):
+            stats.setdefault(key, 0)
+
+        # 记录由 json.dumps 按固定格式写出，先按字节粗筛掉绝大多数不相干的行
+        needle = json.dumps({"user": user}, ensure_ascii=False)[1:-1].encode("utf-8") if user is not None else b""
+
+        def matches(record: dict) -> bool:
+            return (lo <= record.get("time", 0) <= hi and (wanted is None or record.get("event") in wanted)
+                    and (user is None or record.get("user") == user))
+
+        for entry in cls.read_index(directory):
+            if entry["end"] < lo or entry["start"] > hi or (wanted and not wanted & set(entry["events"])):
+                stats["blocks_skipped"] += len(entry["blocks"])
+                continue
+            try:
+                f = open(os.path.join(directory, entry["file"]), "rb")
+            except FileNotFoundError:
+                continue  # 索引已追加、段还没改名（轮转中途）
+            found = []
+            with f:
+                for first, last, offset, length, _, event, users in entry["blocks"]:
+                    if (last < lo or first > hi or (wanted and event not in wanted)
+                            or (user is not None and user not in users)):
+                        stats["blocks_skipped"] += 1
+                        continue
+                    f.seek(offset)
+                    data = f.read(length)
+                    stats["blocks_read"] += 1
+                    stats["bytes_read"] += len(data)
+                    for line in zlib.decompress(data, 16 + zlib.MAX_WBITS).splitlines():
+                        if needle in line:
+                            record = json.loads(line)
+                            if matches(record):
+                                found.append(record)
+            found.sort(key=lambda record: record["time"])
+            yield from found
+        try:
+            with open(os.path.join(directory, cls.CURRENT), "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # 正在写入的最后一行
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if matches(record):
+                        yield record
+        except FileNotFoundError:
+            pass
+
+
+# ==================== 异步核心 ====================
+
+class _LoopTimer:
+    """threading.Timer 接口的事件循环定时器，供 LockDaemon 的倒计时使用（只在事件循环线程上调用）"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, interval: float, function: Callable, args: tuple = ()):
+        self.loop = loop
+        self.interval = interval
+        self.function = function
+        self.args = args
+        self.daemon = True
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+    def start(self):
+        self.handle = self.loop.call_later(self.interval, self.function, *self.args)
+
+    def cancel(self):
+        if self.handle:
+            self.handle.cancel()
+
+
+class AsyncCore(LockDaemon):
+    """单事件循环的锁屏核心：设备事件、判定、倒计时和控制都在一个 asyncio 线程上，锁屏流水线交给线程池"""
+    REOPEN_DELAY = 2.0
+    INBOX_LIMIT = 10000  # 尚未处理的设备事件上限，超出后改为全量核对
+    WATCH_BUFFER_LIMIT = 64 * 1024  # 订阅连接积压超过此字节数视为卡死，断开
+
+    def __init__(self, config_manager: ConfigManager, usb_monitor: Optional[USBMonitor] = None,
+                 lock_action: Optional[Callable[[], None]] = None, control: bool = True):
+        super().__init__(config_manager, usb_monitor, lock_action, timer_factory=self._timer)
+        self.control = control
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread: Optional[threading.Thread] = None
+        self._subscribers: List[Callable[[dict], None]] = []
+        self._handles: Dict[str, asyncio.TimerHandle] = {}  # 去抖截止、后端重建、配置检查
+        self._inbox: List[DeviceEvent] = []
+        self._inbox_lock = threading.Lock()
+        self._drain_scheduled = False
+        self._overflow = False
+        self._locking: Optional[asyncio.Future] = None
+
+    def _timer(self, interval: float, function: Callable, args: tuple = ()) -> _LoopTimer:
+        return _LoopTimer(self.loop, interval, function, args)
+
+    def _later(self, name: str, delay: Optional[float], callback: Callable, when: Optional[float] = None):
+        """安排（或取消）一个具名的事件循环回调，同名的旧回调被替换"""
+        handle = self._handles.pop(name, None)
+        if handle:
+            handle.cancel()
+        if when is not None:
+            self._handles[name] = self.loop.call_at(when, callback)
+        elif delay is not None:
+            self._handles[name] = self.loop.call_later(delay, callback)
+
+    def call(self, func: Callable, *args, timeout: float = 5.0):
+        """在事件循环线程上执行 func 并返回结果；核心未运行或已在事件循环线程上时直接调用"""
+        if self.thread is None or threading.current_thread() is self.thread:
+            return func(*args)
+
+        async def invoke():
+            return func(*args)
+        return asyncio.run_coroutine_threadsafe(invoke(), self.loop).result(timeout)
+
+    def subscribe(self, deliver: Callable[[dict], None]):
+        """登记一个进程内订阅者，广播的事件字典交给 deliver"""
+        self._subscribers.append(deliver)
+
+    def _broadcast(self, event: dict):
+        for deliver in self._subscribers:
+            deliver(event)
+        if self._watchers:
+            data = (json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8")
+            for writer in list(self._watchers):
+                if writer.transport.get_write_buffer_size() > self.WATCH_BUFFER_LIMIT:
+                    self._watchers.remove(writer)
+                    writer.close()
+                else:
+                    writer.write(data)
+        if self.forwarder:
+            self.forwarder.emit(**event)
+        if self.audit:
+            self.audit.emit(**event)
+
+    # ---------- 设备事件 ----------
+
+    def ingest(self, event: DeviceEvent):
+        """接收一个设备事件（任意线程）：放入有界收件箱，每批只唤醒一次事件循环
+
+        收件箱满时丢弃后续事件并记下溢出，下一批改为全量核对在位状态，而不是按不完整的事件判定。
+        """
+        with self._inbox_lock:
+            if len(self._inbox) >= self.INBOX_LIMIT:
+                self._overflow = True
+                return
+            self._inbox.append(event)
+            if self._drain_scheduled:
+                return
+            self._drain_scheduled = True
+        try:
+            self.loop.call_soon_threadsafe(self._drain)
+        except RuntimeError:  # 事件循环已关闭
+            pass
+
+    def _drain(self):
+        with self._inbox_lock:
+            batch, self._inbox = self._inbox, []
+            overflow, self._overflow = self._overflow, False
+            self._drain_scheduled = False
+        if overflow:
+            METRICS.ingest_overflows.inc()
+            print(f"设备事件积压超过 {self.INBOX_LIMIT} 个，重新核对密钥在位状态")
+            USBScanner.inventory.invalidate()
+            self.usb_monitor.resync()
+        elif batch:
+            self.usb_monitor.process_batch(batch)
+        self._schedule_deadline()
+
+    def _on_deadline(self):
+        self.usb_monitor.poll_due()
+        self._schedule_deadline()
+
+    def _schedule_deadline(self):
+        """事件循环时钟即 time.monotonic，去抖截止时间直接作为回调时刻"""
+        self._later("deadline", None, self._on_deadline, when=self.usb_monitor.presence.next_deadline())
+
+    def _lock_screen(self, event: Optional[dict] = None, scheduled: Optional[float] = None):
+        """在线程池中执行锁屏流水线，事件循环照常处理设备事件、控制命令和代理连接"""
+        if self._locking and not self._locking.done():
+            print("锁屏正在进行，跳过")
+            return
+        self._locking = self.loop.run_in_executor(None, self.lock_action)
+        self._locking.add_done_callback(lambda future: self._on_locked(future, event, scheduled))
+
+    def _on_locked(self, future: asyncio.Future, event: Optional[dict], scheduled: Optional[float] = None):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error:
+            print(f"锁屏失败: {error}")
+        self._record_lock(scheduled)
+        if event:  # 失败也广播，界面据此结束倒计时显示
+            self._broadcast(event)
+
+    def _on_backend_error(self, error: Exception):
+        METRICS.backend_errors.inc()
+        print(f"监听错误: {error}")
+        self.armed = False
+        self.usb_monitor.backend.detach()
+        self._later("reopen", self.REOPEN_DELAY, self._reopen_backend)
+
+    def _reopen_backend(self):
+        """事件源出错（如 WMI 服务重启）或启动时不可用（如代理尚未启动）后重建订阅，并重新核对在位状态"""
+        if not self.usb_monitor.running:
+            return
+        try:
+            self._attach()
+        except Exception as e:
+            print(f"重建监听失败: {e}")
+            self._later("reopen", self.REOPEN_DELAY, self._reopen_backend)
+            return
+        self.armed = True
+        self.usb_monitor.resync()
+        self._schedule_deadline()
+
+    def _attach(self):
+        self.usb_monitor.backend.attach(self.loop, self.config_manager.config, self.ingest, self._on_backend_error)
+
+    # ---------- 配置 ----------
+
+    def _check_config(self):
+        try:
+            if self.config_manager.check_reload(notify=False):
+                self._on_config_reloaded(self.config_manager.config)
+                self._broadcast({"event": "reloaded", "enabled": self.is_enabled})
+        except Exception as e:
+            print(f"配置热加载失败: {e}")
+        self._later("config", self.config_manager.WATCH_INTERVAL, self._check_config)
+
+    def _on_config_reloaded(self, config: AppConfig):
+        super()._on_config_reloaded(config)
+        self._schedule_deadline()
+
+    # ---------- 控制套接字 ----------
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        def reply(payload: dict):
+            writer.write((json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8"))
+
+        try:
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 5)
+                if not line:
+                    return
+                try:
+                    request = json.loads(line)
+                except json.JSONDecodeError:
+                    reply({"ok": False, "error": "请求不是合法的 JSON"})
+                    continue
+                if not hmac.compare_digest(str(request.get("token", "")), self.token):
+                    reply({"ok": False, "error": "令牌无效"})
+                    return
+                if request.get("cmd") == "watch":
+                    reply({"ok": True})
+                    self._watchers.append(writer)
+                    while await reader.read(1024):
+                        pass  # 保持到客户端断开
+                    return
+                reply(self.handle_command(request.get("cmd", "")))
+                await writer.drain()
+        except (OSError, ValueError, asyncio.TimeoutError):
+            pass  # 客户端断开或超时
+        finally:
+            if writer in self._watchers:
+                self._watchers.remove(writer)
+            writer.close()
+
+    # ---------- 生命周期 ----------
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=run_loop_with_com, args=(self.loop,), daemon=True, name="autolocker-core")
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+        if self.control:
+            print(f"守护进程已启动，控制端口 127.0.0.1:{self.port}")
+
+    async def _start(self):
+        if self.control:
+            self._write_token()
+            self._server = await asyncio.start_server(self._handle_client, "127.0.0.1",
+                                                      self.config_manager.config.control_port)
+            self.port = self._server.sockets[0].getsockname()[1]
+        METRICS.start_export(self.config_manager)
+        self.forwarder = EventForwarder.from_config(self.config_manager)
+        self.audit = AuditLog.from_config(self.config_manager)
+        self._later("config", self.config_manager.WATCH_INTERVAL, self._check_config)
+        self.arm()
+
+    def arm(self):
+        """接上监控回调，把事件源接入事件循环"""
+        monitor = self.usb_monitor
+        monitor.on_device_removed = self._on_device_removed
+        monitor.on_device_inserted = self._on_device_inserted
+        monitor.on_device_flapping = self._on_device_flapping
+        monitor.prepare()
+        monitor.running = True
+        try:
+            self._attach()
+        except Exception as e:
+            # 保持 running，按出错重建的节奏重试；reconfigure 也因此不会改走多线程监控的重启路径
+            print(f"监听启动失败 ({monitor.backend.name})，{self.REOPEN_DELAY:.0f} 秒后重试: {e}")
+            self._later("reopen", self.REOPEN_DELAY, self._reopen_backend)
+            return
+        self.armed = True
+        self._schedule_deadline()
 
-    @classmethod
-    def set_enabled(cls, enabled: bool) -> bool:
-        """设置开机自启状态"""
-        return cls.enable() if enabled else cls.disable()
+    def _shutdown(self):
+        self._stopped.set()
+        self.armed = False
+        self.cancel_countdown("shutdown")
+        for name in list(self._handles):
+            self._later(name, None, None)
+        self.usb_monitor.running = False
+        self.usb_monitor.backend.detach()
+        self.usb_monitor.release()
+        if self._server:
+            self._server.close()
+        for writer in self._watchers:
+            writer.close()
+        self._watchers.clear()
 
-    @classmethod
-    def update_path_if_needed(cls) -> None:
-        """如果路径变化，更新注册表（用于程序移动后）"""
-        current = cls.get_current_path()
-        if current is not None:
-            expected = cls.get_exe_path()
-            if current != expected:
-                print(f"检测到路径变化，更新自启动路径...")
-                cls.enable()
+    def stop(self):
+        if self.thread is None:
+            return
+        self.call(self._shutdown)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=2)
+        self.thread = None
+        self.loop.close()
+        self.config_manager.flush()
+        if self.forwarder:
+            self.forwarder.close()
+        if self.audit:
+            self.audit.close()
 
 
-# ==================== USB 监控 ====================
+class CoreMonitor(EventStreamMonitor):
+    """GUI 进程内的监控器，事件来自同进程的 AsyncCore"""
 
-class USBMonitor:
-    """USB 设备监控器"""
+    def __init__(self, core: AsyncCore):
+        super().__init__()
+        self.core = core
+        core.subscribe(self.receive)
 
-    def __init__(self, config_manager: ConfigManager):
-        self.config_manager = config_manager
-        self.device_present = False
+    def start(self):
+        if self.running:
+            return
+        self.core.start()
+        self.device_present = self.core.usb_monitor.device_present
+        self.running = True
+
+    def stop(self):
         self.running = False
+        self.core.stop()
+
+    def reconfigure(self):
+        """设置窗口已修改配置，由核心在事件循环上就地应用"""
+        self.core.call(self.core.reload)
+
+
+# ==================== 设备代理 ====================
+
+class DeviceBroker:
+    """多会话共享的设备代理（--broker）：独占设备事件源，按密钥把事件分发给订阅的会话"""
+    REOPEN_DELAY = 2.0
+    BUFFER_LIMIT = 256 * 1024  # 会话积压超过此字节数后开始考察它的消化速度
+    MAX_BUFFER = 4 * 1024 * 1024  # 无论消化多快，积压超过此字节数都断开
+    DRAIN_WINDOW = 1.0  # 积压超限后，隔这么久按消化速度判断一次（秒）
+    MAX_LAG = 5.0  # 按实测速度消化积压所需时间的上限（秒）
+    SEND_BUFFER = 64 * 1024  # 固定的内核发送缓冲，卡死的会话能被及时发现
+    MAX_KEYS = 64  # 每个会话最多订阅的密钥数
+    KEY_PATTERN = re.compile(r"VID_[0-9A-F]{4}&PID_[0-9A-F]{4}")
+
+    def __init__(self, config_manager: ConfigManager, backend: Optional[DeviceEventBackend] = None):
+        config = config_manager.config
+        self.config_manager = config_manager
+        self.backend = backend or create_backend("auto" if config.backend == "broker" else config.backend)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
         self.thread: Optional[threading.Thread] = None
-        self.on_device_removed: Optional[Callable] = None
-        self.on_device_inserted: Optional[Callable] = None
+        self.port = 0
+        self.present: Dict[str, Dict[str, str]] = {}  # vid_pid -> {实例 ID: 名称}
+        self.tracked: set = set()  # 已全量查询过、由事件增量维护的密钥
+        self.stats = {"events": 0, "delivered": 0, "slow_dropped": 0, "sessions_total": 0}
+        self.started_at = time.time()
+        self._subscribers: Dict[str, set] = {}  # vid_pid -> 订阅了它的会话
+        self._sessions: Dict[asyncio.StreamWriter, List[str]] = {}
+        self._clients: Dict[asyncio.StreamWriter, asyncio.Task] = {}  # 全部连接（含未订阅的），停止时断开
+        self._written: Dict[asyncio.StreamWriter, int] = {}  # 每个连接累计写入的字节数，减去积压即已被读走的
+        self._drain_checks: Dict[asyncio.StreamWriter, asyncio.TimerHandle] = {}
+        self._server = None
+        self._reopen: Optional[asyncio.TimerHandle] = None
+        self._stopped = threading.Event()
 
-    def check_device_presence(self) -> bool:
+    # ---------- 设备事件 ----------
+
+    def _ingest(self, event: DeviceEvent):
+        """后端回调（任意线程）"""
         try:
-            c = wmi.WMI()
-            pnp_id = self.config_manager.config.get_pnp_id()
-            results = c.query(f"SELECT DeviceID FROM Win32_PnPEntity WHERE DeviceID LIKE '{pnp_id}%'")
-            return bool(results)
-        except Exception as e:
-            print(f"设备检测失败: {e}")
-            return False
+            self.loop.call_soon_threadsafe(self._publish, event)
+        except RuntimeError:  # 事件循环已关闭
+            pass
 
-    def _monitor_loop(self):
-        pythoncom.CoInitialize()
+    def _publish(self, event: DeviceEvent):
+        key = event.vid_pid.upper()
+        instances = self.present.setdefault(key, {})
+        if event.action == "add":
+            instances[event.device_id] = event.name
+        else:
+            instances.pop(event.device_id, None)
+        self.stats["events"] += 1
+        subscribers = self._subscribers.get(key)
+        if not subscribers:
+            return
+        data = (json.dumps({"event": "device", "action": event.action, "device_id": event.device_id,
+                            "vid": event.vid, "pid": event.pid, "name": event.name}, ensure_ascii=False) + "\n").encode("utf-8")
+        for writer in list(subscribers):
+            self._send(writer, data)
+            self.stats["delivered"] += 1
+            buffered = writer.transport.get_write_buffer_size()
+            if buffered > self.MAX_BUFFER:
+                self._drop_slow(writer)
+            elif buffered > self.BUFFER_LIMIT and writer not in self._drain_checks:
+                self._watch_drain(writer)
+
+    def _track(self, key: str) -> List[str]:
+        """密钥第一次被订阅时向后端全量查询，之后由事件维护"""
+        if key not in self.tracked:
+            vid, _, pid = key.partition("&")
+            try:
+                device_ids = self.backend.find_instances(vid, pid)
+            except Exception as e:
+                print(f"设备检测失败: {e}")
+                return sorted(self.present.get(key, ()))
+            self.present[key] = {device_id: "" for device_id in device_ids}
+            self.tracked.add(key)
+        return sorted(self.present.get(key, ()))
+
+    def _on_backend_error(self, error: Exception):
+        METRICS.backend_errors.inc()
+        print(f"监听错误: {error}")
+        self.backend.detach()
+        self._reopen = self.loop.call_later(self.REOPEN_DELAY, self._reopen_backend)
+
+    def _reopen_backend(self):
+        """重建事件源，并按全量查询结果给订阅者补发断开期间错过的变化"""
         try:
-            c = wmi.WMI()
-            device_pattern = self.config_manager.config.get_device_id_pattern()
-            print(f"开始监听设备 {device_pattern}...")
+            self._attach()
+        except Exception as e:
+            print(f"重建监听失败: {e}")
+            self._reopen = self.loop.call_later(self.REOPEN_DELAY, self._reopen_backend)
+            return
+        for key in list(self.tracked):
+            old = set(self.present.get(key, ()))
+            self.tracked.discard(key)
+            new = set(self._track(key))
+            vid, _, pid = key.partition("&")
+            for device_id in sorted(old - new):
+                self._publish(DeviceEvent(action="remove", device_id=device_id, vid=vid, pid=pid))
+            for device_id in sorted(new - old):
+                self._publish(DeviceEvent(action="add", device_id=device_id, vid=vid, pid=pid))
 
-            deletion_query = f"SELECT * FROM __InstanceDeletionEvent WITHIN 1 WHERE TargetInstance ISA 'Win32_PnPEntity' AND TargetInstance.DeviceID LIKE '{device_pattern}'"
-            watcher_deletion = c.watch_for(raw_wql=deletion_query)
+    def _attach(self):
+        self.backend.attach(self.loop, self.config_manager.config, self._ingest, self._on_backend_error)
 
-            creation_query = f"SELECT * FROM __InstanceCreationEvent WITHIN 1 WHERE TargetInstance ISA 'Win32_PnPEntity' AND TargetInstance.DeviceID LIKE '{device_pattern}'"
-            watcher_creation = c.watch_for(raw_wql=creation_query)
+    # ---------- 会话 ----------
 
-            while self.running:
-                try:
-                    event = watcher_deletion(timeout_ms=100)
-                    if event and self.device_present:
-                        print("检测到设备拔出！")
-                        self.device_present = False
-                        if self.on_device_removed:
-                            self.on_device_removed()
-                except wmi.x_wmi_timed_out:
-                    pass
+    def _send(self, writer: asyncio.StreamWriter, data: bytes):
+        writer.write(data)
+        self._written[writer] = self._written.get(writer, 0) + len(data)
+
+    def _drained(self, writer: asyncio.StreamWriter) -> int:
+        return self._written.get(writer, 0) - writer.transport.get_write_buffer_size()
+
+    def _watch_drain(self, writer: asyncio.StreamWriter):
+        self._drain_checks[writer] = self.loop.call_later(
+            self.DRAIN_WINDOW, self._check_drain, writer, self._drained(writer), self.loop.time())
+
+    def _check_drain(self, writer: asyncio.StreamWriter, drained_before: int, since: float):
+        """积压超限的会话：按它在这段时间里的实际消化速度，判断能否在 MAX_LAG 内追上"""
+        del self._drain_checks[writer]
+        if writer not in self._clients:
+            return
+        buffered = writer.transport.get_write_buffer_size()
+        if buffered <= self.BUFFER_LIMIT:
+            return
+        rate = (self._drained(writer) - drained_before) / max(self.loop.time() - since, 1e-3)
+        if rate * self.MAX_LAG < buffered:
+            self._drop_slow(writer)
+        else:
+            self._watch_drain(writer)
+
+    def _drop_slow(self, writer: asyncio.StreamWriter):
+        self.stats["slow_dropped"] += 1
+        self._unsubscribe(writer)
+        writer.transport.abort()  # close() 会等积压写完，卡死的会话永远写不完
+
+    def _subscribe(self, writer: asyncio.StreamWriter, keys: List[str]):
+        self._unsubscribe(writer)
+        self._sessions[writer] = keys
+        for key in keys:
+            self._subscribers.setdefault(key, set()).add(writer)
+
+    def _unsubscribe(self, writer: asyncio.StreamWriter):
+        for key in self._sessions.pop(writer, ()):
+            subscribers = self._subscribers.get(key)
+            if subscribers is not None:
+                subscribers.discard(writer)
+                if not subscribers:
+                    del self._subscribers[key]
+
+    def status(self) -> dict:
+        return {"ok": True, "backend": self.backend.name, "sessions": len(self._sessions),
+                "keys": len(self._subscribers), "uptime": round(time.time() - self.started_at), **self.stats}
 
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        def reply(payload: dict):
+            self._send(writer, (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8"))
+
+        self._clients[writer] = asyncio.current_task()
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.SEND_BUFFER)
+        try:
+            while True:
+                # 订阅后的会话可以长时间不发请求；未订阅的连接须在 5 秒内发出请求
+                line = await (reader.readline() if writer in self._sessions else asyncio.wait_for(reader.readline(), 5))
+                if not line:
+                    return
                 try:
-                    event = watcher_creation(timeout_ms=100)
-                    if event and not self.device_present:
-                        print("检测到设备插入！")
-                        self.device_present = True
-                        if self.on_device_inserted:
-                            self.on_device_inserted()
-                except wmi.x_wmi_timed_out:
-                    pass
-                except Exception as e:
-                    print(f"监听错误: {e}")
-                    time.sleep(2)
+                    request = json.loads(line)
+                    cmd = request.get("cmd")
+                    keys = sorted({str(key).upper() for key in request.get("keys", [])})
+                except (ValueError, AttributeError, TypeError):
+                    reply({"ok": False, "error": "请求不是合法的 JSON"})
+                    continue
+                if cmd == "status":
+                    reply(self.status())
+                elif cmd not in ("subscribe", "query"):
+                    reply({"ok": False, "error": f"未知命令: {cmd}"})
+                elif len(keys) > self.MAX_KEYS or not all(self.KEY_PATTERN.fullmatch(key) for key in keys):
+                    reply({"ok": False, "error": f"keys 应为最多 {self.MAX_KEYS} 个 VID_XXXX&PID_XXXX"})
+                else:
+                    present = {key: self._track(key) for key in keys}
+                    if cmd == "subscribe":
+                        if writer not in self._sessions:
+                            self.stats["sessions_total"] += 1
+                        self._subscribe(writer, keys)  # 与快照在同一步完成，之间不会漏掉事件
+                    reply({"event": "snapshot", "present": present})
+        except (OSError, ValueError, asyncio.TimeoutError):
+            pass  # 会话断开或超时
         finally:
-            pythoncom.CoUninitialize()
+            self._clients.pop(writer, None)
+            self._written.pop(writer, None)
+            check = self._drain_checks.pop(writer, None)
+            if check:
+                check.cancel()
+            self._unsubscribe(writer)
+            writer.close()
+
+    # ---------- 生命周期 ----------
 
     def start(self):
-        if self.running:
-            return
-        self.device_present = self.check_device_presence()
-        print(f"初始设备状态: {'已连接' if self.device_present else '未连接'}")
-        self.running = True
-        self.thread = threading.Thread(target=self._monitor_loop, daemon=True)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=run_loop_with_com, args=(self.loop,), daemon=True, name="autolocker-broker")
         self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+        print(f"设备代理已启动，端口 127.0.0.1:{self.port}，事件源 {self.backend.name}")
+
+    async def _start(self):
+        self._server = await asyncio.start_server(self._handle_client, "127.0.0.1", self.config_manager.config.broker_port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        try:
+            self._attach()
+        except Exception as e:
+            self._on_backend_error(e)
+
+    async def _shutdown(self):
+        self._stopped.set()
+        if self._reopen:
+            self._reopen.cancel()
+        self.backend.detach()
+        if self._server:
+            self._server.close()
+        tasks = list(self._clients.values())
+        for writer in list(self._clients):
+            writer.transport.abort()
+        if tasks:  # 等连接处理结束、套接字真正关闭，会话立即看到断开
+            await asyncio.wait(tasks, timeout=1)
 
     def stop(self):
-        self.running = False
-        if self.thread:
-            self.thread.join(timeout=2)
-            self.thread = None
+        if self.thread is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(timeout=2)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=2)
+        self.thread = None
+        self.loop.close()
 
-    def restart(self):
-        self.stop()
-        time.sleep(0.5)
+    def run(self):
         self.start()
+        try:
+            while not self._stopped.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
 
 
 # ==================== 倒计时弹窗 ====================
 
+class ShiftCancelHook:
+    """连按两次 Shift 取消倒计时的全局键盘钩子
+
+    只在倒计时弹窗显示期间安装，平时不挂任何钩子，避免每次按键都进入 Python 回调。
+    pynput 的 Listener 不能重复启动，每次安装都新建一个。
+    """
+    INTERVAL = 0.5  # 两次 Shift 的最大间隔（秒）
+
+    def __init__(self, on_trigger: Callable[[], None], listener_factory: Optional[Callable] = None):
+        self.on_trigger = on_trigger
+        self.listener_factory = listener_factory or (lambda callback: keyboard.Listener(on_release=callback))
+        self.listener = None
+        self.last_shift_time = 0.0
+        self.callbacks = 0  # 钩子回调总次数
+
+    @property
+    def armed(self) -> bool:
+        return self.listener is not None
+
+    def arm(self):
+        if self.listener:
+            return
+        self.last_shift_time = 0.0
+        try:
+            self.listener = self.listener_factory(self._on_key_release)
+            self.listener.start()
+        except Exception as e:
+            self.listener = None
+            print(f"键盘钩子安装失败: {e}")
+
+    def disarm(self):
+        listener, self.listener = self.listener, None
+        if listener:
+            listener.stop()
+
+    def _on_key_release(self, key):
+        self.callbacks += 1
+        if key in (keyboard.Key.shift_l, keyboard.Key.shift_r):
+            now = time.monotonic()
+            if now - self.last_shift_time < self.INTERVAL:
+                self.last_shift_time = 0.0
+                self.on_trigger()
+            else:
+                self.last_shift_time = now
+
+
+class PopupWindow:
+    """预先构建、平时隐藏的倒计时窗口
+
+    窗口、字体和布局在启动时构建一次，拔出时只更新文字并显示，不再查询 DPI、计算几何或创建控件。
+    check() 定期在窗口隐藏时核对 DPI 与屏幕尺寸，变化后重建。
+    """
+    CHECK_INTERVAL_MS = 5000
+    BG = '#ffcccc'
+
+    def __init__(self, root: tk.Tk):
+        self.root = root
+        self.toplevel: Optional[tk.Toplevel] = None
+        self.label: Optional[tk.Label] = None
+        self.layout: tuple = ()  # 构建时的 (缩放比例, 屏幕宽, 屏幕高)
+        self.showing = False
+        self.on_paint: Optional[Callable[[], None]] = None
+        self.builds = 0
+
+    def _measure(self, window) -> tuple:
+        return window.winfo_fpixels('1i') / 96.0, window.winfo_screenwidth(), window.winfo_screenheight()
+
+    def build(self):
+        if self.toplevel:
+            self.toplevel.destroy()
+        window = tk.Toplevel(self.root)
+        window.withdraw()
+        window.attributes("-topmost", True)
+        window.overrideredirect(True)
+
+        self.layout = scale, screen_w, screen_h = self._measure(window)
+        w, h = int(500 * scale), int(160 * scale)
+        window.geometry(f"{w}x{h}+{screen_w // 2 - w // 2}+{screen_h // 2 - h // 2}")
+        window.configure(bg=self.BG)
+
+        self.label = tk.Label(window, text="", font=("Microsoft YaHei", int(16 * scale), "bold"), bg=self.BG, fg='red')
+        self.label.pack(expand=True, pady=20)
+        tk.Label(window, text="连按两次 Shift 键取消",
+                 font=("Microsoft YaHei", int(10 * scale), "bold"), bg=self.BG).pack(pady=5)
+        window.bind("<Expose>", self._on_expose)
+        window.update_idletasks()  # 布局在隐藏时算好
+        self.toplevel = window
+        self.builds += 1
+
+    def start(self):
+        """构建窗口并开始定期核对 DPI"""
+        self.build()
+        self.root.after(self.CHECK_INTERVAL_MS, self.check)
+
+    def check(self):
+        if not self.showing and self.toplevel and self._measure(self.toplevel) != self.layout:
+            print("显示缩放或屏幕尺寸已变化，重建倒计时窗口")
+            self.build()
+        self.root.after(self.CHECK_INTERVAL_MS, self.check)
+
+    def present(self, text: str, on_paint: Optional[Callable[[], None]] = None):
+        if not self.toplevel:
+            self.build()
+        self.label.config(text=text, fg='red')
+        self.on_paint = on_paint
+        self.showing = True
+        self.toplevel.deiconify()
+        self.toplevel.lift()
+
+    def hide(self):
+        self.showing = False
+        self.on_paint = None
+        if self.toplevel:
+            self.toplevel.withdraw()
+
+    def _on_expose(self, event=None):
+        on_paint, self.on_paint = self.on_paint, None
+        if on_paint:
+            on_paint()
+
+
 class CountdownPopup:
-    """倒计时弹窗"""
+    """倒计时弹窗
 
-    def __init__(self, root: tk.Tk, countdown_seconds: int, on_complete: Callable, on_cancel: Optional[Callable] = None):
+    只负责显示，截止时间、锁屏和指标由 AsyncCore 或守护进程负责；显示的秒数按单调时钟上的剩余时间计算。
+    传入 window（PopupWindow）时复用预先构建的窗口，否则每次新建一个 Toplevel。
+    """
+
+    def __init__(self, root: tk.Tk, countdown_seconds: int, on_complete: Optional[Callable] = None,
+                 on_cancel: Optional[Callable] = None, key_hook: Optional[ShiftCancelHook] = None,
+                 window: Optional[PopupWindow] = None):
         self.root = root
         self.countdown_seconds = countdown_seconds
         self.on_complete = on_complete
         self.on_cancel = on_cancel
+        self.key_hook = key_hook
+        self._hook_armed = False  # 键盘钩子由多个弹窗共用，只卸下自己安装的那一次
         self.popup: Optional[tk.Toplevel] = None
         self.label: Optional[tk.Label] = None
         self.remaining = countdown_seconds
         self.cancelled = False
+        self.deadline = 0.0
+        self.fired = False
+        self.window = window
+        self._show_started = 0.0
+        self.paint_seconds: Optional[float] = None  # show 到窗口首次绘制的耗时
 
     def _get_scale_factor(self, window) -> float:
         return window.winfo_fpixels('1i') / 96.0
 
     def show(self):
+        self._show_started = time.perf_counter()
+        self.paint_seconds = None
         self.cancelled = False
+        self.fired = False
+        self.deadline = time.monotonic() + self.countdown_seconds
         self.remaining = self.countdown_seconds
+        self._build_window()
+        self._tick()
+        # 窗口出现后再安装键盘钩子；倒计时为 0 时窗口已关闭，无需安装
+        if self.key_hook and self.popup:
+            self.key_hook.arm()
+            self._hook_armed = True
+
+    def _painted(self, event=None):
+        if self.paint_seconds is None:
+            self.paint_seconds = time.perf_counter() - self._show_started
+            METRICS.popup_paint.observe(self.paint_seconds)
+
+    def _build_window(self):
+        if self.window:
+            self.window.present(f"！USB密钥已拔出 ！\n将在 {self.remaining} 秒后锁屏", on_paint=self._painted)
+            self.popup, self.label = self.window.toplevel, self.window.label
+            return
         self.popup = tk.Toplevel(self.root)
         self.popup.attributes("-topmost", True)
         self.popup.overrideredirect(True)
@@ -375,29 +4258,61 @@ class CountdownPopup:
         self.label.pack(expand=True, pady=20)
         tk.Label(self.popup, text="连按两次 Shift 键取消",
                  font=("Microsoft YaHei", int(10 * scale), "bold"), bg='#ffcccc').pack(pady=5)
-        self._tick()
+        self.popup.bind("<Expose>", self._painted)
+
+    def _set_text(self, text: str, fg: Optional[str] = None):
+        if fg:
+            self.label.config(text=text, fg=fg)
+        else:
+            self.label.config(text=text)
 
     def _tick(self):
         if not self.popup:
             return
         if self.cancelled:
-            self.label.config(text="！已取消锁屏 ！", fg='green')
+            self._set_text("！已取消锁屏 ！", fg='green')
             self.root.after(1500, self.close)
             return
-        if self.remaining > 0:
-            self.label.config(text=f"！USB密钥已拔出 ！\n将在 {self.remaining} 秒后锁屏")
-            self.remaining -= 1
-            self.root.after(1000, self._tick)
+        left = self.deadline - time.monotonic()
+        if left > 0:
+            self.remaining = math.ceil(left)
+            self._set_text(f"！USB密钥已拔出 ！\n将在 {self.remaining} 秒后锁屏")
+            # 在显示的秒数变化（或到期）时再醒来
+            self.root.after(max(1, math.ceil((left - (self.remaining - 1)) * 1000)), self._tick)
         else:
             self.close()
+            self._fire()
+
+    def _fire(self):
+        """倒计时结束（到达截止时间或被 expire 提前结束），通知 on_complete"""
+        if self.fired or self.cancelled:
+            return
+        self.fired = True
+        if self.on_complete:
             self.on_complete()
 
-    def cancel(self):
+    def expire(self):
+        """提前结束倒计时并关闭窗口（核心已因频繁插拔立即锁屏）"""
+        self._fire()
+        self.close()
+
+    def cancel(self) -> bool:
+        """取消倒计时，已结束或已取消时返回 False"""
+        if self.fired or self.cancelled:
+            return False
         self.cancelled = True
+        return True
 
     def close(self):
+        # "已取消"提示的延迟 close 可能在下一个倒计时已显示后才到，此时钩子属于新弹窗
+        if self._hook_armed:
+            self._hook_armed = False
+            self.key_hook.disarm()
         if self.popup:
-            self.popup.destroy()
+            if self.window:
+                self.window.hide()
+            else:
+                self.popup.destroy()
             self.popup = None
 
     @property
@@ -415,7 +4330,7 @@ class TrayIconManager:
         self.on_settings = on_settings
         self.on_quit = on_quit
         self.is_enabled_getter = is_enabled_getter
-        self.icon: Optional[Icon] = None
+        self.icon: Optional[pystray.Icon] = None
 
     def _create_image(self, is_enabled: bool) -> Image.Image:
         image = Image.new('RGB', (64, 64), color=(255, 255, 255))
@@ -429,14 +4344,14 @@ class TrayIconManager:
             dc.arc((22, 12, 42, 36), start=180, end=300, fill="black", width=4)
         return image
 
-    def create(self) -> Icon:
-        menu = Menu(
-            MenuItem('启用自动锁屏', lambda i, item: (self.on_toggle(), self.update_icon()), checked=lambda item: self.is_enabled_getter()),
-            MenuItem('设置', lambda i, item: self.on_settings(), default=True),  # 双击默认动作
-            Menu.SEPARATOR,
-            MenuItem('退出', lambda i, item: self.on_quit())
+    def create(self) -> pystray.Icon:
+        menu = pystray.Menu(
+            pystray.MenuItem('启用自动锁屏', lambda i, item: self.on_toggle(), checked=lambda item: self.is_enabled_getter()),
+            pystray.MenuItem('设置', lambda i, item: self.on_settings(), default=True),  # 双击默认动作
+            pystray.Menu.SEPARATOR,
+            pystray.MenuItem('退出', lambda i, item: self.on_quit())
         )
-        self.icon = Icon("USB_AutoLocker", self._create_image(self.is_enabled_getter()), "USB 自动锁屏助手", menu)
+        self.icon = pystray.Icon("USB_AutoLocker", self._create_image(self.is_enabled_getter()), "USB 自动锁屏助手", menu)
         return self.icon
 
     def update_icon(self):
@@ -455,46 +4370,235 @@ class TrayIconManager:
 
 # ==================== 设置窗口 ====================
 
-class SettingsWindow(ctk.CTkToplevel):
-    """设置窗口"""
+class DeviceListModel:
+    """设备列表的数据部分：按 VID/PID 去重并保持出现顺序，可按名称 / VID / PID 过滤
+
+    merge 与 retain 只处理增减的设备，返回过滤后的可见列表是否变化。
+    """
+
+    def __init__(self):
+        self.devices: Dict[str, USBDevice] = {}  # vid_pid -> 设备
+        self.filter_text = ""
+        self.visible: List[USBDevice] = []
+
+    def matches(self, dev: USBDevice) -> bool:
+        text = self.filter_text
+        return not text or text in dev.name.lower() or text in dev.vid_pid.lower()
+
+    def merge(self, devices: List[USBDevice]) -> bool:
+        changed = False
+        for dev in devices:
+            if dev.vid_pid in self.devices:
+                continue
+            self.devices[dev.vid_pid] = dev
+            if self.matches(dev):
+                self.visible.append(dev)
+                changed = True
+        return changed
+
+    def retain(self, present: set) -> bool:
+        """移除 present 之外的设备"""
+        missing = [key for key in self.devices if key not in present]
+        for key in missing:
+            del self.devices[key]
+        if not missing:
+            return False
+        count = len(self.visible)
+        self.visible = [dev for dev in self.visible if dev.vid_pid in present]
+        return len(self.visible) != count
+
+    def set_filter(self, text: str) -> bool:
+        text = text.strip().lower()
+        if text == self.filter_text:
+            return False
+        self.filter_text = text
+        self.visible = [dev for dev in self.devices.values() if self.matches(dev)]
+        return True
+
+
+class VirtualDeviceList:
+    """只为可见行创建控件的设备列表
+
+    固定数量的单选按钮循环使用：滚动、过滤或增删设备时把可见区间的设备重新绑定到这些按钮上，
+    绑定未变的行不重新配置。设备再多，控件数量也不变。
+    """
+    ROWS = 6
+
+    def __init__(self, parent, variable, on_select: Callable[[USBDevice], None]):
+        self.model = DeviceListModel()
+        self.variable = variable
+        self.on_select = on_select
+        self.offset = 0
+        self.empty_text = "正在扫描设备..."
+        self.configures = 0  # 行控件重新绑定的次数
+        self._build(parent)
+        self.rows = [self._create_row() for _ in range(self.ROWS)]
+        self.bound: List[Optional[str]] = [None] * self.ROWS  # 每行当前绑定的 vid_pid
+        self.render()
+
+    # ---------- 控件 ----------
+
+    def _build(self, parent):
+        self.frame = ctk.CTkFrame(parent)
+        self.scrollbar = ctk.CTkScrollbar(self.frame, command=self._on_scrollbar)
+        self.scrollbar.pack(side="right", fill="y")
+        self.body = ctk.CTkFrame(self.frame, fg_color="transparent")
+        self.body.pack(side="left", fill="both", expand=True)
+        self.placeholder = ctk.CTkLabel(self.body, text="", text_color="gray")
+        for widget in (self.body, self.placeholder):
+            self._bind_wheel(widget)
+
+    def _bind_wheel(self, widget):
+        widget.bind("<MouseWheel>", lambda e: self.scroll(-1 if e.delta > 0 else 1))
+        widget.bind("<Button-4>", lambda e: self.scroll(-1))  # X11
+        widget.bind("<Button-5>", lambda e: self.scroll(1))
+
+    def _create_row(self):
+        row = ctk.CTkRadioButton(self.body, text="", variable=self.variable, value="")
+        self._bind_wheel(row)
+        return row
+
+    def _bind_row(self, slot: int, row, dev: USBDevice):
+        row.configure(text=dev.display_name, value=dev.vid_pid, command=lambda: self.on_select(dev))
+        # 换了 value 后按共享变量刷新选中状态，不改动变量本身
+        if self.variable.get() == dev.vid_pid:
+            row.select(from_variable_callback=True)
+        else:
+            row.deselect(from_variable_callback=True)
+        row.grid(row=slot, column=0, sticky="w", pady=2)
+
+    def _hide_row(self, row):
+        row.grid_remove()
+
+    def _set_placeholder(self, text: Optional[str]):
+        if text:
+            self.placeholder.configure(text=text)
+            self.placeholder.grid(row=0, column=0, pady=10)
+        else:
+            self.placeholder.grid_remove()
+
+    def _set_scrollbar(self, first: float, last: float):
+        self.scrollbar.set(first, last)
+
+    # ---------- 数据 ----------
+
+    def merge(self, devices: List[USBDevice]):
+        if self.model.merge(devices):
+            self.render()
+
+    def retain(self, present: set):
+        if self.model.retain(present):
+            self.render()
+
+    def set_filter(self, text: str):
+        if self.model.set_filter(text):
+            self.offset = 0
+            self.render()
+
+    def scroll(self, rows: int):
+        self.offset += rows
+        self.render()
+
+    def _on_scrollbar(self, *args):
+        if args[0] == "moveto":
+            self.offset = int(float(args[1]) * len(self.model.visible))
+        elif args[0] == "scroll":
+            self.offset += int(args[1]) * (self.ROWS if args[2] == "pages" else 1)
+        self.render()
+
+    def render(self):
+        """把可见区间绑定到行控件，只重新配置内容变化的行"""
+        visible = self.model.visible
+        self.offset = max(0, min(self.offset, len(visible) - self.ROWS))
+        for slot, row in enumerate(self.rows):
+            index = self.offset + slot
+            dev = visible[index] if index < len(visible) else None
+            key = dev.vid_pid if dev else None
+            if key == self.bound[slot]:
+                continue
+            self.bound[slot] = key
+            self.configures += 1
+            if dev:
+                self._bind_row(slot, row, dev)
+            else:
+                self._hide_row(row)
+        if visible:
+            self._set_placeholder(None)
+        else:
+            self._set_placeholder("没有匹配的设备" if self.model.filter_text and self.model.devices else self.empty_text)
+        total = len(visible)
+        self._set_scrollbar(*((self.offset / total, min(1.0, (self.offset + self.ROWS) / total)) if total > self.ROWS else (0.0, 1.0)))
+
+
+class SettingsWindow:
+    """设置窗口
+
+    设备列表先显示上次已知的设备，再由后台的流式扫描（DeviceScan）边找边合并；Tk 线程定时读取
+    扫描进度，不从扫描线程调用 Tk。同一时刻只有一次扫描，重复点击刷新会加入正在进行的扫描。
+    """
+    SCAN_POLL_MS = 100
 
     def __init__(self, parent, config_manager: ConfigManager, on_save: Optional[Callable] = None):
-        super().__init__(parent)
+        self.window = ctk.CTkToplevel(parent)
         self.config_manager = config_manager
         self.on_save_callback = on_save
-        self.usb_devices: List[USBDevice] = []
+        self._scan: Optional[DeviceScan] = None
+        self._scan_merged = 0
+        self._scan_found: set = set()
         self._setup_window()
         self._create_widgets()
         self._load_config()
-        # 异步加载设备列表，避免阻塞窗口显示
-        self.after(100, self._refresh_devices_async)
+        self._merge_devices(USBScanner.last_known())
+        # 扫描在后台进行，不阻塞窗口显示
+        self._refresh_devices_async()
+
+    @property
+    def is_open(self) -> bool:
+        try:
+            return bool(self.window.winfo_exists())
+        except Exception:
+            return False
+
+    def activate(self):
+        """已打开的窗口恢复并置顶"""
+        self.window.deiconify()  # 如果最小化则恢复
+        self.window.lift()  # 提升到最前
+        self.window.focus_force()  # 强制获取焦点
 
     def _setup_window(self):
-        self.title("USB AutoLocker 设置")
-        self.geometry("520x600")
-        self.resizable(True, True)
-        self.minsize(480, 500)
-        self.update_idletasks()
-        x = (self.winfo_screenwidth() // 2) - 260
-        y = (self.winfo_screenheight() // 2) - 300
-        self.geometry(f"+{x}+{y}")
+        self.window.title("USB AutoLocker 设置")
+        self.window.geometry("520x600")
+        self.window.resizable(True, True)
+        self.window.minsize(480, 500)
+        self.window.update_idletasks()
+        x = (self.window.winfo_screenwidth() // 2) - 260
+        y = (self.window.winfo_screenheight() // 2) - 300
+        self.window.geometry(f"+{x}+{y}")
         # 延迟设置置顶，避免干扰控件交互
-        self.after(100, lambda: self.attributes("-topmost", True))
-        self.after(200, lambda: self.attributes("-topmost", False))
-        self.focus_force()
+        self.window.after(100, lambda: self.window.attributes("-topmost", True))
+        self.window.after(200, lambda: self.window.attributes("-topmost", False))
+        self.window.focus_force()
 
     def _create_widgets(self):
         # 使用可滚动的主容器
-        main = ctk.CTkScrollableFrame(self, fg_color="transparent")
+        main = ctk.CTkScrollableFrame(self.window, fg_color="transparent")
         main.pack(fill="both", expand=True, padx=10, pady=10)
 
         # USB 设备
         dev_frame = ctk.CTkFrame(main)
         dev_frame.pack(fill="x", pady=(0, 15))
         ctk.CTkLabel(dev_frame, text="🔌 USB 设备", font=("Microsoft YaHei", 14, "bold")).pack(anchor="w", padx=10, pady=(10, 5))
-        self.device_listbox = ctk.CTkScrollableFrame(dev_frame, height=100)
-        self.device_listbox.pack(fill="x", padx=10, pady=5)
-        ctk.CTkButton(dev_frame, text="🔄 刷新", command=self._refresh_devices, width=80).pack(anchor="e", padx=10, pady=5)
+        self.filter_var = ctk.StringVar()
+        ctk.CTkEntry(dev_frame, textvariable=self.filter_var, placeholder_text="按名称 / VID / PID 过滤").pack(fill="x", padx=10, pady=(0, 5))
+        self.device_var = ctk.StringVar()
+        self.device_list = VirtualDeviceList(dev_frame, self.device_var, self._select_device)
+        self.device_list.frame.pack(fill="x", padx=10, pady=5)
+        self.filter_var.trace_add("write", lambda *_: self.device_list.set_filter(self.filter_var.get()))
+        scan_row = ctk.CTkFrame(dev_frame, fg_color="transparent")
+        scan_row.pack(fill="x", padx=10, pady=5)
+        self.scan_status = ctk.CTkLabel(scan_row, text="", text_color="gray")
+        self.scan_status.pack(side="left")
+        ctk.CTkButton(scan_row, text="🔄 刷新", command=self._refresh_devices, width=80).pack(side="right")
 
         # VID/PID
         vidpid_frame = ctk.CTkFrame(main)
@@ -508,6 +4612,10 @@ class SettingsWindow(ctk.CTkToplevel):
         ctk.CTkLabel(row, text="PID:").pack(side="left", padx=(0, 5))
         self.pid_entry = ctk.CTkEntry(row, width=120, placeholder_text="PID_XXXX")
         self.pid_entry.pack(side="left")
+        cfg = self.config_manager.config
+        if cfg.extra_devices:
+            ctk.CTkLabel(vidpid_frame, text=f"另有 {len(cfg.extra_devices)} 把额外密钥（策略: {cfg.policy}），请在 config.json 中编辑",
+                         text_color="gray").pack(anchor="w", padx=10, pady=(0, 5))
 
         # 倒计时
         cd_frame = ctk.CTkFrame(main)
@@ -534,53 +4642,72 @@ class SettingsWindow(ctk.CTkToplevel):
         btn_frame = ctk.CTkFrame(main, fg_color="transparent")
         btn_frame.pack(fill="x", pady=(10, 0))
         ctk.CTkButton(btn_frame, text="保存", command=self._save, width=100).pack(side="right", padx=(10, 0))
-        ctk.CTkButton(btn_frame, text="取消", command=self.destroy, width=100, fg_color="gray").pack(side="right")
+        ctk.CTkButton(btn_frame, text="取消", command=self.window.destroy, width=100, fg_color="gray").pack(side="right")
+        self.save_status = ctk.CTkLabel(main, text="", text_color="red", wraplength=400, justify="left")
+        self.save_status.pack(fill="x", pady=(5, 0))
 
-    def _refresh_devices_async(self):
-        """异步刷新设备列表"""
-        for w in self.device_listbox.winfo_children():
-            w.destroy()
-        ctk.CTkLabel(self.device_listbox, text="正在扫描设备...", text_color="gray").pack(pady=10)
-        threading.Thread(target=self._scan_and_update, daemon=True).start()
-
-    def _scan_and_update(self):
-        """在后台线程扫描设备"""
-        pythoncom.CoInitialize()
-        try:
-            devices = USBScanner.scan_devices()
-            # 检查窗口是否还存在
-            if self.winfo_exists():
-                self.after(0, lambda: self._update_device_list(devices))
-        finally:
-            pythoncom.CoUninitialize()
+    def _refresh_devices_async(self, refresh: bool = False):
+        """开始（或加入正在进行的）流式扫描；清单缓存有效且不强制刷新时直接使用缓存"""
+        if not refresh and USBScanner.inventory.is_live:
+            self._merge_devices(USBScanner.inventory.snapshot())
+            self._remove_missing({dev.vid_pid for dev in USBScanner.inventory.snapshot()})
+            return
+        scan = USBScanner.start_scan()
+        if scan is self._scan:
+            return  # 已在读取这次扫描的进度
+        self._scan, self._scan_merged, self._scan_found = scan, 0, set()
+        self.scan_status.configure(text="正在扫描设备...")
+        self._update_placeholder()
+        self._poll_scan()
 
-    def _update_device_list(self, devices: List[USBDevice]):
-        """更新设备列表 UI"""
-        # 检查窗口和控件是否还存在
-        try:
-            if not self.winfo_exists():
-                return
-        except Exception:
+    def _poll_scan(self):
+        """在 Tk 线程上合并扫描线程已找到的设备，窗口关闭时取消扫描"""
+        scan = self._scan
+        if scan is None:
             return
-        
-        for w in self.device_listbox.winfo_children():
-            w.destroy()
-        self.usb_devices = devices
-        if not self.usb_devices:
-            ctk.CTkLabel(self.device_listbox, text="未检测到 USB 设备", text_color="gray").pack(pady=10)
+        if not self.is_open:
+            scan.cancel()
             return
-        self.device_var = ctk.StringVar()
-        current_vid, current_pid = self.vid_entry.get(), self.pid_entry.get()
-        for dev in self.usb_devices:
-            rb = ctk.CTkRadioButton(self.device_listbox, text=dev.display_name, variable=self.device_var, value=dev.vid_pid,
-                                     command=lambda d=dev: self._select_device(d))
-            rb.pack(anchor="w", pady=2)
-            if dev.vid == current_vid and dev.pid == current_pid:
-                self.device_var.set(dev.vid_pid)
+        finished = scan.finished.is_set()  # 先读结束标志，结束前追加的设备本轮都能取到
+        found = scan.devices[self._scan_merged:]
+        self._scan_merged += len(found)
+        self._scan_found.update(dev.vid_pid for dev in found)
+        self._merge_devices(found)
+        if not finished:
+            self.window.after(self.SCAN_POLL_MS, self._poll_scan)
+            return
+        self._scan = None
+        if scan.state == "done":
+            self._remove_missing(self._scan_found)
+            self.scan_status.configure(text="")
+        elif scan.state == "timeout":
+            self.scan_status.configure(text="扫描超时，列表可能不完整")
+        else:
+            self.scan_status.configure(text=f"扫描未完成: {scan.error or '已取消'}")
+
+    @property
+    def usb_devices(self) -> List[USBDevice]:
+        return list(self.device_list.model.devices.values())
+
+    def _merge_devices(self, devices: List[USBDevice]):
+        """把新出现的设备（按 VID/PID 去重）并入列表"""
+        self.device_list.merge(devices)
+        self._update_placeholder()
+
+    def _remove_missing(self, present: set):
+        """完整扫描结束后移除已不在的设备"""
+        self.device_list.retain(present)
+        self._update_placeholder()
+
+    def _update_placeholder(self):
+        empty_text = "正在扫描设备..." if self._scan else "未检测到 USB 设备"
+        if empty_text != self.device_list.empty_text:
+            self.device_list.empty_text = empty_text
+            self.device_list.render()
 
     def _refresh_devices(self):
-        """手动刷新按钮调用"""
-        self._refresh_devices_async()
+        """手动刷新按钮调用，强制全量同步"""
+        self._refresh_devices_async(refresh=True)
 
     def _select_device(self, dev: USBDevice):
         self.vid_entry.delete(0, "end")
@@ -592,6 +4719,7 @@ class SettingsWindow(ctk.CTkToplevel):
         cfg = self.config_manager.config
         self.vid_entry.insert(0, cfg.device_vid)
         self.pid_entry.insert(0, cfg.device_pid)
+        self.device_var.set(f"{cfg.device_vid}&{cfg.device_pid}")
         self.countdown_var.set(str(cfg.countdown_seconds))
         self.autostart_var.set(AutoStartManager.is_enabled())
         self.unlock_on_reconnect_var.set(cfg.unlock_on_reconnect)
@@ -609,128 +4737,355 @@ class SettingsWindow(ctk.CTkToplevel):
             countdown = max(1, min(30, countdown))  # 限制在 1-30 之间
         except ValueError:
             countdown = 5
-        self.config_manager.update(
-            device_vid=vid,
-            device_pid=pid,
-            countdown_seconds=countdown,
-            auto_start=self.autostart_var.get(),
-            unlock_on_reconnect=self.unlock_on_reconnect_var.get()
-        )
+        try:
+            self.config_manager.update(
+                device_vid=vid,
+                device_pid=pid,
+                countdown_seconds=countdown,
+                auto_start=self.autostart_var.get(),
+                unlock_on_reconnect=self.unlock_on_reconnect_var.get()
+            )
+        except ConfigError as e:
+            self.save_status.configure(text=f"未保存: {e}")  # 窗口保持打开，改正后再保存
+            return
         AutoStartManager.set_enabled(self.autostart_var.get())
         if self.on_save_callback:
             self.on_save_callback()
-        self.destroy()
+        self.window.destroy()
+
+
+# ==================== 界面分派 ====================
+
+class TkDispatcher:
+    """把其他线程的事件和调用交给 Tk 主循环
+
+    生产者（核心事件循环、守护进程 watch 线程、托盘线程、键盘钩子线程）只往队列里追加，不触碰任何
+    Tk 对象；Tk 侧由一个 after 定时的 pump 每次取一批，合并冗余事件后依次分派。deque 的追加和弹出
+    是原子操作，生产者无需加锁。事件队列有上限：满时清空积压并安排一次 resync，由界面向核心查询
+    当前状态重建显示，而不是逐个重放过时的事件。
+    """
+    MAX_PENDING = 4096
+    BATCH_SIZE = 256
+    INTERVAL_MS = 50
+
+    def __init__(self, handler: Callable[[dict], None]):
+        self.handler = handler
+        self.root: Optional[tk.Tk] = None
+        self._events: deque = deque()
+        self._calls: deque = deque()
+        self.posted = 0
+        self.dispatched = 0
+        self.dropped = 0
+        self.batches = 0
+
+    def post(self, event: dict):
+        """任意线程调用：登记一个事件"""
+        self.posted += 1
+        if len(self._events) >= self.MAX_PENDING:
+            self.dropped += len(self._events)
+            self._events.clear()
+            event = {"event": "resync"}
+        self._events.append(event)
+
+    def call(self, func: Callable, *args):
+        """任意线程调用：在 Tk 线程上执行 func（不参与合并）"""
+        self._calls.append((func, args))
+
+    def attach(self, root: tk.Tk):
+        """根窗口就绪后开始分派，此前的事件保留在队列中"""
+        self.root = root
+        self.pump()
+
+    @staticmethod
+    def collapse(events: List[dict]) -> List[dict]:
+        """合并一批事件
+
+        同一批内开始又被取消或已锁屏的倒计时不再弹出；在位变化（removed/inserted）只保留最后一次；
+        reloaded/resync 只保留最后一次。
+        """
+        out: List[Optional[dict]] = []
+        last: Dict[str, int] = {}  # 可合并事件类别 -> 在 out 中的下标
+        for event in events:
+            name = event.get("event")
+            if name in ("cancelled", "locked", "flapping") and "countdown" in last:
+                out[last.pop("countdown")] = None
+                if name != "flapping":
+                    continue
+            kind = "presence" if name in ("removed", "inserted") else name
+            if kind in ("presence", "countdown", "reloaded", "resync"):
+                if kind in last:
+                    out[last[kind]] = None
+                last[kind] = len(out)
+            out.append(event)
+        return [event for event in out if event is not None]
+
+    def pump(self):
+        batch = []
+        while len(batch) < self.BATCH_SIZE:
+            try:
+                batch.append(self._events.popleft())
+            except IndexError:
+                break
+        events = self.collapse(batch)
+        self.batches += bool(batch)
+        self.dispatched += len(events)
+        for event in events:
+            try:
+                self.handler(event)
+            except Exception as e:
+                print(f"界面事件处理失败: {e}")
+        while self._calls:
+            func, args = self._calls.popleft()
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"界面调用失败: {e}")
+        # 仍有积压时立即继续，否则按固定间隔轮询
+        self.root.after(1 if self._events else self.INTERVAL_MS, self.pump)
 
 
 # ==================== 主应用 ====================
 
 class USBAutoLockerApp:
-    """主应用程序"""
+    """主应用程序
 
-    def __init__(self):
-        self.config_manager = ConfigManager()
-        self.usb_monitor = USBMonitor(self.config_manager)
+    回调全部在 Tk 线程上执行：核心（或守护进程）的事件、托盘菜单和键盘钩子都经 TkDispatcher 转入。
+    """
+
+    def __init__(self, config_manager: Optional[ConfigManager] = None, usb_monitor: Optional[USBMonitor] = None,
+                 daemon_client: Optional[DaemonClient] = None):
+        self.config_manager = config_manager or ConfigManager()
+        self.daemon_client = daemon_client
+        self.core: Optional[AsyncCore] = None
+        if daemon_client:
+            usb_monitor = usb_monitor or DaemonMonitor(daemon_client)
+        else:
+            # 监控、倒计时截止与锁屏在核心的事件循环上运行，界面只负责显示
+            self.core = AsyncCore(self.config_manager, usb_monitor, control=False)
+            usb_monitor = CoreMonitor(self.core)
+        self.usb_monitor: EventStreamMonitor = usb_monitor
         self.root: Optional[tk.Tk] = None
         self.tray_manager: Optional[TrayIconManager] = None
+        self.popup_factory: Callable[..., CountdownPopup] = CountdownPopup
+        self.popup_window: Optional[PopupWindow] = None
         self.countdown_popup: Optional[CountdownPopup] = None
         self.settings_window: Optional[SettingsWindow] = None
         self.is_enabled = True
-        self.last_shift_time = 0
-        self.keyboard_listener = keyboard.Listener(on_release=self._on_key_release)
-        self.keyboard_listener.start()
+        self.dispatcher = TkDispatcher(self.usb_monitor.handle)
+        self.cancel_hook = ShiftCancelHook(lambda: self.dispatcher.call(self._on_double_shift))
 
-    def _on_key_release(self, key):
+    def _on_double_shift(self):
         if not self.countdown_popup or not self.countdown_popup.is_showing:
             return
-        if key in (keyboard.Key.shift_l, keyboard.Key.shift_r):
-            now = time.time()
-            if now - self.last_shift_time < 0.5:
-                self.countdown_popup.cancel()
-            self.last_shift_time = now
+        self.countdown_popup.cancel()
+        if self.core:
+            self.core.call(self.core.cancel_countdown, "keyboard")
+        else:
+            self._send_to_daemon("cancel")
 
-    def _execute_lock(self):
-        """执行系统锁屏"""
-        print("执行锁屏...")
+    def _send_to_daemon(self, cmd: str) -> dict:
+        """发送控制命令给守护进程，或交给同进程的核心执行"""
+        if self.core:
+            return self.core.call(self.core.handle_command, cmd)
         try:
-            # 使用 ctypes 直接调用 Windows API（更可靠）
-            ctypes.windll.user32.LockWorkStation()
-        except Exception as e:
-            print(f"锁屏失败: {e}")
-            # 备用方案
-            subprocess.run("rundll32.exe user32.dll,LockWorkStation", shell=True)
+            return self.daemon_client.send(cmd)
+        except (OSError, ValueError) as e:
+            print(f"守护进程通信失败: {e}")
+            return {"ok": False, "error": str(e)}
 
     def _on_device_removed(self):
-        """设备拔出回调"""
+        """核心开始倒计时：显示倒计时弹窗"""
         if not self.is_enabled:
             print("自动锁屏已禁用，跳过")
             return
-        # 如果已经在倒计时中，不重复触发
-        if self.countdown_popup and self.countdown_popup.is_showing:
-            print("已在倒计时中，跳过")
-            return
-        print(f"触发锁屏倒计时 ({self.config_manager.config.countdown_seconds}秒)...")
-        self.countdown_popup = CountdownPopup(self.root, self.config_manager.config.countdown_seconds, on_complete=self._execute_lock)
-        self.root.after(0, self.countdown_popup.show)
+        self._show_countdown(self.config_manager.config.countdown_seconds)
+
+    def _show_countdown(self, seconds: int):
+        popup = self.countdown_popup
+        if popup and popup.is_showing:
+            if not popup.cancelled:
+                print("已在倒计时中，跳过")
+                return
+            popup.close()  # 上一次倒计时的"已取消"提示还在显示
+        self.countdown_popup = self.popup_factory(self.root, seconds, key_hook=self.cancel_hook,
+                                                  window=self.popup_window)
+        self.countdown_popup.show()
 
     def _on_device_inserted(self):
-        """设备插入回调"""
-        # 根据配置决定是否在设备插入时取消锁屏
-        if self.config_manager.config.unlock_on_reconnect:
-            if self.countdown_popup and self.countdown_popup.is_showing:
-                print("设备重新插入，取消锁屏倒计时")
-                self.countdown_popup.cancel()
+        """设备插入回调（倒计时由核心取消，随后收到 cancelled 事件）"""
         if self.tray_manager:
             self.tray_manager.notify("USB 密钥已插入", "设备状态")
 
+    def _on_device_flapping(self):
+        """密钥频繁插拔：核心已立即锁屏，结束正在显示的倒计时"""
+        popup = self.countdown_popup
+        if popup and popup.is_showing and not popup.cancelled:
+            popup.expire()
+
+    def _on_config_reloaded(self):
+        """配置文件被外部工具替换，核心已就地应用"""
+        self.config_manager.check_reload(notify=False)  # 客户端模式下本进程的配置也要跟上
+        self.is_enabled = self.config_manager.config.enabled
+        if self.tray_manager:
+            self.tray_manager.update_icon()
+            self.tray_manager.notify("配置文件已更新并生效", "设置")
+
     def _toggle_enable(self):
         self.is_enabled = not self.is_enabled
-        self.config_manager.update(enabled=self.is_enabled)
+        self._send_to_daemon("enable" if self.is_enabled else "disable")
         if self.tray_manager:
+            self.tray_manager.update_icon()
             self.tray_manager.notify(f"自动锁屏{'已启用' if self.is_enabled else '已禁用'}", "状态")
 
     def _open_settings(self):
         if self.settings_window:
             try:
-                if self.settings_window.winfo_exists():
+                if self.settings_window.is_open:
                     # 窗口已存在，激活并置顶
-                    self.settings_window.deiconify()  # 如果最小化则恢复
-                    self.settings_window.lift()  # 提升到最前
-                    self.settings_window.focus_force()  # 强制获取焦点
+                    self.settings_window.activate()
                     return
             except Exception:
                 pass  # 窗口可能已销毁
             self.settings_window = None
-        self.root.after(0, self._create_settings)
+        self._create_settings()
 
     def _create_settings(self):
         def on_save():
-            self.usb_monitor.restart()
+            self.config_manager.flush()  # 客户端模式下守护进程要从文件读到新配置
+            self.usb_monitor.reconfigure()
             if self.tray_manager:
                 self.tray_manager.notify("配置已保存", "设置")
         self.settings_window = SettingsWindow(self.root, self.config_manager, on_save=on_save)
 
     def _quit(self):
         self.usb_monitor.stop()
+        self.config_manager.flush()
         if self.tray_manager:
             self.tray_manager.stop()
         if self.root:
             self.root.quit()
         os._exit(0)
 
-    def run(self):
-        self.root = tk.Tk()
-        self.root.withdraw()
+    def arm(self):
+        """启动设备监控，不加载任何 GUI 模块"""
         self.is_enabled = self.config_manager.config.enabled
         self.usb_monitor.on_device_removed = self._on_device_removed
         self.usb_monitor.on_device_inserted = self._on_device_inserted
+        self.usb_monitor.on_device_flapping = self._on_device_flapping
+        self.usb_monitor.on_countdown_cancelled = self._on_countdown_cancelled
+        self.usb_monitor.on_config_reloaded = self._on_config_reloaded
+        self.usb_monitor.on_resync = self._resync
+        self.usb_monitor.deliver = self.dispatcher.post  # GUI 就绪前的事件留在队列里
+        if self.daemon_client:
+            self.is_enabled = self._send_to_daemon("status").get("enabled", self.is_enabled)
         self.usb_monitor.start()
-        self.tray_manager = TrayIconManager(on_toggle=self._toggle_enable, on_settings=self._open_settings, on_quit=self._quit, is_enabled_getter=lambda: self.is_enabled)
+
+    def _on_countdown_cancelled(self):
+        """核心通知倒计时已被取消（重新插入、其他客户端或本机按键）"""
+        if self.countdown_popup and self.countdown_popup.is_showing:
+            self.countdown_popup.cancel()
+
+    def _resync(self):
+        """分派队列溢出后，按核心的当前状态重建显示"""
+        status = self._send_to_daemon("status")
+        if not status.get("ok"):
+            return
+        self.usb_monitor.device_present = status["device_present"]
+        self.is_enabled = status["enabled"]
+        remaining = status["countdown_remaining"]
+        popup = self.countdown_popup
+        showing = popup is not None and popup.is_showing and not popup.cancelled
+        if remaining is None and showing:
+            popup.cancel()
+        elif remaining is not None and not showing:
+            self._show_countdown(math.ceil(remaining))
+
+    def run(self):
+        self.arm()
+        self.root = tk.Tk()
+        self.root.withdraw()
+        self.popup_window = PopupWindow(self.root)
+        self.popup_window.start()  # 在分派事件之前构建好，第一次拔出就能直接显示
+        self.dispatcher.attach(self.root)
+        call = self.dispatcher.call
+        self.tray_manager = TrayIconManager(on_toggle=lambda: call(self._toggle_enable), on_settings=lambda: call(self._open_settings),
+                                            on_quit=lambda: call(self._quit), is_enabled_getter=lambda: self.is_enabled)
+        NotifyHook.sender = self.tray_manager.notify  # 锁屏前的 notify 动作改用托盘通知
         threading.Thread(target=self.tray_manager.create().run, daemon=True).start()
         self.root.mainloop()
 
 
-if __name__ == "__main__":
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="USB AutoLocker")
+    parser.add_argument("--daemon", action="store_true", help="以无界面守护进程运行（只包含设备监控和锁屏）")
+    parser.add_argument("--broker", action="store_true", help="以设备代理运行，供本机各会话（backend 设为 broker）共享设备事件源")
+    parser.add_argument("--ctl", choices=CONTROL_COMMANDS[:-1], help="向运行中的守护进程发送控制命令")
+    parser.add_argument("--config", default=CONFIG_FILE, help="配置文件路径")
+    parser.add_argument("--replay", metavar="TRACE", help="回放事件追踪文件（锁屏动作不执行）并输出判定")
+    parser.add_argument("--speed", type=float, default=0.0, help="回放速度，0 为尽快回放，1 为原速")
+    parser.add_argument("--audit", action="store_true", help="查询审计日志（可配合 --since/--until/--event/--user）")
+    parser.add_argument("--since", help="审计查询起始时间：ISO 日期/时间，或相对时间如 7d、12h")
+    parser.add_argument("--until", help="审计查询结束时间，格式同 --since")
+    parser.add_argument("--event", help="审计查询的事件类型，逗号分隔，如 removed,cancelled")
+    parser.add_argument("--user", help="审计查询的用户名")
+    parser.add_argument("--json", action="store_true", help="审计查询结果按 JSON 行输出")
+    args = parser.parse_args(argv)
+
+    if args.replay:
+        result = replay_trace(args.replay, speed=args.speed)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        sys.exit(1 if result["mismatches"] else 0)
+
+    config_manager = ConfigManager(args.config)
+    if args.audit:
+        if not config_manager.config.audit_dir:
+            print("审计日志未启用，请在 config.json 中设置 audit_dir（如 \"audit\"）")
+            sys.exit(2)
+        try:
+            since = parse_time_arg(args.since) if args.since else None
+            until = parse_time_arg(args.until) if args.until else None
+        except ValueError as e:
+            print(f"无法解析时间: {e}")
+            sys.exit(2)
+        events = [e.strip() for e in args.event.split(",") if e.strip()] if args.event else None
+        count = 0
+        for record in AuditLog.query(AuditLog.directory_for(config_manager), since, until, events, args.user):
+            count += 1
+            if args.json:
+                print(json.dumps(record, ensure_ascii=False))
+                continue
+            extra = " ".join(f"{k}={v}" for k, v in record.items() if k not in ("time", "event", "user", "host"))
+            stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record["time"]))
+            print(f"{stamp}  {record['event']:<10} {record.get('user', '')}@{record.get('host', '')}  {extra}".rstrip())
+        if not args.json:
+            print(f"共 {count} 条")
+        return
+
+    if args.ctl:
+        try:
+            print(json.dumps(DaemonClient(config_manager).send(args.ctl), ensure_ascii=False, indent=2))
+        except (OSError, ValueError) as e:
+            print(f"无法连接守护进程: {e}")
+            sys.exit(1)
+        return
+
+    if args.broker:
+        mutex = check_single_instance("USB_AutoLocker_Broker_Mutex")
+        DeviceBroker(config_manager).run()
+        return
+
+    if args.daemon:
+        mutex = check_single_instance("USB_AutoLocker_Daemon_Mutex")
+        AsyncCore(config_manager).run()
+        return
+
     mutex = check_single_instance()
     # 如果程序位置变化，自动更新自启动路径
     AutoStartManager.update_path_if_needed()
-    USBAutoLockerApp().run()
+    # 已有守护进程时 GUI 作为它的客户端运行，不再自行监控
+    client = DaemonClient(config_manager)
+    USBAutoLockerApp(config_manager, daemon_client=client if client.is_running() else None).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2762 @@
+"""
+USB AutoLocker 基准测试
+
+无需 USB 硬件和图形界面：通过 FakeBackend 向 USBMonitor 注入模拟设备事件，
+弹窗和锁屏动作以无界面的桩替代，可在 Linux 服务器上直接运行。
+
+用法:
+    python benchmark.py latency --runs 5000
+    python benchmark.py latency --baseline old-results.json --tolerance 0.25
+    python benchmark.py wmi-watch --idle 10
+    python benchmark.py inventory --devices 5000
+    python benchmark.py wmi-connections
+    python benchmark.py startup --budget-ms 300
+    python benchmark.py countdown --seconds 3 --stall-ms 300
+    python benchmark.py keyhook --keys-per-min 200 --countdowns 4
+    python benchmark.py flap --rate 50
+    python benchmark.py replay --hours 8
+    python benchmark.py metrics
+    python benchmark.py reconfig --pairs 200
+    python benchmark.py config --kills 30
+    python benchmark.py forward --events 2000 --outages 2
+    python benchmark.py core --cycles 500
+    python benchmark.py dispatch --cycles 5000
+    python benchmark.py storm --rate 10000 --budget-ms 50
+    python benchmark.py popup --runs 30 --busy 2
+    python benchmark.py scan --devices 300 --clicks 10
+    python benchmark.py devlist --sizes 100,1000,5000,20000
+    python benchmark.py lockpipe --runs 20 --deadline-ms 200
+    python benchmark.py broker --sessions 300 --stalled 10 --dead 50
+    python benchmark.py audit --days 180 --per-day 2000
+"""
+import argparse
+import asyncio
+import heapq
+import json
+import os
+import platform
+import queue
+import random
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager, redirect_stdout
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+import AutoLocker as al
+
+
+DEFAULT_OUTPUT = "benchmark-results.json"
+
+
+# ==================== 公共工具 ====================
+
+def percentile(sorted_samples: List[float], q: float) -> float:
+    """线性插值百分位，q 取 0-100"""
+    if not sorted_samples:
+        return 0.0
+    pos = (len(sorted_samples) - 1) * q / 100.0
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_samples) - 1)
+    return sorted_samples[lo] + (sorted_samples[hi] - sorted_samples[lo]) * (pos - lo)
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """把秒级样本汇总为毫秒统计"""
+    ordered = sorted(samples)
+    ms = 1000.0
+    return {
+        "count": len(ordered),
+        "mean_ms": (sum(ordered) / len(ordered) * ms) if ordered else 0.0,
+        "p50_ms": percentile(ordered, 50) * ms,
+        "p95_ms": percentile(ordered, 95) * ms,
+        "p99_ms": percentile(ordered, 99) * ms,
+        "max_ms": (ordered[-1] * ms) if ordered else 0.0,
+    }
+
+
+def print_table(title: str, stats: Dict[str, Dict[str, float]]):
+    print(f"\n{title}")
+    print(f"{'阶段':<18}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}")
+    for name, s in stats.items():
+        print(f"{name:<18}{s['p50_ms']:>10.3f}{s['p95_ms']:>10.3f}{s['p99_ms']:>10.3f}{s['max_ms']:>10.3f}")
+
+
+def write_results(path: str, name: str, payload: dict):
+    """把一项基准结果合并写入 JSON 文件（按基准名称分键）"""
+    data = {}
+    if os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, OSError):
+            data = {}
+    payload = dict(payload, python=platform.python_version(), platform=platform.platform(), timestamp=time.time())
+    data[name] = payload
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    print(f"\n结果已写入 {path}")
+
+
+def check_regression(baseline_path: str, name: str, stats: Dict[str, Dict[str, float]], tolerance: float) -> bool:
+    """与基线结果比较 p95，超过容差则返回 False"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f).get(name, {}).get("stages", {})
+    ok = True
+    for stage, s in stats.items():
+        old = baseline.get(stage)
+        if not old or old["p95_ms"] <= 0:
+            continue
+        limit = old["p95_ms"] * (1 + tolerance)
+        if s["p95_ms"] > limit:
+            print(f"回归: {stage} p95 {s['p95_ms']:.3f}ms > 基线 {old['p95_ms']:.3f}ms (+{tolerance:.0%})")
+            ok = False
+    return ok
+
+
+class HeadlessRoot:
+    """替代 tk.Tk 的无界面事件循环，只实现 after，在调用 run_until 的线程上执行回调"""
+
+    def __init__(self):
+        self._timers = []
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    def after(self, ms: int, func: Optional[Callable] = None, *args):
+        due = time.perf_counter() + ms / 1000.0
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._timers, (due, self._seq, func, args))
+            self._cond.notify()
+        return f"after#{self._seq}"
+
+    def run_until(self, predicate: Callable[[], bool], timeout: float = 5.0) -> bool:
+        deadline = time.perf_counter() + timeout
+        while not predicate():
+            with self._cond:
+                now = time.perf_counter()
+                if now >= deadline:
+                    return False
+                if not self._timers or self._timers[0][0] > now:
+                    wait = deadline - now
+                    if self._timers:
+                        wait = min(wait, self._timers[0][0] - now)
+                    self._cond.wait(wait)
+                    continue
+                _, _, func, args = heapq.heappop(self._timers)
+            if func:
+                func(*args)
+        return True
+
+
+class _NullWindow:
+    def destroy(self):
+        pass
+
+
+class HeadlessPopup(al.CountdownPopup):
+    """不创建窗口的倒计时弹窗，计时逻辑与正式版相同"""
+    marks: Dict[str, float] = {}
+
+    def show(self):
+        self.marks.setdefault("show", time.perf_counter())
+        super().show()
+
+    def _build_window(self):
+        self.popup = _NullWindow()
+
+    def _set_text(self, text: str, fg: Optional[str] = None):
+        pass
+
+    def _tick(self):
+        self.marks.setdefault("tick", time.perf_counter())
+        super()._tick()
+
+
+# ==================== WMI 替身 ====================
+
+class StandInWMI:
+    """替代 wmi 模块的进程内实现：设备实体表 + 事件订阅，统计连接创建和 watcher 唤醒次数"""
+
+    class x_wmi(Exception):
+        pass
+
+    class x_wmi_timed_out(x_wmi):
+        pass
+
+    def __init__(self, connect_cost: float = 0.0, entity_cost: float = 0.0):
+        self.connect_cost = connect_cost
+        self.entity_cost = entity_cost
+        self.entities: Dict[str, str] = {}  # DeviceID -> Name
+        self.connections = 0
+        self.queries = 0
+        self.wakeups = 0
+        self.generation = 0
+        self._watchers: List["_StandInWatcher"] = []
+        self._lock = threading.Lock()
+
+    def WMI(self, *args, **kwargs):
+        if not StandInPythoncom.initialized():
+            raise self.x_wmi("CoInitialize has not been called")
+        with self._lock:
+            self.connections += 1
+        if self.connect_cost:
+            time.sleep(self.connect_cost)
+        return _StandInConnection(self)
+
+    def restart_service(self):
+        """模拟 WMI 服务重启：之前的连接和订阅全部失效"""
+        self.generation += 1
+        for watcher in self._watchers:
+            watcher.events.put(None)
+        self._watchers = []
+
+    def add_entities(self, count: int, prefix: str = "USB"):
+        for i in range(count):
+            vid, pid = f"VID_{(i >> 16) & 0xFFFF:04X}", f"PID_{i & 0xFFFF:04X}"
+            self.entities[f"{prefix}\\{vid}&{pid}\\{i:08d}"] = f"模拟设备 {i}"
+
+    def emit(self, event_type: str, device_id: str):
+        """event_type 为 creation / deletion"""
+        if event_type == "creation":
+            self.entities[device_id] = "模拟设备"
+        else:
+            self.entities.pop(device_id, None)
+        event = SimpleNamespace(DeviceID=device_id, Name="模拟设备", event_type=event_type)
+        for watcher in list(self._watchers):
+            if event_type in watcher.classes and watcher.matches(device_id):
+                watcher.events.put(event)
+
+
+def like_to_regex(pattern: str):
+    """WQL LIKE 模式转正则（% 与 _ 通配）"""
+    parts = []
+    for ch in pattern:
+        parts.append(".*" if ch == "%" else "." if ch == "_" else re.escape(ch))
+    return re.compile("^" + "".join(parts) + "$", re.IGNORECASE)
+
+
+class _StandInWatcher:
+    def __init__(self, module: StandInWMI, wql: str):
+        self.module = module
+        self.generation = module.generation
+        self.events: "queue.Queue" = queue.Queue()
+        if "__InstanceOperationEvent" in wql:
+            self.classes = {"creation", "deletion"}
+        elif "__InstanceDeletionEvent" in wql:
+            self.classes = {"deletion"}
+        else:
+            self.classes = {"creation"}
+        match = re.search(r"DeviceID LIKE '([^']*)'", wql)
+        self._regex = like_to_regex(match.group(1)) if match else None
+
+    def matches(self, device_id: str) -> bool:
+        return self._regex is None or bool(self._regex.match(device_id))
+
+    def __call__(self, timeout_ms: int = -1):
+        try:
+            event = self.events.get(timeout=None if timeout_ms < 0 else timeout_ms / 1000.0)
+        except queue.Empty:
+            self.module.wakeups += 1
+            raise self.module.x_wmi_timed_out()
+        self.module.wakeups += 1
+        if event is None or self.generation != self.module.generation:
+            raise self.module.x_wmi("RPC 服务器不可用")
+        return event
+
+
+class _StandInConnection:
+    def __init__(self, module: StandInWMI):
+        self.module = module
+        self.generation = module.generation
+
+    def _check(self):
+        if self.generation != self.module.generation:
+            raise self.module.x_wmi("RPC 服务器不可用")
+
+    def watch_for(self, raw_wql: str = "", **kwargs):
+        self._check()
+        watcher = _StandInWatcher(self.module, raw_wql)
+        self.module._watchers.append(watcher)
+        return watcher
+
+    def _entity(self, device_id: str):
+        return _StandInEntity(self.module, device_id)
+
+    def Win32_PnPEntity(self, *args, **kwargs):
+        self._check()
+        self.module.queries += 1
+        return [self._entity(device_id) for device_id in list(self.module.entities)]
+
+    def query(self, wql: str):
+        self._check()
+        if "Win32_OperatingSystem" in wql:
+            return [SimpleNamespace(Caption="stand-in")]
+        self.module.queries += 1
+        match = re.search(r"DeviceID LIKE '([^']*)'", wql)
+        regex = like_to_regex(match.group(1)) if match else None
+        return [self._entity(d) for d in list(self.module.entities) if regex is None or regex.match(d)]
+
+
+class _StandInEntity:
+    """WMI 实体替身：与 wmi 模块一样，属性在首次读取时才经 COM 取回，此时付出模拟开销"""
+
+    def __init__(self, module: StandInWMI, device_id: str):
+        self._module = module
+        self._device_id = device_id
+        self._loaded = False
+
+    def __getattr__(self, name: str):
+        if name not in ("DeviceID", "Name", "Description"):
+            raise AttributeError(name)
+        if not self._loaded:
+            self._loaded = True
+            if self._module.entity_cost:
+                time.sleep(self._module.entity_cost)
+        return self._device_id if name == "DeviceID" else self._module.entities.get(self._device_id)
+
+
+class StandInPythoncom:
+    """按线程记录 CoInitialize；与 pythoncom 一样，导入它的主线程自动完成初始化"""
+    _local = threading.local()
+
+    @classmethod
+    def CoInitialize(cls):
+        cls._local.depth = getattr(cls._local, "depth", 0) + 1
+
+    @classmethod
+    def CoUninitialize(cls):
+        cls._local.depth = getattr(cls._local, "depth", 0) - 1
+
+    @classmethod
+    def initialized(cls) -> bool:
+        return threading.current_thread() is threading.main_thread() or getattr(cls._local, "depth", 0) > 0
+
+
+@contextmanager
+def standin_wmi(module: StandInWMI):
+    """临时把 AutoLocker 使用的 wmi/pythoncom 替换为替身"""
+    saved = al.wmi, al.pythoncom
+    al.wmi, al.pythoncom = module, StandInPythoncom
+    try:
+        yield module
+    finally:
+        al.wmi, al.pythoncom = saved
+
+
+class LegacyWMIBackend(al.WMIBackend):
+    """对照组：旧版 _monitor_loop 的两个 watcher 交替 100 ms 超时"""
+
+    def open(self, config: al.AppConfig) -> None:
+        if not self._com_ready:  # 旧版监控线程同样先 CoInitialize
+            al.com_initialize()
+            self._com_ready = True
+        c = al.wmi.WMI()
+        pattern = config.get_device_id_pattern()
+        self.watchers = []
+        for action, event_class in (("remove", "__InstanceDeletionEvent"), ("add", "__InstanceCreationEvent")):
+            wql = f"SELECT * FROM {event_class} WITHIN 1 WHERE TargetInstance ISA 'Win32_PnPEntity' AND TargetInstance.DeviceID LIKE '{pattern}'"
+            self.watchers.append((action, c.watch_for(raw_wql=wql)))
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[al.DeviceEvent]:
+        for action, watcher in self.watchers:
+            try:
+                event = watcher(timeout_ms=100)
+            except al.wmi.x_wmi_timed_out:
+                continue
+            if event:
+                return al.DeviceEvent.from_device_id(action, event.DeviceID or "")
+        return None
+
+
+# ==================== WMI 订阅唤醒次数 ====================
+
+def bench_wmi_watch(args) -> int:
+    """比较旧版交替 watcher 与合并订阅的空闲唤醒次数和检测延迟"""
+    vid, pid = "VID_1050", "PID_0407"
+    device_id = f"USB\\{vid}&{pid}\\0001"
+    results = {}
+    for label, backend_cls in (("legacy", LegacyWMIBackend), ("merged", al.WMIBackend)):
+        module = StandInWMI()
+        module.entities[device_id] = "YubiKey"
+        config_manager = al.ConfigManager(os.path.join(tempfile.mkdtemp(), "config.json"))
+        config_manager.config.device_vid, config_manager.config.device_pid = vid, pid
+        config_manager.config.insert_debounce_ms, config_manager.config.flap_limit = 0, 0  # 反复插拔是测量手段，不是抖动
+        removed, inserted = threading.Event(), threading.Event()
+        marks: Dict[str, float] = {}
+        latencies: List[float] = []
+        with standin_wmi(module), open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+            monitor = al.USBMonitor(config_manager, backend=backend_cls())
+            monitor.on_device_removed = lambda: (marks.setdefault("removed", time.perf_counter()), removed.set())
+            monitor.on_device_inserted = inserted.set
+            monitor.start()
+            time.sleep(0.2)
+            module.wakeups = 0
+            time.sleep(args.idle)
+            idle_wakeups = module.wakeups
+            for _ in range(args.runs):
+                time.sleep(random.uniform(0, 0.15))  # 打散事件与等待循环的相位
+                removed.clear()
+                inserted.clear()
+                marks.clear()
+                t0 = time.perf_counter()
+                module.emit("deletion", device_id)
+                if removed.wait(2.0):
+                    latencies.append(marks["removed"] - t0)
+                module.emit("creation", device_id)
+                inserted.wait(2.0)
+            monitor.stop()
+        stats = summarize(latencies)
+        results[label] = {"wakeups_per_minute": idle_wakeups * 60.0 / args.idle, "detect": stats, "detected": len(latencies)}
+    print(f"\n{'实现':<10}{'空闲唤醒/分钟':>16}{'p50(ms)':>10}{'p99(ms)':>10}{'最坏(ms)':>10}")
+    for label, r in results.items():
+        d = r["detect"]
+        print(f"{label:<10}{r['wakeups_per_minute']:>16.1f}{d['p50_ms']:>10.3f}{d['p99_ms']:>10.3f}{d['max_ms']:>10.3f}")
+    ok = all(r["detected"] == args.runs for r in results.values())  # 任一实现漏检（如监听未能启动）时数字没有意义
+    if not ok:
+        print("有拔出未被检测到: " + "，".join(f"{label} {r['detected']}/{args.runs}" for label, r in results.items()))
+    write_results(args.output, "wmi_watch", {"idle_seconds": args.idle, "runs": args.runs, "backends": results, "passed": ok})
+    return 0 if ok else 1
+
+
+# ==================== 拔出到锁屏延迟 ====================
+
+LATENCY_STAGES = ("detect", "lock", "ui", "total")
+
+
+def bench_latency(args) -> int:
+    """注入拔出事件，测量 FakeBackend → AsyncCore 判定 → 锁屏动作，以及事件经 TkDispatcher 到达 Tk 线程的延迟"""
+    vid, pid = "VID_1050", "PID_0407"
+    config_manager = al.ConfigManager(os.path.join(tempfile.mkdtemp(), "config.json"))
+    config_manager.config.device_vid, config_manager.config.device_pid = vid, pid
+    config_manager.config.countdown_seconds = 0  # 只测量流水线本身的开销
+    config_manager.config.insert_debounce_ms, config_manager.config.flap_limit = 0, 0  # 反复插拔是测量手段，不是抖动
+
+    backend = al.FakeBackend(present=[f"{vid}&{pid}"])
+    monitor = al.USBMonitor(config_manager, backend=backend)
+    app = al.USBAutoLockerApp(config_manager=config_manager, usb_monitor=monitor)
+    core = app.core
+    app.root = HeadlessRoot()
+    app.popup_factory = HeadlessPopup
+    marks = HeadlessPopup.marks
+    inserted = threading.Event()
+    core.lock_action = lambda: marks.setdefault("lock", time.perf_counter())
+
+    def on_removed():
+        marks.setdefault("detect", time.perf_counter())
+        core._on_device_removed()
+
+    def on_inserted():
+        core._on_device_inserted()
+        inserted.set()
+
+    def on_ui_event(event: dict):
+        if event.get("event") == "removed":
+            marks.setdefault("ui", time.perf_counter())
+        handle(event)
+
+    handle, app.dispatcher.handler = app.dispatcher.handler, on_ui_event
+
+    samples: Dict[str, List[float]] = {stage: [] for stage in LATENCY_STAGES}
+    timeouts = 0
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+        app.arm()
+        monitor.on_device_removed = on_removed
+        monitor.on_device_inserted = on_inserted
+        app.dispatcher.attach(app.root)
+        try:
+            for i in range(args.warmup + args.runs):
+                marks.clear()
+                inserted.clear()
+                t0 = time.perf_counter()
+                backend.inject("remove", vid, pid)
+                if not app.root.run_until(lambda: "lock" in marks and "ui" in marks, timeout=5.0):
+                    timeouts += 1
+                elif i >= args.warmup:
+                    samples["detect"].append(marks["detect"] - t0)
+                    samples["lock"].append(marks["lock"] - marks["detect"])
+                    samples["ui"].append(marks["ui"] - marks["detect"])
+                    samples["total"].append(marks["lock"] - t0)
+                backend.inject("add", vid, pid)
+                app.root.run_until(inserted.is_set, timeout=5.0)
+        finally:
+            app.usb_monitor.stop()
+
+    stats = {stage: summarize(values) for stage, values in samples.items()}
+    print_table(f"拔出到锁屏延迟 ({args.runs} 次, 预热 {args.warmup} 次, 超时 {timeouts} 次)", stats)
+    print(f"ui 为核心判定到事件在 Tk 线程上分派，包含最长 {app.dispatcher.INTERVAL_MS} ms 的分派间隔，不影响锁屏")
+    write_results(args.output, "latency", {"runs": args.runs, "warmup": args.warmup, "timeouts": timeouts, "stages": stats})
+    if args.baseline and not check_regression(args.baseline, "latency", stats, args.tolerance):
+        return 1
+    return 1 if timeouts else 0
+
+
+# ==================== 设备清单缓存 ====================
+
+def _time_calls(func: Callable, count: int) -> List[float]:
+    samples = []
+    for _ in range(count):
+        t0 = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+def bench_inventory(args) -> int:
+    """比较全量 WMI 枚举与事件维护的清单缓存的查询耗时"""
+    module = StandInWMI(entity_cost=args.entity_cost / 1e6)
+    module.add_entities(args.devices)
+    module.add_entities(args.devices, prefix="HID")  # 非 USB 实体，同样要被枚举
+    target = next(iter(module.entities))
+    vid, pid = al.USBScanner.parse_vid_pid(target)
+    inventory = al.USBScanner.inventory
+    with standin_wmi(module):
+        cold_scan = _time_calls(lambda: al.USBScanner.scan_devices(refresh=True), args.cold_runs)
+        inventory.tracking = True
+        try:
+            cached_scan = _time_calls(al.USBScanner.scan_devices, args.lookups)
+            cached_find = _time_calls(lambda: al.USBScanner.find_device(vid, pid), args.lookups)
+            event = al.DeviceEvent(action="add", device_id="USB\\VID_FFFF&PID_FFFF\\NEW", vid="VID_FFFF", pid="PID_FFFF")
+            apply_event = _time_calls(lambda: inventory.apply(event.action, event.to_device()), args.lookups)
+            scan_after_change = _time_calls(lambda: (inventory.apply(event.action, event.to_device()), al.USBScanner.scan_devices()), args.cold_runs)
+        finally:
+            inventory.tracking = False
+            inventory.invalidate()
+    stats = {
+        "cold_scan": summarize(cold_scan),
+        "cached_scan": summarize(cached_scan),
+        "cached_find": summarize(cached_find),
+        "apply_event": summarize(apply_event),
+        "scan_after_change": summarize(scan_after_change),
+    }
+    print_table(f"设备清单 ({args.devices} 个 USB 实体 + {args.devices} 个其他实体, 每实体 {args.entity_cost}µs)", stats)
+    write_results(args.output, "inventory", {"devices": args.devices, "entity_cost_us": args.entity_cost, "stages": stats})
+    return 0
+
+
+# ==================== WMI 连接复用 ====================
+
+def bench_wmi_connections(args) -> int:
+    """统计启动、设置窗口扫描和在位检查创建的 WMI 连接数，并验证服务重启后自动重连"""
+    vid, pid = "VID_1050", "PID_0407"
+    device_id = f"USB\\{vid}&{pid}\\0001"
+    module = StandInWMI(connect_cost=args.connect_cost / 1000.0)
+    module.add_entities(200)
+    module.entities[device_id] = "YubiKey"
+    config_manager = al.ConfigManager(os.path.join(tempfile.mkdtemp(), "config.json"))
+    config_manager.config.device_vid, config_manager.config.device_pid = vid, pid
+    removed = threading.Event()
+    timings: Dict[str, List[float]] = {"startup": [], "scan": [], "presence": []}
+    calls = 0
+    with standin_wmi(module), open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+        monitor = al.USBMonitor(config_manager, backend=al.WMIBackend())
+        monitor.on_device_removed = removed.set
+        t0 = time.perf_counter()
+        monitor.start()
+        timings["startup"].append(time.perf_counter() - t0)
+        calls += 2  # 启动时的在位检查 + 监控线程订阅
+        for _ in range(args.scans):
+            t0 = time.perf_counter()
+            al.USBScanner.submit_scan(refresh=True).result()
+            timings["scan"].append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            monitor.check_device_presence()
+            timings["presence"].append(time.perf_counter() - t0)
+            calls += 2
+        before_restart = module.connections
+
+        module.restart_service()
+        al.USBScanner.submit_scan(refresh=True).result()
+        monitor.check_device_presence()
+        deadline = time.perf_counter() + 10
+        while module.connections < before_restart + 3 and time.perf_counter() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.2)
+        module.emit("deletion", device_id)
+        detected_after_restart = removed.wait(5.0)
+        monitor.stop()
+        module.emit("creation", device_id)
+        core_checks = _wmi_core_checks(module, config_manager, device_id)
+
+    print(f"\n调用次数 {calls}（旧实现每次调用新建一条连接，连接耗时 {args.connect_cost}ms）")
+    print(f"重启前创建连接: {before_restart}")
+    print(f"重启后累计连接: {module.connections}，重连次数 {al.WMI_CONNECTIONS.reconnects}")
+    print(f"服务重启后仍能检测拔出: {'是' if detected_after_restart else '否'}")
+    for name, passed in core_checks.items():
+        print(f"  {name:<34}{'通过' if passed else '失败'}")
+    stats = {name: summarize(values) for name, values in timings.items()}
+    print_table("各调用点耗时", stats)
+    write_results(args.output, "wmi_connections", {
+        "calls": calls, "connections_before_restart": before_restart, "connections_total": module.connections,
+        "connect_cost_ms": args.connect_cost, "detected_after_restart": detected_after_restart, "stages": stats,
+        "core_checks": core_checks,
+    })
+    return 0 if detected_after_restart and before_restart <= 3 and all(core_checks.values()) else 1
+
+
+def _wmi_core_checks(module: StandInWMI, config_manager: al.ConfigManager, device_id: str) -> Dict[str, bool]:
+    """事件循环线程与代理线程上的 WMI 调用（替身在未 CoInitialize 的线程上拒绝连接）"""
+    results = {}
+    config_manager.config.countdown_seconds = 0
+    locks: List[float] = []
+    core = al.AsyncCore(config_manager, al.USBMonitor(config_manager, backend=al.WMIBackend()),
+                        lock_action=lambda: locks.append(time.monotonic()), control=False)
+    core.start()
+    try:
+        results["core_presence_on_loop_thread"] = core.call(lambda: core.usb_monitor.device_present)
+        core.call(core.usb_monitor.reconfigure)
+        results["core_reconfigure_on_loop_thread"] = core.call(lambda: core.usb_monitor.device_present)
+        time.sleep(0.2)
+        module.emit("deletion", device_id)
+        results["core_locks_on_removal"] = _wait_for(lambda: bool(locks), 5.0)
+    finally:
+        core.stop()
+    module.emit("creation", device_id)
+    broker = al.DeviceBroker(_core_config(broker_port=0), backend=al.WMIBackend())
+    broker.start()
+    try:
+        vid, pid = al.USBScanner.parse_vid_pid(device_id)
+        backend = al.BrokerBackend()
+        backend.port = broker.port
+        results["broker_query_on_loop_thread"] = backend.find_instances(vid, pid) == [device_id]
+    finally:
+        broker.stop()
+    return results
+
+
+# ==================== 启动耗时 ====================
+
+STARTUP_CHILD = r"""
+import json, os, sys, tempfile, time
+sys.path.insert(0, {repo!r})
+t0 = time.perf_counter()
+import AutoLocker as al
+t_import = time.perf_counter()
+config_manager = al.ConfigManager(os.path.join(tempfile.mkdtemp(), "config.json"))
+backend = al.FakeBackend(present=["VID_1050&PID_0407"]) if {backend!r} == "fake" else al.create_backend({backend!r})
+app = al.USBAutoLockerApp(config_manager=config_manager, usb_monitor=al.USBMonitor(config_manager, backend=backend))
+app.arm()
+t_armed = time.perf_counter()
+wall_armed = time.time()
+gui_loaded = [m for m in al.GUI_MODULES if m in sys.modules]
+app.usb_monitor.stop()
+t_gui = time.perf_counter()
+for name in ("tkinter", "customtkinter", "PIL.Image", "PIL.ImageDraw", "pystray", "pynput.keyboard"):
+    try:
+        __import__(name)
+    except Exception:
+        pass  # 无显示环境下 pystray/pynput 导入失败，只统计能导入的部分
+gui_import = time.perf_counter() - t_gui
+print(json.dumps({{"import": t_import - t0, "arm": t_armed - t_import, "wall_armed": wall_armed,
+                  "gui_loaded": gui_loaded, "gui_import": gui_import}}))
+"""
+
+
+def parse_importtime(stderr: str) -> Dict[str, Dict[str, int]]:
+    """解析 -X importtime 输出：模块名 -> self/cumulative 微秒"""
+    modules = {}
+    for line in stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)", line)
+        if match:
+            modules[match.group(4)] = {"self_us": int(match.group(1)), "cumulative_us": int(match.group(2)),
+                                       "depth": len(match.group(3)) // 2}
+    return modules
+
+
+def bench_startup(args) -> int:
+    """用 python -X importtime 测量导入耗时，并测量从进程启动到监控就绪（time-to-armed）的时间"""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    script = STARTUP_CHILD.format(repo=repo, backend=args.backend)
+    armed, imports, arms, gui_imports = [], [], [], []
+    importtime: Dict[str, List[int]] = {}
+    gui_loaded: List[str] = []
+    for _ in range(args.runs):
+        wall_start = time.time()
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", script], capture_output=True, text=True, cwd=repo)
+        if proc.returncode != 0:
+            print(proc.stderr[-2000:])
+            return 1
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        armed.append(result["wall_armed"] - wall_start)
+        imports.append(result["import"])
+        arms.append(result["arm"])
+        gui_imports.append(result["gui_import"])
+        gui_loaded = sorted(set(gui_loaded) | set(result["gui_loaded"]))
+        for name, entry in parse_importtime(proc.stderr).items():
+            importtime.setdefault(name, []).append(entry["cumulative_us"] if entry["depth"] == 0 else entry["self_us"])
+
+    stats = {
+        "time_to_armed": summarize(armed),
+        "import_autolocker": summarize(imports),
+        "arm_monitor": summarize(arms),
+        "gui_import": summarize(gui_imports),
+    }
+    print_table(f"启动耗时 ({args.runs} 次, 后端 {args.backend})", stats)
+    heaviest = sorted(((statistics.median(v), k) for k, v in importtime.items()), reverse=True)[:args.top]
+    print(f"\n导入耗时最高的模块（-X importtime 中位数）")
+    for us, name in heaviest:
+        print(f"  {name:<40}{us / 1000:>10.2f} ms")
+    print(f"\n就绪时已加载的 GUI 模块: {gui_loaded or '无'}")
+    median_armed_ms = statistics.median(armed) * 1000
+    write_results(args.output, "startup", {
+        "runs": args.runs, "backend": args.backend, "time_to_armed_ms": median_armed_ms, "gui_loaded_at_armed": gui_loaded,
+        "stages": stats, "heaviest_imports_ms": {name: us / 1000 for us, name in heaviest},
+    })
+    ok = not gui_loaded
+    if args.budget_ms is not None and median_armed_ms > args.budget_ms:
+        print(f"time-to-armed 中位数 {median_armed_ms:.1f}ms 超出预算 {args.budget_ms}ms")
+        ok = False
+    return 0 if ok else 1
+
+
+# ==================== 倒计时漂移 ====================
+
+class DriftPopup(al.CountdownPopup):
+    """无界面倒计时弹窗，用于测量锁屏时刻"""
+
+    def _build_window(self):
+        self.popup = _NullWindow()
+
+    def _set_text(self, text: str, fg: Optional[str] = None):
+        pass
+
+
+class LegacyDriftPopup(DriftPopup):
+    """对照组：旧版每秒重新 after(1000) 的倒计时"""
+
+    def show(self):
+        self.cancelled = False
+        self.deadline = time.monotonic() + self.countdown_seconds
+        self.remaining = self.countdown_seconds
+        self._build_window()
+        self._tick()
+
+    def _tick(self):
+        if not self.popup:
+            return
+        if self.remaining > 0:
+            self.remaining -= 1
+            self.root.after(1000, self._tick)
+        else:
+            self.close()
+            self.on_complete()
+
+
+def bench_countdown(args) -> int:
+    """Tk 循环周期性阻塞时的锁屏偏差：旧版弹窗自行计时，对照核心按截止时间锁屏并在流水线结束后记录的 lock_history"""
+    root = HeadlessRoot()
+
+    def stall():
+        time.sleep(args.stall_ms / 1000.0)
+        root.after(args.stall_every_ms, stall)
+
+    root.after(args.stall_every_ms, stall)
+    results = {}
+    timeout = args.seconds * 3 + 5
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+        drifts = []
+        for _ in range(args.runs):
+            done: List[float] = []
+            popup = LegacyDriftPopup(root, args.seconds, on_complete=lambda: done.append(time.monotonic()))
+            root.after(0, popup.show)
+            if root.run_until(lambda: bool(done), timeout=timeout):
+                drifts.append(done[0] - popup.deadline)
+        results["legacy"] = summarize(drifts)
+
+        # 锁屏动作耗时 hook_ms（相当于锁屏前动作），记录应在它之后
+        backend = al.FakeBackend(present=[f"{CORE_VID}&{CORE_PID}"])
+        config_manager = _core_config(countdown_seconds=args.seconds, insert_debounce_ms=0, flap_limit=0)
+        core = al.AsyncCore(config_manager, al.USBMonitor(config_manager, backend=backend),
+                            lock_action=lambda: time.sleep(args.hook_ms / 1000.0), control=False)
+        core.start()
+        try:
+            for i in range(args.runs):
+                backend.inject("remove", CORE_VID, CORE_PID)
+                root.run_until(lambda: len(core.lock_history) > i, timeout=timeout)
+                backend.inject("add", CORE_VID, CORE_PID)
+                root.run_until(lambda: core.usb_monitor.device_present, timeout=5.0)
+            history = core.call(core.status)["lock_history"]
+        finally:
+            core.stop()
+        results["deadline"] = summarize([record["actual"] - record["scheduled"] for record in history])
+    print_table(f"锁屏时刻偏差（{args.seconds}s 倒计时，Tk 循环每 {args.stall_every_ms}ms 阻塞 {args.stall_ms}ms，"
+                f"锁屏动作 {args.hook_ms:g}ms）", results)
+    deadline = results["deadline"]
+    ok = (deadline["count"] == args.runs and deadline["p50_ms"] >= args.hook_ms
+          and deadline["max_ms"] <= args.hook_ms + args.tolerance_ms)
+    write_results(args.output, "countdown", {"seconds": args.seconds, "stall_ms": args.stall_ms,
+                                              "stall_every_ms": args.stall_every_ms, "hook_ms": args.hook_ms,
+                                              "stages": results, "passed": ok})
+    return 0 if ok else 1
+
+
+# ==================== 键盘钩子 ====================
+
+class _StandInListener:
+    """替代 pynput.keyboard.Listener：只记录启停次数"""
+    started = 0
+
+    def __init__(self, on_release=None):
+        self.on_release = on_release
+
+    def start(self):
+        type(self).started += 1
+
+    def stop(self):
+        pass
+
+
+STANDIN_KEYBOARD = SimpleNamespace(Key=SimpleNamespace(shift_l="shift_l", shift_r="shift_r"), Listener=_StandInListener)
+
+
+class LegacyKeyHook:
+    """对照组：旧版常驻钩子，每次按键都进入回调，再判断是否在倒计时中"""
+
+    def __init__(self):
+        self.showing = False
+        self.last_shift_time = 0.0
+        self.callbacks = 0
+
+    def on_release(self, key):
+        self.callbacks += 1
+        if not self.showing:
+            return
+        if key in (al.keyboard.Key.shift_l, al.keyboard.Key.shift_r):
+            now = time.time()
+            if now - self.last_shift_time < 0.5:
+                pass
+            self.last_shift_time = now
+
+
+def bench_keyhook(args) -> int:
+    """模拟一小时的键盘输入，比较常驻钩子与仅倒计时期间安装钩子的回调次数和开销"""
+    rng = random.Random(args.seed)
+    keys = ["a", "e", "space", "shift_l", "enter", "backspace"]
+    stream = sorted((rng.uniform(0, 3600), rng.choice(keys)) for _ in range(args.keys_per_min * 60))
+    step = 3600 / (args.countdowns + 1)
+    windows = [(step * (i + 1), step * (i + 1) + args.seconds) for i in range(args.countdowns)]
+
+    def in_countdown(t: float) -> bool:
+        return any(start <= t < end for start, end in windows)
+
+    saved = al.keyboard
+    al.keyboard = STANDIN_KEYBOARD
+    try:
+        flags = [(in_countdown(ts), key) for ts, key in stream]
+        legacy = LegacyKeyHook()
+        t0 = time.perf_counter()
+        for showing, key in flags:
+            legacy.showing = showing
+            legacy.on_release(key)
+        legacy_cost = time.perf_counter() - t0
+
+        # 新方式：只有倒计时窗口内的按键才会到达回调，安装和卸载各在窗口边界发生一次
+        _StandInListener.started = 0
+        hook = al.ShiftCancelHook(lambda: None)
+        armed_keys = [key for showing, key in flags if showing]
+        t0 = time.perf_counter()
+        for _ in windows:
+            hook.arm()
+            hook.disarm()
+        for key in armed_keys:
+            hook._on_key_release(key)
+        new_cost = time.perf_counter() - t0
+    finally:
+        al.keyboard = saved
+
+    # 钩子对按下和松开都会回调，pynput 在调用我们之前还要解码按键，这部分开销与回调次数成正比
+    rows = {
+        "常驻钩子": {"callbacks_per_hour": legacy.callbacks, "hook_events_per_hour": legacy.callbacks * 2,
+                     "ns_per_keystroke": legacy_cost / len(stream) * 1e9, "listener_starts": 1},
+        "倒计时期间": {"callbacks_per_hour": hook.callbacks, "hook_events_per_hour": hook.callbacks * 2,
+                      "ns_per_keystroke": new_cost / len(stream) * 1e9, "listener_starts": _StandInListener.started},
+    }
+    print(f"一小时 {len(stream)} 次按键，{args.countdowns} 次 {args.seconds}s 倒计时")
+    print(f"{'方式':<12}{'回调/小时':>12}{'钩子事件/小时':>16}{'ns/按键':>12}{'安装次数':>10}")
+    for name, row in rows.items():
+        print(f"{name:<12}{row['callbacks_per_hour']:>12}{row['hook_events_per_hour']:>16}"
+              f"{row['ns_per_keystroke']:>12.1f}{row['listener_starts']:>10}")
+    print("\n注：ns/按键 只含本程序回调；操作系统钩子与 pynput 分发的开销按钩子事件数等比例发生。")
+    write_results(args.output, "keyhook", {"keys": len(stream), "countdowns": args.countdowns,
+                                            "seconds": args.seconds, "modes": rows})
+    return 0
+
+
+# ==================== 去抖与抖动检测 ====================
+
+# (名称, 原始采样 [(时间, 是否在位)], 状态机参数, 期望输出 [(时间, 动作)])
+FLAP_SCENARIOS = [
+    ("真实拔出", [(0.0, False)], {}, [(0.0, "removed")]),
+    ("拔出后插回", [(0.0, False), (2.0, True)], {}, [(0.0, "removed"), (2.3, "inserted")]),
+    ("插入期间抖动", [(0.0, False), (1.0, True), (1.1, False), (1.2, True)], {},
+     [(0.0, "removed"), (1.5, "inserted")]),
+    ("拔出去抖吸收闪断", [(0.0, False), (0.05, True)], {"remove_debounce": 0.2}, []),
+    ("拔出去抖后生效", [(0.0, False)], {"remove_debounce": 0.2}, [(0.2, "removed")]),
+    ("频繁插拔升级", [(t, p) for i in range(4) for t, p in ((i * 1.0, False), (i * 1.0 + 0.5, True))], {},
+     [(0.0, "removed"), (0.8, "inserted"), (1.0, "removed"), (1.8, "inserted"), (2.0, "removed"),
+      (2.8, "inserted"), (3.0, "flapping"), (3.8, "inserted")]),
+    ("升级后不重复", [(t, p) for i in range(8) for t, p in ((i * 0.1, False), (i * 0.1 + 0.05, True))], {},
+     [(0.0, "removed"), (0.3, "flapping"), (1.05, "inserted")]),
+    ("窗口外不升级", [(t, p) for i in range(4) for t, p in ((i * 5.0, False), (i * 5.0 + 0.5, True))], {},
+     [(t, a) for i in range(4) for t, a in ((i * 5.0, "removed"), (i * 5.0 + 0.8, "inserted"))]),
+]
+
+
+def _same_actions(got: List[tuple], expected: List[tuple]) -> bool:
+    return len(got) == len(expected) and all(a == b and abs(t - u) < 1e-9 for (t, a), (u, b) in zip(got, expected))
+
+
+def bench_flap(args) -> int:
+    """回放固定事件序列检查状态机输出，再以高速率抖动驱动 USBMonitor，统计回调次数和真实拔出的检测延迟"""
+    failures = 0
+    print("场景回放:")
+    for name, samples, params, expected in FLAP_SCENARIOS:
+        got = al.PresenceStateMachine.replay(samples, **params)
+        ok = _same_actions(got, expected)
+        failures += not ok
+        print(f"  {'通过' if ok else '失败'}  {name}" + ("" if ok else f"\n      期望 {expected}\n      实际 {got}"))
+
+    # 状态机本身的吞吐
+    rng = random.Random(args.seed)
+    samples, now, present = [], 0.0, True
+    for _ in range(args.events):
+        now += rng.expovariate(args.rate)
+        present = not present
+        samples.append((now, present))
+    t0 = time.perf_counter()
+    al.PresenceStateMachine.replay(samples)
+    per_event_us = (time.perf_counter() - t0) / len(samples) * 1e6
+
+    # 通过 USBMonitor + FakeBackend：抖动 burst 之后真实拔出
+    vid, pid = "VID_1050", "PID_0407"
+    config_manager = al.ConfigManager(os.path.join(tempfile.mkdtemp(), "config.json"))
+    config_manager.config.device_vid, config_manager.config.device_pid = vid, pid
+    backend = al.FakeBackend(present=[f"{vid}&{pid}"])
+    monitor = al.USBMonitor(config_manager, backend=backend)
+    counts = {"removed": 0, "inserted": 0, "flapping": 0}
+    removed = threading.Event()
+    marks: Dict[str, float] = {}
+
+    def on_removed():
+        counts["removed"] += 1
+        marks.setdefault("removed", time.perf_counter())
+        removed.set()
+
+    monitor.on_device_removed = on_removed
+    monitor.on_device_inserted = lambda: counts.__setitem__("inserted", counts["inserted"] + 1)
+    monitor.on_device_flapping = lambda: counts.__setitem__("flapping", counts["flapping"] + 1)
+    latencies: List[float] = []
+    raw_removals = 0
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+        monitor.start()
+        try:
+            for _ in range(args.bursts):
+                for _ in range(args.burst_len):
+                    backend.inject("remove", vid, pid)
+                    backend.inject("add", vid, pid)
+                    raw_removals += 1
+                    time.sleep(1.0 / args.rate)
+                time.sleep(config_manager.config.insert_debounce_ms / 1000.0 + 0.1)
+                # 抖动升级在插入稳定后解除，随后的真实拔出应立即上报
+                removed.clear()
+                marks.clear()
+                t0 = time.perf_counter()
+                backend.inject("remove", vid, pid)
+                raw_removals += 1
+                if removed.wait(2.0):
+                    latencies.append(marks["removed"] - t0)
+                backend.inject("add", vid, pid)
+                time.sleep(config_manager.config.insert_debounce_ms / 1000.0 + 0.1)
+        finally:
+            monitor.stop()
+
+    detect = summarize(latencies)
+    print(f"\n状态机吞吐: {len(samples)} 个原始事件（{args.rate}/s），每事件 {per_event_us:.2f} µs")
+    print(f"原始拔出 {raw_removals} 次 → 回调: 拔出 {counts['removed']}，插入 {counts['inserted']}，立即锁屏 {counts['flapping']}")
+    print(f"抖动后真实拔出检测延迟 p50 {detect['p50_ms']:.3f} ms，最大 {detect['max_ms']:.3f} ms")
+    write_results(args.output, "flap", {"scenario_failures": failures, "per_event_us": per_event_us,
+                                         "raw_removals": raw_removals, "callbacks": counts, "detect": detect})
+    return 1 if failures else 0
+
+
+# ==================== 追踪回放 ====================
+
+def synthesize_trace(path: str, hours: float, seed: int, vid: str, pid: str) -> int:
+    """生成一段合成追踪：目标密钥偶尔拔出/插回/抖动，其他 USB 设备频繁插拔"""
+    rng = random.Random(seed)
+    config = al.AppConfig(device_vid=vid, device_pid=pid)
+    key_id = f"USB\\{vid}&{pid}\\0001"
+    others = [f"USB\\VID_{0x1000 + i:04X}&PID_{i:04X}\\{i}" for i in range(20)]
+    events = 0
+    with open(path, "wb") as fp:
+        writer = al.TraceWriter(fp, path)
+        now = 1000.0
+        writer.config(config, now)
+        writer.snapshot([key_id], now)
+        end = now + hours * 3600
+        while now < end:
+            now += rng.expovariate(1 / 5.0)
+            roll = rng.random()
+            if roll < 0.02:  # 真实离开座位
+                writer.event(al.DeviceEvent("remove", key_id, timestamp=now))
+                now += rng.uniform(1, 600)
+                writer.event(al.DeviceEvent("add", key_id, timestamp=now))
+                events += 2
+            elif roll < 0.03:  # 接触不良：一串快速抖动
+                for _ in range(rng.randint(2, 8)):
+                    writer.event(al.DeviceEvent("remove", key_id, timestamp=now))
+                    now += rng.uniform(0.01, 0.2)
+                    writer.event(al.DeviceEvent("add", key_id, timestamp=now))
+                    now += rng.uniform(0.01, 0.2)
+                    events += 2
+            else:  # 无关设备
+                device_id = rng.choice(others)
+                writer.event(al.DeviceEvent(rng.choice(("add", "remove")), device_id, timestamp=now))
+                events += 1
+    return events
+
+
+def bench_replay(args) -> int:
+    """合成数小时的追踪并尽快回放两次，检查结果确定性并测量回放速度；再对一段实时录制回放核对判定"""
+    vid, pid = "VID_1050", "PID_0407"
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, "synthetic.trace")
+    events = synthesize_trace(path, args.hours, args.seed, vid, pid)
+    size = os.path.getsize(path)
+
+    runs = []
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+        for _ in range(2):
+            t0 = time.perf_counter()
+            result = al.replay_trace(path)
+            runs.append((time.perf_counter() - t0, result))
+    elapsed = min(t for t, _ in runs)
+    deterministic = runs[0][1]["decisions"] == runs[1][1]["decisions"] and runs[0][1]["locks"] == runs[1][1]["locks"]
+    result = runs[0][1]
+
+    # 实时录制：FakeBackend 驱动监控器和守护进程，写追踪文件，再回放核对
+    config_manager = al.ConfigManager(os.path.join(workdir, "config.json"))
+    config_manager.config.device_vid, config_manager.config.device_pid = vid, pid
+    config_manager.config.trace_file, config_manager.config.countdown_seconds = "live.trace", 1
+    backend = al.FakeBackend(present=[f"{vid}&{pid}"])
+    monitor = al.USBMonitor(config_manager, backend=backend)
+    live_locks: List[float] = []
+    daemon = al.LockDaemon(config_manager, usb_monitor=monitor, lock_action=lambda: live_locks.append(time.monotonic()))
+    rng = random.Random(args.seed)
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+        daemon.arm()
+        for _ in range(args.live_events):
+            backend.inject(rng.choice(("remove", "add")), vid, pid)
+            time.sleep(rng.uniform(0.01, 0.4))
+        time.sleep(1.5)
+        monitor.stop()
+        live = al.replay_trace(os.path.join(workdir, "live.trace"))
+
+    hours = args.hours
+    print(f"合成追踪: {hours} 小时，{events} 个原始事件，{size} 字节（{size / max(events, 1):.1f} 字节/事件）")
+    print(f"回放耗时 {elapsed:.3f}s，{events / elapsed:,.0f} 事件/秒，相当于 {hours * 3600 / elapsed:,.0f} 倍速")
+    print(f"判定 {len(result['decisions'])} 次，锁屏 {len(result['locks'])} 次，两次回放结果{'一致' if deterministic else '不一致'}")
+    print(f"实时录制: 锁屏 {len(live_locks)} 次，回放锁屏 {len(live['locks'])} 次，"
+          f"判定 {live['recorded_decisions']} 次，差异 {len(live['mismatches'])} 处")
+    write_results(args.output, "replay", {"hours": hours, "events": events, "bytes": size, "seconds": elapsed,
+                                           "events_per_second": events / elapsed, "deterministic": deterministic,
+                                           "live_mismatches": len(live["mismatches"]),
+                                           "live_locks": [len(live_locks), len(live["locks"])]})
+    ok = deterministic and not live["mismatches"] and len(live_locks) == len(live["locks"])
+    return 0 if ok else 1
+
+
+# ==================== 指标开销 ====================
+
+def bench_metrics(args) -> int:
+    """测量 inc/observe 的单次开销，并用 tracemalloc 确认记录过程的内存不随调用次数增长"""
+    import tracemalloc
+    registry = al.AppMetrics()
+    counter = registry.device_events["remove"]
+    histogram = registry.event_dispatch
+    values = [random.Random(args.seed).uniform(0, 0.05) for _ in range(1024)]
+
+    def run_counter(n: int):
+        for _ in range(n):
+            counter.inc()
+
+    def run_histogram(n: int):
+        for i in range(n):
+            histogram.observe(values[i & 1023])
+
+    def run_empty(n: int):
+        for i in range(n):
+            values[i & 1023]
+
+    results = {}
+    for name, func in (("empty", run_empty), ("counter.inc", run_counter), ("histogram.observe", run_histogram)):
+        func(1000)
+        t0 = time.perf_counter()
+        func(args.calls)
+        results[name] = {"ns_per_call": (time.perf_counter() - t0) / args.calls * 1e9}
+
+    # int/float 累加会替换值对象，本身不可避免；这里检查留存内存是否随调用次数增长
+    allocations = {}
+    for name, func in (("counter.inc", run_counter), ("histogram.observe", run_histogram)):
+        func(1000)
+        retained = []
+        for n in (args.calls // 100, args.calls // 10):
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+            func(n)
+            after = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            diff = [d for d in after.compare_to(before, "filename") if d.traceback[0].filename.endswith("AutoLocker.py")]
+            retained.append(sum(d.size_diff for d in diff))
+        allocations[name] = retained[1] - retained[0]
+        results[name]["retained_growth_bytes"] = allocations[name]
+
+    t0 = time.perf_counter()
+    text = registry.render()
+    render_ms = (time.perf_counter() - t0) * 1000
+
+    base = results["empty"]["ns_per_call"]
+    print(f"{'操作':<20}{'ns/次':>10}{'扣除循环':>10}{'留存增长(B)':>12}")
+    for name, row in results.items():
+        if name == "empty":
+            continue
+        print(f"{name:<20}{row['ns_per_call']:>10.1f}{row['ns_per_call'] - base:>10.1f}{row['retained_growth_bytes']:>12}")
+    print(f"\n导出 {len(text.splitlines())} 行 Prometheus 文本耗时 {render_ms:.3f} ms")
+    write_results(args.output, "metrics", {"calls": args.calls, "ops": results, "render_ms": render_ms})
+    return 0 if all(growth <= 0 for growth in allocations.values()) else 1
+
+
+# ==================== 在线重新配置 ====================
+
+def _legacy_restart(monitor: al.USBMonitor):
+    """对照组：旧版修改配置时的停止、等待 0.5 秒、再启动"""
+    monitor.stop()
+    time.sleep(0.5)
+    monitor.start()
+
+
+def bench_reconfig(args) -> int:
+    """一边反复修改配置一边插拔密钥，检查每次拔出都产生回调（旧版 restart 对照）"""
+    vid, pid = "VID_1050", "PID_0407"
+    extra = {"vid": "VID_FFFF", "pid": "PID_0001", "name": "备用密钥"}
+    results = {}
+    passed = True
+    for label, apply in (("restart", _legacy_restart), ("reconfigure", al.USBMonitor.reconfigure)):
+        config_manager = al.ConfigManager(os.path.join(tempfile.mkdtemp(), "config.json"))
+        config = config_manager.config
+        config.device_vid, config.device_pid = vid, pid
+        config.insert_debounce_ms, config.flap_limit = 0, 0  # 每次插拔都应单独上报
+        backend = al.FakeBackend(present=[f"{vid}&{pid}"])
+        monitor = al.USBMonitor(config_manager, backend=backend)
+        counts = {"removed": 0, "inserted": 0}
+        monitor.on_device_removed = lambda: counts.__setitem__("removed", counts["removed"] + 1)
+        monitor.on_device_inserted = lambda: counts.__setitem__("inserted", counts["inserted"] + 1)
+        rng = random.Random(args.seed)
+        done = threading.Event()
+
+        def inject():
+            for _ in range(args.pairs):
+                backend.inject("remove", vid, pid)
+                time.sleep(rng.uniform(0.002, 0.02))
+                backend.inject("add", vid, pid)
+                time.sleep(rng.uniform(0.002, 0.02))
+            done.set()
+
+        durations: List[float] = []
+        with open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+            monitor.start()
+            injector = threading.Thread(target=inject)
+            injector.start()
+            i = 0
+            while not done.is_set():
+                i += 1
+                config.extra_devices = [extra] if i % 2 else []
+                config.countdown_seconds = 5 + i % 3
+                t0 = time.perf_counter()
+                apply(monitor)
+                durations.append(time.perf_counter() - t0)
+                time.sleep(0.005)
+            injector.join()
+            time.sleep(0.2)  # 让队列中剩余的事件处理完
+            monitor.stop()
+        lost = args.pairs - counts["removed"]
+        results[label] = {"reconfigs": len(durations), "removals": args.pairs, "removed_callbacks": counts["removed"],
+                          "inserted_callbacks": counts["inserted"], "lost": lost, "duration": summarize(durations)}
+        if label == "reconfigure":
+            passed = lost == 0 and counts["inserted"] == args.pairs
+
+    print(f"{'方式':<14}{'配置次数':>10}{'拔出':>8}{'拔出回调':>10}{'丢失':>8}{'耗时p50(ms)':>14}{'最大(ms)':>12}")
+    for label, r in results.items():
+        print(f"{label:<14}{r['reconfigs']:>10}{r['removals']:>8}{r['removed_callbacks']:>10}{r['lost']:>8}"
+              f"{r['duration']['p50_ms']:>14.3f}{r['duration']['max_ms']:>12.3f}")
+    print(f"\n在线重新配置期间无事件丢失: {'是' if passed else '否'}")
+    write_results(args.output, "reconfig", {"pairs": args.pairs, "modes": results, "passed": passed})
+    return 0 if passed else 1
+
+
+# ==================== 配置持久化 ====================
+
+CONFIG_WRITER_CHILD = r"""
+import json, os, sys
+from dataclasses import asdict
+sys.path.insert(0, {repo!r})
+import AutoLocker as al
+path, mode = sys.argv[1], sys.argv[2]
+manager = al.ConfigManager(path)
+manager.config.extra_devices = [{{"vid": "VID_%04X" % i, "pid": "PID_0001", "name": "x" * 40}} for i in range(2000)]
+print("ready", flush=True)
+while True:
+    if mode == "legacy":  # 旧版: 原地覆盖写
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(asdict(manager.config), f, indent=2, ensure_ascii=False)
+    else:
+        manager.save()
+"""
+
+
+def bench_config(args) -> int:
+    """配置写入的崩溃安全、突发修改的合并、外部修改的热加载延迟与无效文件的处理"""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    script = CONFIG_WRITER_CHILD.format(repo=repo)
+    vid = "VID_ABCD"
+    rng = random.Random(args.seed)
+    ok = True
+
+    # 1. 写入过程中被强制结束后，磁盘上的配置文件是否完整
+    corrupt = {}
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+        for mode in ("legacy", "atomic"):
+            bad = 0
+            for _ in range(args.kills):
+                path = os.path.join(tempfile.mkdtemp(), "config.json")
+                al.ConfigManager(path).save(al.AppConfig(device_vid=vid))
+                proc = subprocess.Popen([sys.executable, "-c", script, path, mode], stdout=subprocess.PIPE, text=True)
+                proc.stdout.readline()
+                time.sleep(rng.uniform(0.01, 0.1))
+                proc.kill()
+                proc.wait()
+                proc.stdout.close()
+                try:
+                    with open(path, encoding="utf-8") as f:
+                        intact = json.load(f)["device_vid"] == vid
+                except (OSError, ValueError, KeyError):
+                    intact = False
+                bad += not intact
+            corrupt[mode] = bad
+    ok &= corrupt["atomic"] == 0
+
+    # 2. 突发修改合并写入
+    manager = al.ConfigManager(os.path.join(tempfile.mkdtemp(), "config.json"))
+    saves_before = al.METRICS.config_saves["ok"].value
+    t0 = time.perf_counter()
+    for i in range(args.updates):
+        manager.update(enabled=bool(i % 2))
+    update_cost = (time.perf_counter() - t0) / args.updates
+    time.sleep(manager.SAVE_DELAY + 0.3)
+    writes = al.METRICS.config_saves["ok"].value - saves_before
+    on_disk = json.load(open(manager.config_path, encoding="utf-8"))["enabled"]
+    ok &= writes == 1 and on_disk == bool((args.updates - 1) % 2)
+
+    # 3. 外部替换配置文件后的热加载延迟；无效文件被拒绝
+    manager.WATCH_INTERVAL = args.watch_interval
+    reloaded = threading.Event()
+    seen: List[al.AppConfig] = []
+    manager.watch(lambda config: (seen.append(config), reloaded.set()))
+    time.sleep(0.05)
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+        t0 = time.perf_counter()
+        al.ConfigManager._atomic_write(manager.config_path, json.dumps(dict(al.asdict(manager.config), device_vid="VID_BEEF")))
+        got = reloaded.wait(args.watch_interval * 5)
+        reload_ms = (time.perf_counter() - t0) * 1000
+        reloaded.clear()
+        al.ConfigManager._atomic_write(manager.config_path, json.dumps({"device_vid": "not-a-vid", "countdown_seconds": "5"}))
+        rejected = not reloaded.wait(args.watch_interval * 3) and manager.config.device_vid == "VID_BEEF"
+        # 4. 启动时文件不合法：改用 .bak
+        fallback_vid = al.ConfigManager(manager.config_path).config.device_vid
+    ok &= got and rejected and fallback_vid == "VID_BEEF"
+
+    print(f"写入中被强制结束 {args.kills} 次后配置文件损坏: 原地覆盖 {corrupt['legacy']} 次，原子替换 {corrupt['atomic']} 次")
+    print(f"{args.updates} 次连续 update 写盘 {writes} 次，每次 update {update_cost * 1e6:.1f} µs，最终值{'正确' if on_disk == bool((args.updates - 1) % 2) else '错误'}")
+    print(f"外部修改热加载: {'成功' if got else '失败'}，延迟 {reload_ms:.0f} ms（检查间隔 {args.watch_interval}s）")
+    print(f"无效文件被拒绝并保留当前配置: {'是' if rejected else '否'}；启动时无效改用备份: {fallback_vid}")
+    write_results(args.output, "config", {"kills": args.kills, "corrupt": corrupt, "updates": args.updates, "writes": writes,
+                                           "update_us": update_cost * 1e6, "reload_ms": reload_ms, "rejected_invalid": rejected,
+                                           "passed": bool(ok)})
+    return 0 if ok else 1
+
+
+# ==================== 事件转发 ====================
+
+class StandInCollector:
+    """收集端替身：按行接收批次并回复确认，可随时下线/上线，可按比例丢弃确认以制造重发"""
+
+    def __init__(self, drop_ack_every: int = 0):
+        self.port = 0
+        self.drop_ack_every = drop_ack_every
+        self.records: List[dict] = []
+        self.batches = 0
+        self.lock = threading.Lock()
+        self.server: Optional[socket.socket] = None
+        self.conns: List[socket.socket] = []
+
+    def up(self):
+        self.server = socket.create_server(("127.0.0.1", self.port))
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self._accept, args=(self.server,), daemon=True).start()
+
+    def down(self):
+        """下线；已下线时为空操作（相邻两次断开的间隔可能短于断开时长）"""
+        server, self.server = self.server, None
+        if server is None:
+            return
+        try:
+            server.shutdown(socket.SHUT_RDWR)  # 唤醒阻塞在 accept 的线程，否则端口仍在监听
+        except OSError:
+            pass
+        server.close()
+        with self.lock:
+            conns, self.conns = self.conns, []
+        for conn in conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+
+    def _accept(self, server: socket.socket):
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.conns.append(conn)
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn: socket.socket):
+        try:
+            for line in conn.makefile("rb"):
+                batch = json.loads(line)
+                with self.lock:
+                    self.records.extend(batch["events"])
+                    self.batches += 1
+                    drop = self.drop_ack_every and self.batches % self.drop_ack_every == 0
+                if drop:  # 已收下但不确认：转发端会重发整批
+                    conn.close()
+                    return
+                conn.sendall((json.dumps({"ack": batch["batch"]}) + "\n").encode("utf-8"))
+        except (OSError, ValueError):
+            pass
+
+    def check(self, session: str, expected: int) -> Dict[str, int]:
+        """按 (session, seq) 去重后检查是否齐全且有序"""
+        with self.lock:
+            seqs = [r["seq"] for r in self.records if r["session"] == session]
+        first: List[int] = []
+        seen = set()
+        for seq in seqs:
+            if seq not in seen:
+                seen.add(seq)
+                first.append(seq)
+        return {"received": len(seqs), "unique": len(seen), "duplicates": len(seqs) - len(seen),
+                "missing": expected - len(seen & set(range(1, expected + 1))),
+                "out_of_order": sum(1 for a, b in zip(first, first[1:]) if b < a)}
+
+
+def _wait_for(predicate: Callable[[], bool], timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return predicate()
+
+
+def bench_forward(args) -> int:
+    """收集端反复断开、确认丢失、进程重启时事件是否齐全有序，以及 emit 的开销"""
+    collector = StandInCollector(drop_ack_every=args.drop_ack_every)
+    collector.up()
+    url = f"tcp://127.0.0.1:{collector.port}"
+    spool_dir = tempfile.mkdtemp()
+    ok = True
+
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+        # 1. 持续产生事件，期间收集端多次下线
+        forwarder = al.EventForwarder(url, spool_dir, batch_size=args.batch_size, interval=0.05)
+        forwarder.MAX_BACKOFF = 0.5
+        emit_costs: List[float] = []
+        interval = 1.0 / args.rate
+        outages = set(int(args.events * (i + 1) / (args.outages + 1)) for i in range(args.outages))
+        for i in range(args.events):
+            if i in outages:
+                collector.down()
+                down_until = time.monotonic() + args.outage_seconds
+            if collector.server is None and time.monotonic() >= down_until:
+                collector.up()
+            t0 = time.perf_counter()
+            forwarder.emit("removed", index=i)
+            emit_costs.append(time.perf_counter() - t0)
+            time.sleep(interval)
+        if collector.server is None:
+            time.sleep(max(0.0, down_until - time.monotonic()))
+            collector.up()
+        delivered = _wait_for(lambda: collector.check(forwarder.session, args.events)["missing"] == 0, args.timeout)
+        live = collector.check(forwarder.session, args.events)
+        forwarder.close()
+        ok &= delivered and live["out_of_order"] == 0
+
+        # 2. 收集端不可达时退出，事件留在暂存目录；重启后补发
+        collector.down()
+        spool_dir = tempfile.mkdtemp()  # 第一阶段可能留有已送达但未确认的批次
+        first = al.EventForwarder(url, spool_dir, batch_size=args.batch_size, interval=0.05)
+        for i in range(args.batch_size * 3):
+            first.emit("locked", index=i)
+        first.close(timeout=5)
+        spooled = first.spooled
+        collector.up()
+        second = al.EventForwarder(url, spool_dir, batch_size=args.batch_size, interval=0.05)
+        second.emit("removed")
+        restored = _wait_for(lambda: collector.check(first.session, spooled)["missing"] == 0, args.timeout)
+        after_restart = collector.check(first.session, spooled)
+        second.close()
+        ok &= spooled == args.batch_size * 3 and restored and after_restart["out_of_order"] == 0
+
+    emit_stats = summarize(emit_costs)
+    print(f"收集端下线 {args.outages} 次（每次 {args.outage_seconds}s），每 {args.drop_ack_every} 批丢弃一次确认")
+    print(f"{args.events} 个事件: 送达 {live['unique']}，缺失 {live['missing']}，乱序 {live['out_of_order']}，"
+          f"重复 {live['duplicates']}（收集端按 (session, seq) 去重）")
+    print(f"emit: p50 {emit_stats['p50_ms'] * 1000:.1f} µs，max {emit_stats['max_ms']:.3f} ms（收集端下线期间不阻塞）")
+    print(f"进程退出时暂存 {spooled} 个事件，重启后补发: 缺失 {after_restart['missing']}，乱序 {after_restart['out_of_order']}")
+    write_results(args.output, "forward", {"events": args.events, "outages": args.outages, "live": live, "emit": emit_stats,
+                                            "spooled_on_exit": spooled, "after_restart": after_restart, "passed": bool(ok)})
+    return 0 if ok else 1
+
+
+# ==================== 异步核心 ====================
+
+CORE_VID, CORE_PID = "VID_1050", "PID_0407"
+
+
+class PerEventCore(al.AsyncCore):
+    """对照组：每个事件单独 call_soon_threadsafe 唤醒事件循环并立即判定"""
+
+    def ingest(self, event: al.DeviceEvent):
+        self.loop.call_soon_threadsafe(self._process_one, event)
+
+    def _process_one(self, event: al.DeviceEvent):
+        self.usb_monitor.process(event)
+        self._schedule_deadline()
+
+
+def _core_config(**overrides) -> al.ConfigManager:
+    config_manager = al.ConfigManager(os.path.join(tempfile.mkdtemp(), "config.json"))
+    config = config_manager.config
+    config.device_vid, config.device_pid = CORE_VID, CORE_PID
+    config.control_port = 0
+    for key, value in overrides.items():
+        setattr(config, key, value)
+    return config_manager
+
+
+def _core_scenarios() -> Dict[str, bool]:
+    """用 FakeBackend 驱动 AsyncCore 的事件循环，核对事件序列与锁屏时刻"""
+    results = {}
+
+    def run(name: str, script: Callable, check: Callable, **overrides):
+        backend = al.FakeBackend(present=[f"{CORE_VID}&{CORE_PID}"])
+        config_manager = _core_config(**overrides)
+        locks: List[float] = []
+        core = al.AsyncCore(config_manager, al.USBMonitor(config_manager, backend=backend),
+                            lock_action=lambda: locks.append(time.monotonic()), control=False)
+        events: "queue.Queue[dict]" = queue.Queue()
+        core.subscribe(events.put_nowait)
+        core.start()
+        try:
+            t0 = time.monotonic()
+            script(core, backend)
+        finally:
+            core.stop()
+        seen = []
+        while not events.empty():
+            seen.append(events.get().get("event"))
+        results[name] = bool(check(seen, [t - t0 for t in locks]))
+
+    inject = lambda backend, action: backend.inject(action, CORE_VID, CORE_PID)
+    run("countdown_locks_at_deadline",
+        lambda core, b: (inject(b, "remove"), time.sleep(1.3)),
+        lambda seen, locks: seen == ["removed", "countdown", "locked"] and len(locks) == 1 and 0.99 <= locks[0] < 1.1,
+        countdown_seconds=1)
+    run("reinsert_cancels",
+        lambda core, b: (inject(b, "remove"), time.sleep(0.2), inject(b, "add"), time.sleep(1.2)),
+        lambda seen, locks: seen == ["removed", "countdown", "inserted", "cancelled"] and not locks,
+        countdown_seconds=1, insert_debounce_ms=0)
+    run("flapping_locks_now",
+        lambda core, b: ([(inject(b, "remove"), time.sleep(0.02), inject(b, "add"), time.sleep(0.02)) for _ in range(4)],
+                         time.sleep(0.2)),
+        lambda seen, locks: "flapping" in seen and len(locks) == 1 and locks[0] < 0.5,
+        countdown_seconds=30, insert_debounce_ms=0, flap_limit=3)
+    run("insert_debounce_on_loop",
+        lambda core, b: (inject(b, "remove"), time.sleep(0.05), inject(b, "add"), time.sleep(0.1),
+                         inject(b, "remove"), time.sleep(0.05), inject(b, "add"), time.sleep(0.5)),
+        lambda seen, locks: seen.count("inserted") == 1 and seen[-2:] == ["inserted", "cancelled"] and not locks,
+        countdown_seconds=5, insert_debounce_ms=200, flap_limit=0)
+    run("disabled_skips",
+        lambda core, b: (core.call(core.handle_command, "disable"), inject(b, "remove"), time.sleep(0.2)),
+        lambda seen, locks: "countdown" not in seen and not locks,
+        countdown_seconds=1)
+    return results
+
+
+def _thread_profile(daemon: al.LockDaemon, backend: al.FakeBackend, cycles: int, before: int) -> Dict[str, float]:
+    """连接一个 watch 客户端后反复拔出/插入，统计核心新增线程数的峰值与上下文切换次数"""
+    client = al.DaemonClient(daemon.config_manager)
+    client.port = daemon.port
+    received = threading.Event()
+    counts = {"events": 0}
+
+    def watch():
+        for _ in client.watch():
+            counts["events"] += 1
+            received.set()
+
+    idle = threading.active_count() - before
+    watcher = threading.Thread(target=watch, daemon=True)
+    watcher.start()
+    time.sleep(0.2)
+    peak = threading.active_count()
+    try:
+        import resource
+        usage = lambda: (lambda r: r.ru_nvcsw + r.ru_nivcsw)(resource.getrusage(resource.RUSAGE_SELF))
+    except ImportError:
+        usage = lambda: 0  # Windows 没有 resource 模块
+    switches = usage()
+    coalesced = al.METRICS.coalesced_events.value
+    t0 = time.perf_counter()
+    for _ in range(cycles):
+        backend.inject("remove", CORE_VID, CORE_PID)
+        time.sleep(0.002)
+        peak = max(peak, threading.active_count())
+        backend.inject("add", CORE_VID, CORE_PID)
+        time.sleep(0.002)
+    elapsed = time.perf_counter() - t0
+    # 事件循环按批处理：拔出和插入偶尔落在同一批、互相抵消，这一轮的四个事件不会推送
+    expected = lambda: cycles * 4 - 4 * (al.METRICS.coalesced_events.value - coalesced)
+    _wait_for(lambda: counts["events"] >= expected(), 5.0)
+    switches = usage() - switches
+    client.close_watch()
+    return {"idle_threads": idle, "peak_threads": peak - before - 1,  # 不计 watch 客户端线程
+            "context_switches": switches, "switches_per_cycle": switches / cycles,
+            "events": counts["events"], "expected_events": expected(), "seconds": elapsed}
+
+
+def bench_core(args) -> int:
+    """事件循环核心的场景核对，以及与旧版多线程守护进程的线程数、上下文切换对比"""
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+        scenarios = _core_scenarios()
+        profiles = {}
+        for label in ("threaded", "asyncio"):
+            backend = al.FakeBackend(present=[f"{CORE_VID}&{CORE_PID}"])
+            config_manager = _core_config(countdown_seconds=30, insert_debounce_ms=0, flap_limit=0)
+            monitor = al.USBMonitor(config_manager, backend=backend)
+            cls = al.LockDaemon if label == "threaded" else al.AsyncCore
+            daemon = cls(config_manager, usb_monitor=monitor, lock_action=lambda: None)
+            before = threading.active_count()
+            daemon.start()
+            try:
+                profiles[label] = _thread_profile(daemon, backend, args.cycles, before)
+            finally:
+                daemon.stop()
+            time.sleep(0.3)
+
+    ok = all(scenarios.values())
+    print("事件循环场景（FakeBackend 驱动）:")
+    for name, passed in scenarios.items():
+        print(f"  {name:<32}{'通过' if passed else '失败'}")
+    print(f"\n{args.cycles} 次拔出/插入（倒计时开始又取消），1 个 watch 客户端:")
+    print(f"{'实现':<10}{'空闲线程':>10}{'线程峰值':>10}{'上下文切换':>12}{'每次':>10}{'推送事件':>10}")
+    for label, p in profiles.items():
+        print(f"{label:<10}{p['idle_threads']:>10}{p['peak_threads']:>10}{p['context_switches']:>12}"
+              f"{p['switches_per_cycle']:>10.1f}{p['events']:>10}")
+    ok &= profiles["asyncio"]["events"] >= profiles["asyncio"]["expected_events"]
+    ok &= profiles["asyncio"]["peak_threads"] < profiles["threaded"]["peak_threads"]
+    write_results(args.output, "core", {"cycles": args.cycles, "scenarios": scenarios, "profiles": profiles, "passed": bool(ok)})
+    return 0 if ok else 1
+
+
+# ==================== 界面分派 ====================
+
+class StrictRoot(HeadlessRoot):
+    """记录非 Tk 线程（首次调用 run_until 的线程）发起的 after 调用"""
+
+    def __init__(self):
+        super().__init__()
+        self.owner: Optional[int] = None
+        self.cross_thread = 0
+
+    def after(self, ms: int, func: Optional[Callable] = None, *args):
+        if self.owner is not None and threading.get_ident() != self.owner:
+            self.cross_thread += 1
+        return super().after(ms, func, *args)
+
+    def run_until(self, predicate: Callable[[], bool], timeout: float = 5.0) -> bool:
+        self.owner = threading.get_ident()
+        return super().run_until(predicate, timeout)
+
+
+def _dispatch_run(cycles: int, dispatched: bool, rate: float = 0.0, max_pending: Optional[int] = None, stall: float = 0.0) -> dict:
+    """核心 + 界面跑一轮突发拔插（以拔出结束），返回弹窗与跨线程调用统计"""
+    backend = al.FakeBackend(present=[f"{CORE_VID}&{CORE_PID}"])
+    config_manager = _core_config(countdown_seconds=30, insert_debounce_ms=0, flap_limit=0)
+    app = al.USBAutoLockerApp(config_manager=config_manager, usb_monitor=al.USBMonitor(config_manager, backend=backend))
+    app.core.lock_action = lambda: None
+    app.core.__class__ = PerEventCore  # 核心不合并突发，每次拔插都产生界面事件
+    app.root = root = StrictRoot()
+    root.owner = threading.get_ident()
+    if max_pending:
+        app.dispatcher.MAX_PENDING = max_pending
+    popups: List[HeadlessPopup] = []
+    overlaps = [0]
+
+    def factory(*args, **kwargs):
+        overlaps[0] += any(p.is_showing and not p.cancelled for p in popups)
+        popup = HeadlessPopup(*args, **kwargs)
+        popups.append(popup)
+        return popup
+
+    app.popup_factory = factory
+    app.arm()
+    if not dispatched:
+        app.usb_monitor.deliver = None  # 旧方式：回调直接在核心线程上执行
+    calls_off_tk = [0]
+
+    def probe():
+        calls_off_tk[0] += threading.get_ident() != root.owner
+
+    def produce():
+        start = time.perf_counter()
+        for i in range(cycles):
+            backend.inject("add" if i % 2 else "remove", CORE_VID, CORE_PID)
+            if i % 100 == 0:
+                app.dispatcher.call(probe)  # 模拟托盘/键盘钩子线程的调用
+            if rate and i % 50 == 0:
+                time.sleep(max(0.0, start + i / rate - time.perf_counter()))
+        backend.inject("remove", CORE_VID, CORE_PID)
+
+    t0 = time.perf_counter()
+    producer = threading.Thread(target=produce)
+    producer.start()
+    if stall:
+        time.sleep(stall)  # Tk 线程忙，积压超过上限
+    if dispatched:
+        app.dispatcher.attach(root)
+    root.run_until(lambda: not producer.is_alive(), timeout=60.0)  # Tk 线程与生产者并行分派
+    producer.join()
+    settled = lambda: (app.core.call(app.core.status)["countdown_remaining"] is not None
+                       and not app.dispatcher._events and not app.dispatcher._calls)
+    root.run_until(settled, timeout=30.0)
+    root.run_until(lambda: False, timeout=0.3)  # 再跑几轮 pump
+    elapsed = time.perf_counter() - t0
+    showing = [p for p in popups if p.is_showing and not p.cancelled]
+    app.usb_monitor.stop()
+    d = app.dispatcher
+    return {"events": cycles + 1, "posted": d.posted, "dispatched": d.dispatched, "batches": d.batches, "dropped": d.dropped,
+            "popups_created": len(popups), "showing_at_end": len(showing), "overlapping_popups": overlaps[0],
+            "cross_thread_tk_calls": root.cross_thread, "calls_off_tk": calls_off_tk[0], "seconds": elapsed}
+
+
+def bench_dispatch(args) -> int:
+    """突发拔插下的界面分派：弹窗数量、跨线程 Tk 调用、批量合并与溢出后的 resync"""
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+        runs = {
+            "direct": _dispatch_run(args.cycles, dispatched=False, rate=args.rate),
+            "batched": _dispatch_run(args.cycles, dispatched=True, rate=args.rate),
+            "overflow": _dispatch_run(args.cycles, dispatched=True, max_pending=args.max_pending, stall=args.stall),
+        }
+    print(f"{args.cycles} 个拔插事件（以拔出结束，每秒 {args.rate:.0f} 个；overflow 不限速），倒计时 30 秒:")
+    print(f"{'方式':<10}{'投递':>8}{'分派':>8}{'批次':>8}{'丢弃':>8}{'弹窗':>8}{'结束时显示':>12}{'重叠':>6}{'跨线程Tk':>10}")
+    for label, r in runs.items():
+        print(f"{label:<10}{r['posted']:>8}{r['dispatched']:>8}{r['batches']:>8}{r['dropped']:>8}{r['popups_created']:>8}"
+              f"{r['showing_at_end']:>12}{r['overlapping_popups']:>6}{r['cross_thread_tk_calls'] + r['calls_off_tk']:>10}")
+    ok = True
+    for label in ("batched", "overflow"):
+        r = runs[label]
+        ok &= r["showing_at_end"] == 1 and r["overlapping_popups"] == 0
+        ok &= r["cross_thread_tk_calls"] == 0 and r["calls_off_tk"] == 0
+    ok &= runs["batched"]["dropped"] == 0 and runs["overflow"]["dropped"] > 0
+    write_results(args.output, "dispatch", {"cycles": args.cycles, "runs": runs, "passed": bool(ok)})
+    return 0 if ok else 1
+
+
+# ==================== 事件风暴 ====================
+
+STORM_VID = "VID_0BDA"  # 扩展坞上的非密钥设备
+
+
+def _counter_values() -> Dict[str, int]:
+    m = al.METRICS
+    return {"batches": m.event_batches.value, "coalesced": m.coalesced_events.value, "overflows": m.ingest_overflows.value}
+
+
+def _storm_run(cls: type, rate: float, seconds: float, dock_devices: int, key_every: float,
+               inbox_limit: Optional[int] = None, stall: float = 0.0) -> dict:
+    """以固定速率注入扩展坞设备的插拔事件，期间周期性拔出/插回密钥，记录拔出被判定的延迟"""
+    backend = al.FakeBackend(present=[f"{CORE_VID}&{CORE_PID}"])
+    config_manager = _core_config(countdown_seconds=60, insert_debounce_ms=0, remove_debounce_ms=0, flap_limit=0)
+    core = cls(config_manager, al.USBMonitor(config_manager, backend=backend), lock_action=lambda: None, control=False)
+    if inbox_limit:
+        core.INBOX_LIMIT = inbox_limit
+    injected: List[float] = []
+    decided: List[float] = []
+    core.subscribe(lambda event: decided.append(time.perf_counter()) if event.get("event") == "removed" else None)
+    before = _counter_values()
+    core.start()
+    dock = [f"USB\\{STORM_VID}&PID_{i:04X}\\DOCK" for i in range(dock_devices)]
+
+    pace_every = max(1, int(rate * 0.01))  # 按 10 ms 一段补齐速率；分段过粗时低速率下一段会跨过密钥的拔出和插回
+
+    def produce():
+        start = time.perf_counter()
+        next_key, key_present, i = start + key_every, True, 0
+        while True:
+            now = time.perf_counter()
+            if now - start >= seconds:
+                break
+            if now >= next_key:  # 密钥状态翻转，拔出与插回之间隔半个周期，不会落在同一批
+                if key_present:
+                    injected.append(time.perf_counter())
+                backend.inject("remove" if key_present else "add", CORE_VID, CORE_PID)
+                key_present, next_key = not key_present, next_key + key_every / 2
+            device_id = dock[i % dock_devices]
+            backend.inject("remove" if (i // dock_devices) % 2 else "add", STORM_VID, f"PID_{i % dock_devices:04X}", device_id)
+            i += 1
+            if i % pace_every == 0:
+                time.sleep(max(0.0, start + i / rate - time.perf_counter()))
+        if key_present:  # 以拔出结束
+            injected.append(time.perf_counter())
+            backend.inject("remove", CORE_VID, CORE_PID)
+        return i
+
+    counts = {}
+    try:
+        if stall:
+            core.loop.call_soon_threadsafe(time.sleep, stall)  # 事件循环被占住，收件箱积压
+        t0 = time.perf_counter()
+        counts["events"] = produce()
+        elapsed = time.perf_counter() - t0
+        _wait_for(lambda: len(decided) >= len(injected), 5.0)
+        time.sleep(0.1)
+        status = core.call(core.status)
+    finally:
+        core.stop()
+    after = _counter_values()
+    latencies = [d - i for i, d in zip(injected, decided)] if not stall else []
+    return {"events": counts["events"], "rate": counts["events"] / elapsed, "removals": len(injected),
+            "decided": len(decided), "countdown_at_end": status["countdown_remaining"] is not None,
+            "detect": summarize(latencies) if latencies else {},
+            **{key: after[key] - before[key] for key in after}}
+
+
+def bench_storm(args) -> int:
+    """扩展坞重连式事件风暴下密钥拔出的判定延迟：逐事件处理与按批合并对比，以及收件箱溢出后的全量核对"""
+    # 溢出场景在事件循环阻塞期间注入三倍于收件箱上限的事件，速率由上限推出、与 --rate 无关，任何速率下都会溢出
+    burst_seconds = args.stall * 0.8
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+        runs = {
+            "per-event": _storm_run(PerEventCore, args.rate, args.seconds, args.dock_devices, args.key_every),
+            "batched": _storm_run(al.AsyncCore, args.rate, args.seconds, args.dock_devices, args.key_every),
+            # 密钥在事件循环阻塞期间拔出，该事件随溢出丢弃，只能靠全量核对发现
+            "overflow": _storm_run(al.AsyncCore, args.inbox_limit * 3 / burst_seconds, burst_seconds, args.dock_devices,
+                                   args.stall * 4, inbox_limit=args.inbox_limit, stall=args.stall),
+        }
+    print(f"每秒 {args.rate:.0f} 个扩展坞事件（{args.dock_devices} 个设备反复插拔），每 {args.key_every * 1000:.0f} ms 拔出一次密钥:")
+    print(f"{'方式':<10}{'事件':>8}{'实际速率':>10}{'拔出':>6}{'判定':>6}{'批次':>8}{'合并':>8}{'溢出':>6}"
+          f"{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for label, r in runs.items():
+        d = r["detect"]
+        print(f"{label:<10}{r['events']:>8}{r['rate']:>10.0f}{r['removals']:>6}{r['decided']:>6}{r['batches']:>8}"
+              f"{r['coalesced']:>8}{r['overflows']:>6}{d.get('p50_ms', 0):>9.2f}{d.get('p99_ms', 0):>9.2f}{d.get('max_ms', 0):>9.2f}")
+    batched, overflow = runs["batched"], runs["overflow"]
+    ok = batched["decided"] == batched["removals"] and batched["detect"]["p99_ms"] <= args.budget_ms
+    ok &= batched["rate"] >= args.rate * 0.9
+    ok &= overflow["overflows"] > 0 and overflow["countdown_at_end"]
+    print(f"\n批处理拔出判定 p99 {batched['detect']['p99_ms']:.2f} ms（预算 {args.budget_ms:.0f} ms）；"
+          f"溢出后全量核对{'判定为拔出' if overflow['countdown_at_end'] else '未判定拔出'}")
+    write_results(args.output, "storm", {"rate": args.rate, "budget_ms": args.budget_ms, "runs": runs, "passed": bool(ok)})
+    return 0 if ok else 1
+
+
+# ==================== 弹窗首帧 ====================
+
+def _busy(stop: threading.Event):
+    """占用 CPU 与 GIL，模拟繁忙的机器"""
+    while not stop.is_set():
+        sum(range(2000))
+
+
+def _paint_samples(root, runs: int, window: Optional["al.PopupWindow"]) -> Dict[str, List[float]]:
+    """反复显示/关闭倒计时弹窗，记录 show() 本身的耗时和到首次绘制（Expose）的耗时"""
+    samples = {"show": [], "paint": []}
+    for _ in range(runs):
+        popup = al.CountdownPopup(root, 30, window=window)
+        t0 = time.perf_counter()
+        popup.show()
+        samples["show"].append(time.perf_counter() - t0)
+        deadline = time.perf_counter() + 2.0
+        while popup.paint_seconds is None and time.perf_counter() < deadline:
+            root.update()
+        if popup.paint_seconds is not None:
+            samples["paint"].append(popup.paint_seconds)
+        popup.close()
+        root.update()
+        time.sleep(0.02)
+    return samples
+
+
+def bench_popup(args) -> int:
+    """比较每次新建 Toplevel 与预先构建的隐藏窗口从 show() 到首次绘制的耗时（需要图形界面）"""
+    try:
+        root = al.tk.Tk()
+    except al.tk.TclError as e:
+        print(f"无法创建 Tk 窗口（{e}），需要图形界面，跳过")
+        write_results(args.output, "popup", {"skipped": str(e)})
+        return 0
+    root.withdraw()
+    stop = threading.Event()
+    for _ in range(args.busy):
+        threading.Thread(target=_busy, args=(stop,), daemon=True).start()
+    try:
+        with open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+            window = al.PopupWindow(root)
+            t0 = time.perf_counter()
+            window.build()
+            build = time.perf_counter() - t0
+            runs = {"per-show": _paint_samples(root, args.runs, None), "prewarmed": _paint_samples(root, args.runs, window)}
+    finally:
+        stop.set()
+        root.destroy()
+    stats = {f"{label}.{stage}": summarize(samples) for label, r in runs.items() for stage, samples in r.items()}
+    print(f"倒计时弹窗 {args.runs} 次显示（{args.busy} 个繁忙线程），预构建窗口一次性耗时 {build * 1000:.2f} ms:")
+    print_table("show() 与首帧绘制耗时", stats)
+    ok = all(len(r["paint"]) == args.runs for r in runs.values())
+    ok &= stats["prewarmed.paint"]["p50_ms"] <= stats["per-show.paint"]["p50_ms"]
+    write_results(args.output, "popup", {"runs": args.runs, "busy": args.busy, "build_ms": build * 1000,
+                                         "stats": stats, "passed": bool(ok)})
+    return 0 if ok else 1
+
+
+# ==================== 流式扫描 ====================
+
+def bench_scan(args) -> int:
+    """设置窗口的设备扫描：首个设备出现的时间、重复刷新是否叠加扫描、取消与超时（使用 wmi 替身）"""
+    module = StandInWMI(entity_cost=args.entity_cost / 1e6)
+    module.add_entities(args.devices)
+    module.add_entities(args.devices, prefix="HID")
+    scanner, inventory = al.USBScanner, al.USBScanner.inventory
+    results: Dict[str, dict] = {}
+    with standin_wmi(module), open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+        # 旧流程：整个扫描结束后才有结果，每次点击刷新都排队一次完整扫描
+        inventory.invalidate()
+        t0 = time.perf_counter()
+        devices = scanner.submit_scan(refresh=True).result()
+        total = time.perf_counter() - t0
+        queries = module.queries
+        t0 = time.perf_counter()
+        for future in [scanner.submit_scan(refresh=True) for _ in range(args.clicks)]:
+            future.result()
+        results["submit_scan"] = {"first_device_ms": total * 1000, "complete_ms": total * 1000, "devices": len(devices),
+                                  "scans_for_clicks": module.queries - queries, "clicks_ms": (time.perf_counter() - t0) * 1000}
+
+        # 流式扫描：边找边显示，扫描进行中的刷新加入同一次扫描
+        inventory.invalidate()
+        t0 = time.perf_counter()
+        scan = scanner.start_scan()
+        _wait_for(lambda: bool(scan.devices), 10.0)
+        first = time.perf_counter() - t0
+        scan.finished.wait(60.0)
+        total = time.perf_counter() - t0
+        queries = module.queries
+        t0 = time.perf_counter()
+        scans = {id(scanner.start_scan()) for _ in range(args.clicks)}
+        scanner._scan.finished.wait(60.0)
+        results["start_scan"] = {"first_device_ms": first * 1000, "complete_ms": total * 1000, "devices": len(scan.devices),
+                                 "state": scan.state, "scans_for_clicks": module.queries - queries, "distinct_scans": len(scans),
+                                 "clicks_ms": (time.perf_counter() - t0) * 1000}
+        t0 = time.perf_counter()
+        cached = scanner.last_known()
+        results["reopen_cached"] = {"first_device_ms": (time.perf_counter() - t0) * 1000, "devices": len(cached)}
+
+        # 取消与超时：扫描线程在下一个设备处停下，清单缓存保持上次完整扫描的结果
+        scan = scanner.start_scan()
+        time.sleep(0.05)
+        t0 = time.perf_counter()
+        scan.cancel()
+        scan.finished.wait(10.0)
+        results["cancel"] = {"stop_ms": (time.perf_counter() - t0) * 1000, "state": scan.state, "partial": len(scan.devices),
+                             "inventory_kept": len(scanner.last_known()) == len(cached)}
+        scan = scanner.start_scan(timeout=0.05)
+        scan.finished.wait(10.0)
+        results["timeout"] = {"state": scan.state, "partial": len(scan.devices),
+                              "inventory_kept": len(scanner.last_known()) == len(cached)}
+        inventory.invalidate()
+
+    print(f"{args.devices} 个 USB 实体 + {args.devices} 个其他实体，每实体 {args.entity_cost:.0f}µs，连续点击刷新 {args.clicks} 次:")
+    print(f"{'方式':<14}{'首个设备 ms':>12}{'完成 ms':>10}{'设备':>6}{'点击触发扫描':>14}{'点击耗时 ms':>12}")
+    for label in ("submit_scan", "start_scan"):
+        r = results[label]
+        print(f"{label:<14}{r['first_device_ms']:>12.1f}{r['complete_ms']:>10.1f}{r['devices']:>6}"
+              f"{r['scans_for_clicks']:>14}{r['clicks_ms']:>12.1f}")
+    print(f"{'reopen_cached':<14}{results['reopen_cached']['first_device_ms']:>12.3f}{'':>10}{results['reopen_cached']['devices']:>6}")
+    print(f"\n取消: {results['cancel']['state']}，{results['cancel']['stop_ms']:.1f} ms 内停止（已找到 {results['cancel']['partial']} 个）；"
+          f"超时: {results['timeout']['state']}（已找到 {results['timeout']['partial']} 个）；清单缓存保留: "
+          f"{'是' if results['cancel']['inventory_kept'] and results['timeout']['inventory_kept'] else '否'}")
+    stream = results["start_scan"]
+    ok = stream["state"] == "done" and stream["devices"] == args.devices and stream["scans_for_clicks"] <= 1
+    ok &= stream["first_device_ms"] < results["submit_scan"]["first_device_ms"] / 2
+    ok &= results["reopen_cached"]["devices"] > 0
+    ok &= results["cancel"]["state"] == "cancelled" and results["timeout"]["state"] == "timeout"
+    ok &= results["cancel"]["inventory_kept"] and results["timeout"]["inventory_kept"]
+    write_results(args.output, "scan", {"devices": args.devices, "entity_cost_us": args.entity_cost, "results": results, "passed": bool(ok)})
+    return 0 if ok else 1
+
+
+# ==================== 设备列表渲染 ====================
+
+def _spin(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class _StandInRow:
+    """行控件替身：创建、配置、销毁时付出模拟开销并计数"""
+
+    def __init__(self, stats: Dict[str, int], costs: Dict[str, float]):
+        self.stats, self.costs = stats, costs
+        stats["created"] += 1
+        stats["alive"] += 1
+        _spin(costs["create"])
+
+    def configure(self):
+        self.stats["configured"] += 1
+        _spin(self.costs["configure"])
+
+    def destroy(self):
+        self.stats["alive"] -= 1
+        _spin(self.costs["configure"])
+
+
+class HeadlessDeviceList(al.VirtualDeviceList):
+    """虚拟化列表，行控件换成替身"""
+
+    def __init__(self, costs: Dict[str, float]):
+        self.stats = {"created": 0, "alive": 0, "configured": 0}
+        self.costs = costs
+        super().__init__(None, SimpleNamespace(get=lambda: ""), lambda dev: None)
+
+    def _build(self, parent):
+        pass
+
+    def _create_row(self):
+        return _StandInRow(self.stats, self.costs)
+
+    def _bind_row(self, slot: int, row, dev):
+        row.configure()
+
+    def _hide_row(self, row):
+        row.configure()
+
+    def _set_placeholder(self, text):
+        pass
+
+    def _set_scrollbar(self, first, last):
+        pass
+
+
+class LegacyDeviceList:
+    """对照组：旧版 _update_device_list，每次刷新销毁全部行再为每个设备新建一个"""
+
+    def __init__(self, costs: Dict[str, float]):
+        self.stats = {"created": 0, "alive": 0, "configured": 0}
+        self.costs = costs
+        self.rows: List[_StandInRow] = []
+
+    def update(self, devices: List[al.USBDevice]):
+        for row in self.rows:
+            row.destroy()
+        self.rows = [_StandInRow(self.stats, self.costs) for _ in devices]
+
+
+def _devices(start: int, count: int) -> List[al.USBDevice]:
+    return [al.USBDevice(vid=f"VID_{i >> 16:04X}", pid=f"PID_{i & 0xFFFF:04X}", name=f"模拟设备 {i}",
+                         device_id=f"USB\\VID_{i >> 16:04X}&PID_{i & 0xFFFF:04X}\\{i}") for i in range(start, start + count)]
+
+
+def _timed(func: Callable) -> float:
+    t0 = time.perf_counter()
+    func()
+    return (time.perf_counter() - t0) * 1000
+
+
+def bench_devlist(args) -> int:
+    """设备列表在不同设备数下的渲染耗时与控件数量：旧版全部重建与差量 + 虚拟化对比"""
+    costs = {"create": args.widget_cost / 1e6, "configure": args.configure_cost / 1e6}
+    sizes = [int(n) for n in args.sizes.split(",")]
+    results: Dict[str, dict] = {}
+    ok = True
+    for n in sizes:
+        devices = _devices(0, n)
+        churn = max(1, n // 100)  # 刷新时 1% 的设备拔出、1% 新插入
+        after = devices[churn:] + _devices(n, churn)
+        virtual = HeadlessDeviceList(costs)
+        r = {
+            "open_ms": _timed(lambda: [virtual.merge(devices[i:i + 50]) for i in range(0, n, 50)]),  # 流式扫描分批合并
+            "refresh_ms": _timed(lambda: (virtual.merge(after), virtual.retain({dev.vid_pid for dev in after}))),
+            "filter_ms": _timed(lambda: virtual.set_filter("pid_00")),
+            "clear_filter_ms": _timed(lambda: virtual.set_filter("")),
+        }
+        pages = max(1, n // virtual.ROWS)
+        r["scroll_page_ms"] = _timed(lambda: [virtual.scroll(virtual.ROWS) for _ in range(pages)]) / pages  # 逐页滚到底
+        r.update(widgets=virtual.stats["alive"], configures=virtual.stats["configured"])
+        ok &= virtual.stats["alive"] == virtual.ROWS
+        ok &= list(virtual.model.devices) == [dev.vid_pid for dev in after]
+        results[f"virtual/{n}"] = r
+        if n <= args.legacy_max:
+            legacy = LegacyDeviceList(costs)
+            filtered = [dev for dev in after if "pid_00" in dev.vid_pid.lower()]
+            results[f"legacy/{n}"] = {
+                "open_ms": _timed(lambda: legacy.update(devices)),
+                "refresh_ms": _timed(lambda: legacy.update(after)),
+                "filter_ms": _timed(lambda: legacy.update(filtered)),
+                "clear_filter_ms": _timed(lambda: legacy.update(after)),
+                "scroll_page_ms": 0.0,  # 控件都已存在，由 Tk 原生滚动
+                "widgets": legacy.stats["alive"], "configures": legacy.stats["created"],
+            }
+    print(f"设备列表渲染（行控件创建 {args.widget_cost:.0f}µs、配置 {args.configure_cost:.0f}µs，刷新时 1% 设备增减）:")
+    print(f"{'方式/设备数':<16}{'打开 ms':>10}{'刷新 ms':>10}{'过滤 ms':>10}{'清除过滤':>10}{'每页滚动 ms':>11}{'控件':>8}{'配置次数':>10}")
+    for label, r in results.items():
+        print(f"{label:<16}{r['open_ms']:>10.1f}{r['refresh_ms']:>10.1f}{r['filter_ms']:>10.1f}{r['clear_filter_ms']:>10.1f}"
+              f"{r['scroll_page_ms']:>11.2f}{r['widgets']:>8}{r['configures']:>10}")
+    largest = results[f"virtual/{sizes[-1]}"]
+    ok &= largest["refresh_ms"] <= args.budget_ms and largest["filter_ms"] <= args.budget_ms
+    print(f"\n{sizes[-1]} 个设备时刷新 {largest['refresh_ms']:.1f} ms、过滤 {largest['filter_ms']:.1f} ms（预算 {args.budget_ms:.0f} ms）")
+    write_results(args.output, "devlist", {"costs_us": {k: v * 1e6 for k, v in costs.items()}, "results": results, "passed": bool(ok)})
+    return 0 if ok else 1
+
+
+# ==================== 锁屏流水线 ====================
+
+class StubLockBackend(al.LockBackend):
+    """锁屏后端桩：记录锁屏时刻，可设为失败"""
+
+    def __init__(self, name: str, fail: bool = False):
+        self.name = name
+        self.fail = fail
+        self.calls: List[float] = []
+
+    def lock(self):
+        self.calls.append(time.perf_counter())
+        if self.fail:
+            raise OSError(f"{self.name} 不可用")
+
+
+class StubHook(al.LockHook):
+    """锁屏前动作桩：睡眠 delay 秒、一直阻塞到 release 置位，或抛出异常"""
+
+    def __init__(self, name: str, delay: float = 0.0, fail: bool = False, hang: bool = False):
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+        self.release = threading.Event() if hang else None
+        self.finished = threading.Event()
+
+    def run(self, timeout: float):
+        try:
+            if self.release:
+                self.release.wait()
+            time.sleep(self.delay)
+            if self.fail:
+                raise RuntimeError("模拟失败")
+        finally:
+            self.finished.set()
+
+
+def _lockpipe_cases(deadline: float) -> Dict[str, bool]:
+    """用桩后端与故意变慢的钩子核对流水线行为"""
+    results = {}
+    slack = 0.05  # 线程调度余量
+
+    def run(hooks, backends=None, hook_deadline=deadline):
+        backends = backends or [StubLockBackend("stub")]
+        pipeline = al.LockPipeline(backends, hooks, hook_deadline)
+        t0 = time.perf_counter()
+        report = pipeline.lock()
+        first_call = next((b.calls[0] for b in backends if b.calls), None)
+        return pipeline, report, (first_call - t0) if first_call else None
+
+    by_name = lambda report: {r["name"]: r["result"] for r in report["hooks"]}
+
+    _, report, locked = run([StubHook("fast-a", 0.01), StubHook("fast-b", 0.02)])
+    results["fast_hooks_complete_before_lock"] = by_name(report) == {"fast-a": "ok", "fast-b": "ok"} and locked < deadline
+
+    _, report, locked = run([StubHook(f"parallel-{i}", deadline / 2) for i in range(5)])
+    results["hooks_run_concurrently"] = all(r == "ok" for r in by_name(report).values()) and locked < deadline * 0.9
+
+    slow = StubHook("slow", deadline * 10)
+    pipeline, report, locked = run([StubHook("fast", 0.01), slow])
+    results["slow_hook_bounded_by_deadline"] = (by_name(report) == {"fast": "ok", "slow": "timeout"}
+                                                and deadline <= locked < deadline + slack)
+    slow.finished.wait(deadline * 20)
+    time.sleep(0.01)
+    results["late_result_not_rewritten"] = by_name(pipeline.history[-1])["slow"] == "timeout"
+
+    hang = StubHook("hang", hang=True)
+    _, report, locked = run([hang])
+    results["hung_hook_bounded_by_deadline"] = by_name(report) == {"hang": "timeout"} and locked < deadline + slack
+    hang.release.set()
+
+    _, report, locked = run([StubHook("broken", fail=True), StubHook("fast", 0.01)])
+    results["failing_hook_does_not_block"] = by_name(report) == {"broken": "error", "fast": "ok"} and locked < deadline
+
+    _, report, locked = run([StubHook("slow", 1.0)], hook_deadline=0.0)
+    results["zero_deadline_locks_immediately"] = locked is not None and locked < slack
+
+    command = al.CommandHook([sys.executable, "-c", "import time; time.sleep(30)"], name="sleepy-command")
+    t0 = time.perf_counter()
+    _, report, locked = run([command])
+    results["command_hook_bounded"] = by_name(report) == {"sleepy-command": "timeout"} and locked < deadline + slack
+
+    backends = [StubLockBackend("primary", fail=True), StubLockBackend("fallback")]
+    failures = al.METRICS.lock_failures.value
+    _, report, _ = run([], backends)
+    results["backend_fallback"] = report["backend"] == "fallback" and al.METRICS.lock_failures.value == failures + 1
+
+    _, report, _ = run([], [StubLockBackend("a", fail=True), StubLockBackend("b", fail=True)])
+    results["all_backends_fail_reported"] = report["backend"] is None
+
+    config = al.AppConfig(lock_backends=["loginctl"], lock_hooks=["pause-media", {"command": ["true"], "name": "custom"}],
+                          lock_hook_deadline_ms=150)
+    pipeline = al.LockPipeline.from_config(config)
+    bad = al.AppConfig(lock_backends=["nope"], lock_hooks=["nope", {"command": "true"}], lock_hook_deadline_ms=-1)
+    results["config_builds_and_validates"] = ([b.name for b in pipeline.backends] == ["loginctl"]
+                                              and [h.name for h in pipeline.hooks] == ["pause-media", "custom"]
+                                              and pipeline.hook_deadline == 0.15 and len(bad.validate()) == 4)
+    return results
+
+
+def bench_lockpipe(args) -> int:
+    """锁屏流水线：桩后端与故意变慢的钩子下的行为核对、锁屏时刻相对截止时间的分布与每个钩子的耗时统计"""
+    deadline = args.deadline_ms / 1000.0
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+        cases = _lockpipe_cases(deadline)
+        # 典型组合：两个快钩子、一个偶尔很慢的钩子、一个总是挂住的钩子，经 AsyncCore 从拔出走到锁屏
+        backend = StubLockBackend("stub")
+        hooks = [StubHook("pause-media", 0.005), StubHook("notify", 0.02), StubHook("displays-off", 0.0), StubHook("hung", hang=True)]
+        pipeline = al.LockPipeline([backend], hooks, deadline)
+        fake = al.FakeBackend(present=[f"{CORE_VID}&{CORE_PID}"])
+        config_manager = _core_config(countdown_seconds=0, insert_debounce_ms=0, flap_limit=0)
+        core = al.AsyncCore(config_manager, al.USBMonitor(config_manager, backend=fake), lock_action=pipeline, control=False)
+        core.start()
+        waits: List[float] = []
+        rng = random.Random(args.seed)
+        try:
+            for i in range(args.runs):
+                hooks[1].delay = deadline * 3 if rng.random() < 0.3 else 0.02  # notify 有时很慢
+                count = len(backend.calls)
+                t0 = time.perf_counter()
+                fake.inject("remove", CORE_VID, CORE_PID)
+                _wait_for(lambda: len(backend.calls) > count, deadline * 5 + 1)
+                waits.append(backend.calls[-1] - t0)
+                fake.inject("add", CORE_VID, CORE_PID)
+                time.sleep(0.05)
+        finally:
+            core.stop()
+            hooks[3].release.set()
+    ok = all(cases.values())
+    print(f"锁屏流水线行为核对（钩子总时限 {args.deadline_ms:.0f} ms）:")
+    for name, passed in cases.items():
+        print(f"  {name:<36}{'通过' if passed else '失败'}")
+    stats = {"remove_to_lock": summarize(waits)}
+    print_table(f"AsyncCore 拔出到锁屏（倒计时 0，{args.runs} 次，含一个总是挂住的钩子）", stats)
+    print(f"\n{'钩子':<14}{'次数':>6}{'超时':>6}{'失败':>6}{'平均 ms':>10}{'最大 ms':>10}")
+    for name, s in pipeline.stats().items():
+        mean = f"{s['mean_ms']:.1f}" if s["mean_ms"] is not None else "-"
+        print(f"{name:<14}{s['runs']:>6}{s['timeouts']:>6}{s['errors']:>6}{mean:>10}{s['max_ms']:>10.1f}")
+    ok &= len(waits) == args.runs and stats["remove_to_lock"]["max_ms"] <= args.deadline_ms + 50
+    write_results(args.output, "lockpipe", {"deadline_ms": args.deadline_ms, "cases": cases, "stats": stats,
+                                            "hooks": pipeline.stats(), "passed": bool(ok)})
+    return 0 if ok else 1
+
+
+# ==================== 设备代理 ====================
+
+SHARED_KEY = "VID_1050&PID_0407"  # 所有会话都订阅的密钥（同型号密钥）
+
+
+def _session_key(i: int) -> str:
+    return f"VID_2000&PID_{i:04X}"
+
+
+async def _broker_session(port: int, keys: List[str], record: dict):
+    """一个轻量会话：订阅后只读取事件，记录到达时刻与不属于自己的事件数"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    record["writer"] = writer
+    writer.write((json.dumps({"cmd": "subscribe", "keys": keys}) + "\n").encode("utf-8"))
+    json.loads(await reader.readline())  # 快照
+    record["ready"].set()
+    received = record["received"]
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        now = time.perf_counter()
+        message = json.loads(line)
+        received.append((message["device_id"], now))
+        if f"{message['vid']}&{message['pid']}" not in keys:
+            record["foreign"] += 1
+
+
+def _pace(count: int, rate: float, emit: Callable[[int], None]):
+    """按固定速率调用 emit(n)"""
+    t0 = time.perf_counter()
+    for n in range(count):
+        delay = t0 + n / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        emit(n)
+
+
+def _broker_sessions_e2e(port: int, fake: al.FakeBackend) -> Dict[str, bool]:
+    """完整的会话核心（AsyncCore + BrokerBackend）：只有拔出自己密钥的会话锁屏，改密钥和代理重启后仍正确"""
+    results = {}
+    keys = [f"VID_3000&PID_{i:04X}" for i in range(3)]
+    for key in keys + ["VID_3000&PID_0100"]:
+        fake.inject("add", *key.split("&"))
+    sessions = []
+    for key in keys:
+        vid, pid = key.split("&")
+        config_manager = _core_config(device_vid=vid, device_pid=pid, backend="broker", broker_port=port,
+                                      countdown_seconds=0, insert_debounce_ms=0, flap_limit=0)
+        locks: List[float] = []
+        core = al.AsyncCore(config_manager, lock_action=lambda locks=locks: locks.append(time.monotonic()), control=False)
+        core.start()
+        sessions.append((core, locks))
+    try:
+        counts = lambda: [len(locks) for _, locks in sessions]
+        results["sessions_start_present"] = all(core.usb_monitor.device_present for core, _ in sessions)
+        fake.inject("remove", *keys[0].split("&"))
+        _wait_for(lambda: counts()[0] == 1, 2.0)
+        time.sleep(0.2)
+        results["only_owner_locks"] = counts() == [1, 0, 0]
+
+        core, _ = sessions[1]
+        core.config_manager.config.device_pid = "PID_0100"
+        core.call(core.usb_monitor.reconfigure)
+        time.sleep(0.2)
+        fake.inject("remove", *keys[1].split("&"))  # 旧密钥已不再订阅
+        time.sleep(0.2)
+        unchanged = counts() == [1, 0, 0]
+        fake.inject("remove", "VID_3000", "PID_0100")
+        results["reconfigure_resubscribes"] = unchanged and _wait_for(lambda: counts()[1] == 1, 2.0)
+    finally:
+        for core, _ in sessions:
+            core.stop()
+    return results
+
+
+def _broker_restart(fake: al.FakeBackend) -> bool:
+    """代理重启期间拔出的密钥：会话重连后按快照全量核对，锁屏"""
+    key = "VID_3000&PID_0200"
+    fake.inject("add", *key.split("&"))
+    broker = al.DeviceBroker(_core_config(broker_port=0), backend=fake)
+    broker.start()
+    vid, pid = key.split("&")
+    config_manager = _core_config(device_vid=vid, device_pid=pid, backend="broker", broker_port=broker.port,
+                                  countdown_seconds=0, insert_debounce_ms=0, flap_limit=0)
+    locks: List[float] = []
+    core = al.AsyncCore(config_manager, lock_action=lambda: locks.append(time.monotonic()), control=False)
+    core.start()
+    try:
+        broker.stop()
+        fake.inject("remove", vid, pid)
+        broker = al.DeviceBroker(_core_config(broker_port=config_manager.config.broker_port), backend=fake)
+        broker.start()
+        return _wait_for(lambda: len(locks) == 1, al.AsyncCore.REOPEN_DELAY * 3)
+    finally:
+        core.stop()
+        broker.stop()
+
+
+def _broker_load(args, sessions: int) -> dict:
+    """一轮负载：sessions 个轻量会话，加上卡死与断开的会话，最后跑完整会话场景"""
+    fake = al.FakeBackend(present=[SHARED_KEY])
+    config_manager = _core_config(broker_port=0)
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+        before = threading.active_count()
+        broker = al.DeviceBroker(config_manager, backend=fake)
+        broker.BUFFER_LIMIT = args.buffer_kb * 1024
+        broker.SEND_BUFFER = args.sndbuf_kb * 1024
+        broker.start()
+    broker_threads = threading.active_count() - before
+    port = broker.port
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True, name="bench-sessions").start()
+    records = [{"keys": [_session_key(i), SHARED_KEY], "received": [], "foreign": 0, "ready": threading.Event()}
+               for i in range(sessions)]
+    t0 = time.perf_counter()
+    for chunk in range(0, sessions, 50):  # 分批连接，避免超出监听队列
+        for record in records[chunk:chunk + 50]:
+            asyncio.run_coroutine_threadsafe(_broker_session(port, record["keys"], record), loop)
+        for record in records[chunk:chunk + 50]:
+            record["ready"].wait(10)
+    connect_seconds = time.perf_counter() - t0
+    ready = sum(1 for r in records if r["ready"].is_set())
+
+    # 断开的会话：订阅后立即关闭连接
+    dead = []
+    for _ in range(args.dead):
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock.sendall((json.dumps({"cmd": "subscribe", "keys": [SHARED_KEY]}) + "\n").encode("utf-8"))
+        sock.recv(65536)
+        dead.append(sock)
+    for sock in dead:
+        sock.close()
+    dead_removed = _wait_for(lambda: broker.status()["sessions"] == sessions, 5.0)
+
+    # 卡死的会话：接收缓冲很小，订阅后从不读取
+    stalled = []
+    for _ in range(args.stalled):
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.connect(("127.0.0.1", port))
+        sock.sendall((json.dumps({"cmd": "subscribe", "keys": [SHARED_KEY]}) + "\n").encode("utf-8"))
+        stalled.append(sock)
+    _wait_for(lambda: broker.status()["sessions"] == sessions + args.stalled, 5.0)
+
+    sent: Dict[str, float] = {}
+    rng = random.Random(args.seed)
+
+    def targeted(n: int):
+        vid, pid = _session_key(rng.randrange(sessions)).split("&")
+        device_id = f"USB\\{vid}&{pid}\\T{n}"
+        sent[device_id] = time.perf_counter()
+        fake.inject("add" if n % 2 else "remove", vid, pid, device_id=device_id)
+
+    def shared(prefix: str) -> Callable[[int], None]:
+        def emit(n: int):
+            vid, pid = SHARED_KEY.split("&")
+            device_id = f"USB\\{SHARED_KEY}\\{prefix}{n}"
+            sent[device_id] = time.perf_counter()
+            fake.inject("add" if n % 2 else "remove", vid, pid, device_id=device_id)
+        return emit
+
+    _pace(args.events, args.rate, targeted)
+    _pace(args.broadcasts, args.broadcast_rate, shared("S"))
+    _pace(args.burst, 20000, shared("B"))  # 突发：卡死的会话在这里积压到上限
+    expected = args.events + (args.broadcasts + args.burst) * sessions
+    total = lambda: sum(len(r["received"]) for r in records)
+    delivered_all = _wait_for(lambda: total() >= expected, 10.0)
+    # 卡死的会话要等一个考察窗口、按消化速度判定后才断开
+    _wait_for(lambda: broker.status()["slow_dropped"] >= args.stalled, broker.DRAIN_WINDOW * 3 + 1)
+    time.sleep(0.2)
+    status = broker.status()
+
+    targeted_latency, fanout = [], {}
+    for record in records:
+        for device_id, at in record["received"]:
+            if "\\T" in device_id:
+                targeted_latency.append(at - sent[device_id])
+            elif "\\S" in device_id:
+                fanout.setdefault(device_id, []).append(at - sent[device_id])
+    complete = [max(samples) for samples in fanout.values() if len(samples) == sessions]
+    foreign = sum(r["foreign"] for r in records)
+    lost = expected - total()
+
+    for record in records:
+        loop.call_soon_threadsafe(record["writer"].close)
+    for sock in stalled:
+        sock.close()
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+        e2e = _broker_sessions_e2e(port, fake)
+        broker.stop()
+        e2e["reconnect_resyncs"] = _broker_restart(fake)
+    loop.call_soon_threadsafe(loop.stop)
+
+    stats = {"targeted": summarize(targeted_latency), "shared_fanout": summarize(complete)}
+    print(f"\n== {sessions} 个会话 ==")
+    print(f"代理线程 {broker_threads} 个；{ready}/{sessions} 个会话在 {connect_seconds * 1000:.0f} ms 内完成订阅")
+    print_table(f"注入到会话收到（{args.events} 个定向事件 @ {args.rate:.0f}/s；{args.broadcasts} 个共享密钥事件 "
+                f"@ {args.broadcast_rate:.0f}/s 扇出到全部会话，之后突发 {args.burst} 个；会话与代理在同一进程）", stats)
+    print(f"\n事件 {status['events']}，投递 {status['delivered']}，会话丢失 {lost}，收到不属于自己的事件 {foreign}")
+    print(f"卡死会话 {args.stalled} 个，被断开 {status['slow_dropped']} 个；断开的会话 {args.dead} 个，"
+          f"{'已全部移除' if dead_removed else '未全部移除'}")
+    print("完整会话（AsyncCore + broker 后端）:")
+    for name, passed in e2e.items():
+        print(f"  {name:<28}{'通过' if passed else '失败'}")
+    ok = (ready == sessions and delivered_all and lost == 0 and foreign == 0 and dead_removed
+          and status["slow_dropped"] == args.stalled and len(complete) == args.broadcasts and all(e2e.values()))
+    if args.budget_ms is not None:
+        ok &= stats["shared_fanout"]["p99_ms"] <= args.budget_ms
+    return {"sessions": sessions, "stalled": args.stalled, "dead": args.dead,
+            "broker_threads": broker_threads, "connect_ms": connect_seconds * 1000,
+            "stats": stats, "status": status, "lost": lost, "foreign": foreign,
+            "e2e": e2e, "passed": bool(ok)}
+
+
+def bench_broker(args) -> int:
+    """多会话设备代理的本机负载测试：按密钥隔离、共享密钥的扇出延迟、卡死与断开的会话不影响其他会话
+
+    依次跑 --sessions 给出的每个规模：会话少时每个会话分到的突发更集中，积压更大，
+    正常读取的会话不能因此被当作卡死断开。
+    """
+    runs = [_broker_load(args, sessions) for sessions in args.sessions]
+    ok = all(run["passed"] for run in runs)
+    write_results(args.output, "broker", {"runs": runs, "passed": ok})
+    return 0 if ok else 1
+
+
+# ==================== 审计日志 ====================
+
+AUDIT_MIX = [("removed", 0.3), ("countdown", 0.25), ("inserted", 0.25), ("cancelled", 0.1), ("locked", 0.1)]
+
+
+def _audit_history(log: al.AuditLog, days: int, per_day: int, users: int, seed: int) -> List[float]:
+    """按历史时间生成审计记录，返回每次 emit 的耗时；写入线程落后太多时等它追上，不计入丢弃"""
+    rng = random.Random(seed)
+    names, weights = zip(*AUDIT_MIX)
+    start = time.time() - days * 86400
+    samples = []
+    for day in range(days):
+        times = sorted(start + day * 86400 + rng.random() * 86400 for _ in range(per_day))
+        for t in times:
+            log.clock = lambda t=t: t
+            log.user = f"user{rng.randrange(users):02d}"
+            event = rng.choices(names, weights)[0]
+            fields = {"reason": rng.choice(["keyboard", "reinsert", "remote"])} if event == "cancelled" else {}
+            t0 = time.perf_counter()
+            log.emit(event, **fields)
+            samples.append(time.perf_counter() - t0)
+        while len(log._pending) > log.MEMORY_LIMIT // 2:
+            time.sleep(0.005)
+    return samples
+
+
+def _audit_full_scan(directory: str, start: float, end: float, events: List[str], user: str) -> List[dict]:
+    """对照组：不看索引，解压并解析全部段，按时间排序"""
+    import gzip
+    results = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".jsonl.gz"):
+            with gzip.open(os.path.join(directory, name), "rb") as f:
+                for line in f:
+                    record = json.loads(line)
+                    if start <= record["time"] <= end and record["event"] in events and record["user"] == user:
+                        results.append(record)
+    with open(os.path.join(directory, al.AuditLog.CURRENT), "rb") as f:
+        for line in f:
+            record = json.loads(line)
+            if start <= record["time"] <= end and record["event"] in events and record["user"] == user:
+                results.append(record)
+    results.sort(key=lambda record: record["time"])
+    return results
+
+
+def _audit_cases() -> Dict[str, bool]:
+    """崩溃与并发场景：半条记录、重复索引行、轮转中途、保留期、写入线程卡住时 emit 仍立即返回"""
+    results = {}
+    directory = tempfile.mkdtemp()
+    log = al.AuditLog(directory, max_bytes=4096, rotate_seconds=3600)
+    log.clock = lambda: 1000.0
+    for i in range(100):
+        log.emit("removed", n=i)
+    log.close()
+    with open(os.path.join(directory, al.AuditLog.CURRENT), "ab") as f:
+        f.write(b'{"event": "locked", "ti')  # 写到一半崩溃
+    log = al.AuditLog(directory, max_bytes=4096, rotate_seconds=3600)
+    log.clock = lambda: 1001.0
+    log.emit("locked", n=100)
+    log.close()
+    records = list(al.AuditLog.query(directory))
+    results["torn_tail_skipped"] = [r["n"] for r in records] == list(range(101))
+
+    with open(os.path.join(directory, al.AuditLog.INDEX), "r+", encoding="utf-8") as f:
+        first = f.readline()
+        f.seek(0, os.SEEK_END)
+        f.write(first)  # 轮转中途崩溃后重新轮转出的同名段
+    results["duplicate_index_deduped"] = [r["n"] for r in al.AuditLog.query(directory)] == list(range(101))
+    segment = al.AuditLog.read_index(directory)[-1]["file"]
+    os.rename(os.path.join(directory, segment), os.path.join(directory, segment + ".tmp"))
+    results["missing_segment_skipped"] = len(list(al.AuditLog.query(directory))) < 101
+    os.rename(os.path.join(directory, segment + ".tmp"), os.path.join(directory, segment))
+
+    directory = tempfile.mkdtemp()
+    log = al.AuditLog(directory, max_bytes=1 << 20, rotate_seconds=86400, retention_seconds=10 * 86400)
+    for day in range(30):
+        log.clock = lambda day=day: 1e9 + day * 86400
+        log.emit("removed", day=day)
+    log.close()
+    days = [r["day"] for r in al.AuditLog.query(directory)]
+    results["retention_prunes_old_segments"] = days == list(range(19, 30)) and len(al.AuditLog.read_index(directory)) == 10
+
+    log = al.AuditLog(tempfile.mkdtemp())
+    write = log._write
+    log._write = lambda batch: (time.sleep(0.3), write(batch))  # 磁盘卡住
+    samples = []
+    for i in range(2000):
+        t0 = time.perf_counter()
+        log.emit("removed", n=i)
+        samples.append(time.perf_counter() - t0)
+        if i % 200 == 0:
+            time.sleep(0.05)
+    log.close(timeout=5)
+    results["stalled_writer_emit_fast"] = summarize(samples)["max_ms"] < 20
+    return results
+
+
+def bench_audit(args) -> int:
+    """审计日志：数月历史下的 emit 开销、压缩比，以及按稀疏索引查询与全量扫描的耗时对比"""
+    directory = tempfile.mkdtemp()
+    dropped = al.METRICS.audit_dropped.value
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+        cases = _audit_cases()
+        log = al.AuditLog(directory, max_bytes=args.max_kb * 1024, rotate_seconds=86400)
+        t0 = time.perf_counter()
+        emits = _audit_history(log, args.days, args.per_day, args.users, args.seed)
+        log.close(timeout=60)
+        write_seconds = time.perf_counter() - t0
+    total = args.days * args.per_day
+    index = al.AuditLog.read_index(directory)
+    stored = sum(os.path.getsize(os.path.join(directory, e["file"])) for e in index)
+    stored += os.path.getsize(os.path.join(directory, al.AuditLog.CURRENT))
+    written = sum(e["count"] for e in index) + sum(1 for _ in open(os.path.join(directory, al.AuditLog.CURRENT), "rb"))
+    plain = sum(len(line) for line in _iter_audit_lines(directory))
+
+    now = time.time()
+    queries = {
+        "week_removed_cancelled_user": (now - 7 * 86400, now, ["removed", "cancelled"]),
+        "quarter_removed_cancelled_user": (now - 90 * 86400, now, ["removed", "cancelled"]),
+        "quarter_locked_user": (now - 90 * 86400, now, ["locked"]),
+    }
+    user = "user03"
+    rows, results = {}, {}
+    ok = all(cases.values()) and written == total and al.METRICS.audit_dropped.value == dropped
+    for name, (start, end, events) in queries.items():
+        stats: dict = {}
+        t0 = time.perf_counter()
+        indexed = list(al.AuditLog.query(directory, start, end, events, user, stats=stats))
+        indexed_s = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        scanned = _audit_full_scan(directory, start, end, events, user)
+        scan_s = time.perf_counter() - t0
+        same = indexed == scanned
+        ok &= same
+        if args.budget_ms is not None:
+            ok &= indexed_s * 1000 <= args.budget_ms
+        rows[name] = (len(indexed), indexed_s, scan_s, stats, same)
+        results[name] = {"matches": len(indexed), "indexed_ms": indexed_s * 1000, "full_scan_ms": scan_s * 1000,
+                         "identical": same, **stats}
+
+    emit_stats = summarize(emits)
+    print("审计日志行为核对:")
+    for name, passed in cases.items():
+        print(f"  {name:<34}{'通过' if passed else '失败'}")
+    print(f"\n{args.days} 天 × {args.per_day} 条/天 = {total} 条，{len(index)} 个段，写入 {written} 条，"
+          f"用时 {write_seconds:.1f} 秒；丢弃 {al.METRICS.audit_dropped.value - dropped} 条")
+    print(f"占用 {stored / 1024 / 1024:.1f} MB（未压缩 {plain / 1024 / 1024:.1f} MB，{plain / max(stored, 1):.1f} 倍）")
+    print_table("emit 耗时（调用方线程）", {"emit": emit_stats})
+    print(f"\n{'查询（' + user + '）':<36}{'命中':>7}{'索引 ms':>10}{'全量 ms':>10}{'读块':>7}{'跳过块':>8}{'一致':>6}")
+    for name, (count, indexed_s, scan_s, stats, same) in rows.items():
+        print(f"{name:<36}{count:>7}{indexed_s * 1000:>10.1f}{scan_s * 1000:>10.1f}"
+              f"{stats['blocks_read']:>7}{stats['blocks_skipped']:>8}{'是' if same else '否':>6}")
+    write_results(args.output, "audit", {"days": args.days, "per_day": args.per_day, "segments": len(index),
+                                         "stored_bytes": stored, "plain_bytes": plain, "emit": emit_stats,
+                                         "cases": cases, "queries": results, "passed": bool(ok)})
+    return 0 if ok else 1
+
+
+def _iter_audit_lines(directory: str):
+    import gzip
+    for entry in al.AuditLog.read_index(directory):
+        with gzip.open(os.path.join(directory, entry["file"]), "rb") as f:
+            yield from f
+    with open(os.path.join(directory, al.AuditLog.CURRENT), "rb") as f:
+        yield from f
+
+
+# ==================== 入口 ====================
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="USB AutoLocker 基准测试")
+    parser.add_argument("--output", "-o", default=DEFAULT_OUTPUT, help="结果 JSON 文件")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("latency", help="拔出到锁屏的分阶段延迟")
+    p.add_argument("--runs", type=int, default=2000)
+    p.add_argument("--warmup", type=int, default=50)
+    p.add_argument("--baseline", help="基线结果 JSON，用于检测回归")
+    p.add_argument("--tolerance", type=float, default=0.25, help="p95 允许的相对增幅")
+    p.set_defaults(func=bench_latency)
+
+    p = sub.add_parser("wmi-watch", help="WMI 订阅的空闲唤醒次数与最坏检测延迟（使用 wmi 替身）")
+    p.add_argument("--idle", type=float, default=5.0, help="空闲观测秒数")
+    p.add_argument("--runs", type=int, default=100)
+    p.set_defaults(func=bench_wmi_watch)
+
+    p = sub.add_parser("inventory", help="全量扫描与设备清单缓存查询的耗时对比（使用 wmi 替身）")
+    p.add_argument("--devices", type=int, default=2000, help="模拟的 USB 实体数量")
+    p.add_argument("--entity-cost", type=float, default=20.0, help="每个实体的模拟 COM 读取开销（微秒）")
+    p.add_argument("--cold-runs", type=int, default=5)
+    p.add_argument("--lookups", type=int, default=10000)
+    p.set_defaults(func=bench_inventory)
+
+    p = sub.add_parser("wmi-connections", help="WMI 连接复用与服务重启后的重连（使用 wmi 替身）")
+    p.add_argument("--scans", type=int, default=20, help="模拟设置窗口扫描与在位检查的次数")
+    p.add_argument("--connect-cost", type=float, default=50.0, help="模拟的连接握手耗时（毫秒）")
+    p.set_defaults(func=bench_wmi_connections)
+
+    p = sub.add_parser("startup", help="导入耗时（-X importtime）与进程启动到监控就绪的时间")
+    p.add_argument("--runs", type=int, default=10)
+    p.add_argument("--backend", default="fake", help="fake / udev / wmi / auto")
+    p.add_argument("--top", type=int, default=10, help="列出导入最慢的模块数")
+    p.add_argument("--budget-ms", type=float, default=None, help="time-to-armed 中位数预算，超出时返回非零")
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser("countdown", help="事件循环卡顿时倒计时锁屏时刻的偏差")
+    p.add_argument("--seconds", type=int, default=3)
+    p.add_argument("--runs", type=int, default=3)
+    p.add_argument("--stall-ms", type=float, default=300, help="每次阻塞事件循环的时长")
+    p.add_argument("--stall-every-ms", type=int, default=400, help="阻塞间隔")
+    p.add_argument("--hook-ms", type=float, default=100, help="锁屏动作耗时，应计入记录的偏差")
+    p.add_argument("--tolerance-ms", type=float, default=50, help="扣除锁屏动作后允许的最大偏差，超出时返回非零")
+    p.set_defaults(func=bench_countdown)
+
+    p = sub.add_parser("keyhook", help="常驻键盘钩子与仅倒计时期间钩子的回调次数对比")
+    p.add_argument("--keys-per-min", type=int, default=200)
+    p.add_argument("--countdowns", type=int, default=4, help="每小时倒计时次数")
+    p.add_argument("--seconds", type=int, default=5, help="倒计时秒数")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_keyhook)
+
+    p = sub.add_parser("flap", help="去抖/抖动检测状态机的场景回放与吞吐")
+    p.add_argument("--rate", type=float, default=50, help="抖动事件速率（次/秒）")
+    p.add_argument("--events", type=int, default=100000, help="状态机吞吐测试的原始事件数")
+    p.add_argument("--bursts", type=int, default=3)
+    p.add_argument("--burst-len", type=int, default=10)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_flap)
+
+    p = sub.add_parser("replay", help="追踪文件的回放速度、确定性与实时录制核对")
+    p.add_argument("--hours", type=float, default=8, help="合成追踪的时长")
+    p.add_argument("--live-events", type=int, default=20, help="实时录制阶段注入的事件数")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_replay)
+
+    p = sub.add_parser("metrics", help="指标记录开销与内存分配检查")
+    p.add_argument("--calls", type=int, default=1000000)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_metrics)
+
+    p = sub.add_parser("reconfig", help="反复修改配置时插拔事件是否丢失（restart 对照）")
+    p.add_argument("--pairs", type=int, default=200, help="拔出/插回的次数")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_reconfig)
+
+    p = sub.add_parser("config", help="配置写入崩溃安全、合并写入与热加载")
+    p.add_argument("--kills", type=int, default=30, help="写入过程中强制结束子进程的次数")
+    p.add_argument("--updates", type=int, default=1000, help="连续 update 次数")
+    p.add_argument("--watch-interval", type=float, default=0.2)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_config)
+
+    p = sub.add_parser("forward", help="事件转发在收集端断开、确认丢失和进程重启时的完整性")
+    p.add_argument("--events", type=int, default=2000)
+    p.add_argument("--rate", type=float, default=1000, help="每秒产生的事件数")
+    p.add_argument("--batch-size", type=int, default=50)
+    p.add_argument("--outages", type=int, default=2, help="收集端下线次数")
+    p.add_argument("--outage-seconds", type=float, default=0.5)
+    p.add_argument("--drop-ack-every", type=int, default=7, help="每 N 批丢弃一次确认，0 为不丢弃")
+    p.add_argument("--timeout", type=float, default=15.0, help="等待全部送达的最长时间")
+    p.set_defaults(func=bench_forward)
+
+    p = sub.add_parser("core", help="事件循环核心的场景核对与线程数、上下文切换对比")
+    p.add_argument("--cycles", type=int, default=500, help="拔出/插入次数")
+    p.set_defaults(func=bench_core)
+
+    p = sub.add_parser("dispatch", help="突发拔插下界面分派的弹窗数量、跨线程 Tk 调用与溢出处理")
+    p.add_argument("--cycles", type=int, default=5000, help="拔插事件数")
+    p.add_argument("--rate", type=float, default=5000, help="direct/batched 场景每秒注入的事件数")
+    p.add_argument("--max-pending", type=int, default=64, help="溢出场景的队列上限")
+    p.add_argument("--stall", type=float, default=0.5, help="溢出场景中 Tk 线程开始分派前的阻塞时间（秒）")
+    p.set_defaults(func=bench_dispatch)
+
+    p = sub.add_parser("storm", help="事件风暴下的批量合并、拔出判定延迟与收件箱溢出处理")
+    p.add_argument("--rate", type=float, default=10000, help="每秒注入的扩展坞事件数")
+    p.add_argument("--seconds", type=float, default=3.0)
+    p.add_argument("--dock-devices", type=int, default=16, help="反复插拔的扩展坞设备数")
+    p.add_argument("--key-every", type=float, default=0.2, help="密钥拔出周期（秒）")
+    p.add_argument("--budget-ms", type=float, default=50, help="批处理拔出判定 p99 预算，超出时返回非零")
+    p.add_argument("--inbox-limit", type=int, default=1000, help="溢出场景的收件箱上限")
+    p.add_argument("--stall", type=float, default=0.5, help="溢出场景中事件循环被阻塞的时间（秒）")
+    p.set_defaults(func=bench_storm)
+
+    p = sub.add_parser("popup", help="倒计时弹窗从 show 到首次绘制的耗时：每次新建与预构建窗口对比（需要图形界面）")
+    p.add_argument("--runs", type=int, default=30)
+    p.add_argument("--busy", type=int, default=0, help="后台占用 CPU 的线程数")
+    p.set_defaults(func=bench_popup)
+
+    p = sub.add_parser("scan", help="流式设备扫描的首个设备时间、重复刷新合并、取消与超时（使用 wmi 替身）")
+    p.add_argument("--devices", type=int, default=300, help="模拟的 USB 实体数量")
+    p.add_argument("--entity-cost", type=float, default=1000.0, help="每个实体的模拟 COM 读取开销（微秒）")
+    p.add_argument("--clicks", type=int, default=10, help="连续点击刷新的次数")
+    p.set_defaults(func=bench_scan)
+
+    p = sub.add_parser("devlist", help="设备列表渲染耗时与控件数量随设备数的变化（旧版重建对照）")
+    p.add_argument("--sizes", default="100,1000,5000,20000", help="逗号分隔的设备数")
+    p.add_argument("--widget-cost", type=float, default=800.0, help="创建一个行控件的模拟开销（微秒）")
+    p.add_argument("--configure-cost", type=float, default=100.0, help="重新配置一个行控件的模拟开销（微秒）")
+    p.add_argument("--legacy-max", type=int, default=5000, help="对照组只测到这个设备数")
+    p.add_argument("--budget-ms", type=float, default=50, help="最大设备数下刷新与过滤的耗时预算")
+    p.set_defaults(func=bench_devlist)
+
+    p = sub.add_parser("lockpipe", help="锁屏流水线：桩后端与慢钩子下的行为核对、锁屏时刻分布与钩子耗时")
+    p.add_argument("--runs", type=int, default=20, help="经 AsyncCore 拔出到锁屏的次数")
+    p.add_argument("--deadline-ms", type=float, default=200, help="锁屏前钩子的总时限")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_lockpipe)
+
+    p = sub.add_parser("broker", help="多会话设备代理的负载测试：密钥隔离、扇出延迟、卡死与断开的会话")
+    p.add_argument("--sessions", type=int, nargs="+", default=[300, 30], help="订阅代理的轻量会话数，可给出多个规模依次测试")
+    p.add_argument("--stalled", type=int, default=10, help="订阅后从不读取的会话数")
+    p.add_argument("--dead", type=int, default=50, help="订阅后立即断开的会话数")
+    p.add_argument("--events", type=int, default=3000, help="发往单个会话密钥的事件数")
+    p.add_argument("--rate", type=float, default=1000, help="定向事件速率（个/秒）")
+    p.add_argument("--broadcasts", type=int, default=300, help="所有会话共享的密钥上的事件数（测扇出延迟）")
+    p.add_argument("--broadcast-rate", type=float, default=50, help="共享密钥事件速率（个/秒）")
+    p.add_argument("--burst", type=int, default=1000, help="之后一次突发的共享密钥事件数（卡死的会话在此期间被断开）")
+    p.add_argument("--buffer-kb", type=int, default=32, help="代理对单个会话的写入积压上限")
+    p.add_argument("--sndbuf-kb", type=int, default=16, help="代理连接的内核发送缓冲")
+    p.add_argument("--budget-ms", type=float, default=None, help="共享密钥扇出 p99 预算，超出时返回非零")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_broker)
+
+    p = sub.add_parser("audit", help="审计日志：emit 开销、轮转压缩、稀疏索引查询与全量扫描对比、崩溃场景")
+    p.add_argument("--days", type=int, default=180, help="生成的历史天数")
+    p.add_argument("--per-day", type=int, default=2000, help="每天的审计记录数")
+    p.add_argument("--users", type=int, default=20)
+    p.add_argument("--max-kb", type=int, default=4096, help="当前段的轮转大小")
+    p.add_argument("--budget-ms", type=float, default=None, help="单次索引查询的耗时预算，超出时返回非零")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_audit)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,610 @@
+"""
+USB AutoLocker 回归测试
+
+每个用例复现一条曾经出错的路径：WMI 替身、FakeBackend 驱动核心，HeadlessRoot 代替 Tk，
+无需 USB 硬件和图形界面。
+
+用法:
+    python -m pytest -q test_autolocker.py
+    python -m unittest test_autolocker
+"""
+import io
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+import AutoLocker as al
+import benchmark as bench
+
+
+class QuietTestCase(unittest.TestCase):
+    """屏蔽被测代码的进度输出"""
+
+    def setUp(self):
+        quiet = redirect_stdout(io.StringIO())
+        quiet.__enter__()
+        self.addCleanup(quiet.__exit__, None, None, None)
+
+
+class DeviceBackendTest(QuietTestCase):
+    KEY = f"{bench.CORE_VID}&{bench.CORE_PID}"
+
+    def test_fake_backend_drives_monitor(self):
+        """FakeBackend 注入的插拔经监控线程判定：无关设备不触发，拔出、插入各回调一次"""
+        backend = al.FakeBackend(present=[self.KEY])
+        monitor = al.USBMonitor(bench._core_config(insert_debounce_ms=0, flap_limit=0), backend=backend)
+        removed, inserted = [], []
+        monitor.on_device_removed = lambda: removed.append(1)
+        monitor.on_device_inserted = lambda: inserted.append(1)
+        monitor.start()
+        try:
+            self.assertTrue(monitor.device_present)
+            backend.inject("remove", "VID_0001", "PID_0002")
+            backend.inject("remove", bench.CORE_VID, bench.CORE_PID)
+            self.assertTrue(bench._wait_for(lambda: removed, 2.0))
+            self.assertFalse(monitor.device_present)
+            backend.inject("add", bench.CORE_VID, bench.CORE_PID)
+            self.assertTrue(bench._wait_for(lambda: inserted, 2.0))
+            self.assertEqual((len(removed), len(inserted)), (1, 1))
+        finally:
+            monitor.stop()
+        self.assertIsNone(monitor.thread)
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "netlink 仅 Linux 可用")
+    def test_udev_backend_close_releases_fds(self):
+        """UdevBackend 反复 open/close（出错重建订阅）不泄漏文件描述符"""
+        config = bench._core_config().config
+        before = len(os.listdir("/proc/self/fd"))
+        backend = al.UdevBackend()
+        for _ in range(5):
+            try:
+                backend.open(config)
+            except OSError as e:
+                self.skipTest(f"无法打开 netlink: {e}")
+            backend.wake()
+            self.assertIsNone(backend.wait(0))
+            backend.close()
+        backend.wake()  # 关闭后唤醒为空操作
+        self.assertEqual(len(os.listdir("/proc/self/fd")), before)
+
+
+class HeadlessImportTest(unittest.TestCase):
+    def test_latency_bench_without_gui_packages(self):
+        """没有 PIL/pystray/Tk 等 GUI 依赖的 Linux 服务器上也能导入两个模块并跑延迟基准"""
+        here = os.path.dirname(os.path.abspath(__file__))
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        output = os.path.join(workdir.name, "latency.json")
+        script = (
+            "import runpy, sys\n"
+            "for name in ('tkinter', 'customtkinter', 'PIL', 'pystray', 'pynput'):\n"
+            "    sys.modules[name] = None  # 导入即 ImportError，等同未安装\n"
+            f"sys.argv = ['benchmark.py', '-o', {output!r}, 'latency', '--runs', '20']\n"
+            "runpy.run_path('benchmark.py', run_name='__main__')\n"
+        )
+        result = subprocess.run([sys.executable, "-c", script], cwd=here, capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertTrue(os.path.exists(output))
+
+
+class KeyPolicyTest(QuietTestCase):
+    RULES = [al.DeviceRule(f"VID_000{i}", "PID_0001") for i in range(1, 4)]
+
+    def test_any_and_all(self):
+        any_policy = al.KeyPolicy(self.RULES, "any")
+        self.assertEqual([any_policy.satisfied(n) for n in range(4)], [False, True, True, True])
+        all_policy = al.KeyPolicy(self.RULES, "all")
+        self.assertEqual([all_policy.satisfied(n) for n in range(4)], [False, False, False, True])
+
+    def test_quorum_boundaries(self):
+        """quorum 恰好达到即满足、差一把不满足；超出密钥数按全部在位、小于 1 按 1 计"""
+        policy = al.KeyPolicy(self.RULES, "quorum", 2)
+        self.assertEqual([policy.satisfied(n) for n in range(4)], [False, False, True, True])
+        self.assertEqual(al.KeyPolicy(self.RULES, "quorum", 5).required, 3)
+        self.assertEqual(al.KeyPolicy(self.RULES, "quorum", 0).required, 1)
+        self.assertEqual(al.KeyPolicy(self.RULES[:1], "quorum", 2).describe(), "quorum (1/1)")
+
+    def test_unknown_mode_falls_back_to_any(self):
+        policy = al.KeyPolicy(self.RULES, "majority", 3)
+        self.assertEqual((policy.mode, policy.required), ("any", 1))
+        self.assertTrue(policy.satisfied(1))
+
+    def test_match_ignores_case(self):
+        policy = al.KeyPolicy(self.RULES, "all")
+        self.assertEqual(policy.match("vid_0002&pid_0001"), self.RULES[1])
+        self.assertIsNone(policy.match("VID_0009&PID_0001"))
+
+
+class LockHistoryTest(QuietTestCase):
+    def test_history_records_completion_after_lock_action(self):
+        """倒计时锁屏在锁屏动作完成后记录计划/实际时刻，经 status 查询；记录归各实例所有"""
+        backend = al.FakeBackend(present=[f"{bench.CORE_VID}&{bench.CORE_PID}"])
+        config_manager = bench._core_config(countdown_seconds=1)
+        core = al.AsyncCore(config_manager, al.USBMonitor(config_manager, backend=backend),
+                            lock_action=lambda: time.sleep(0.2), control=False)
+        core.start()
+        try:
+            backend.inject("remove", bench.CORE_VID, bench.CORE_PID)
+            self.assertTrue(bench._wait_for(lambda: core.lock_history, 5.0))
+            history = core.call(core.status)["lock_history"]
+        finally:
+            core.stop()
+        self.assertEqual(len(history), 1)
+        self.assertGreaterEqual(history[0]["actual"] - history[0]["scheduled"], 0.2)
+        self.assertLess(abs(history[0]["actual"] - time.time()), 5.0)  # 墙上时间
+        other = al.LockDaemon(bench._core_config(), al.USBMonitor(bench._core_config(), backend=al.FakeBackend()),
+                              lock_action=lambda: None)
+        self.assertEqual(len(other.lock_history), 0)
+
+
+class ReplayTest(QuietTestCase):
+    def setUp(self):
+        super().setUp()
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self.trace = os.path.join(workdir.name, "synthetic.trace")
+        bench.synthesize_trace(self.trace, 0.5, 1, bench.CORE_VID, bench.CORE_PID)
+
+    def test_replay_leaves_no_temp_dir_or_queued_events(self):
+        daemons = []
+
+        class RecordingDaemon(al.LockDaemon):
+            def arm(self):
+                daemons.append(self)
+                super().arm()
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        with mock.patch.object(al, "LockDaemon", RecordingDaemon), mock.patch.object(tempfile, "tempdir", tmp.name):
+            result = al.replay_trace(self.trace)
+        self.assertTrue(result["decisions"])
+        self.assertEqual(os.listdir(tmp.name), [])
+        self.assertEqual(daemons[0]._outbox.qsize(), 0)
+
+    def test_replay_aborts_when_monitor_thread_dies(self):
+        """监控线程异常退出时回放报错返回，而不是永远等待回放结束"""
+        with mock.patch.object(al.USBMonitor, "process_batch", side_effect=RuntimeError("模拟崩溃")), \
+                mock.patch.object(al, "REPLAY_POLL_SECONDS", 0.05), mock.patch("threading.excepthook"):
+            t0 = time.monotonic()
+            with self.assertRaises(RuntimeError):
+                al.replay_trace(self.trace)
+        self.assertLess(time.monotonic() - t0, 5.0)
+
+
+class WMIConnectionTest(QuietTestCase):
+    DEVICE_ID = "USB\\VID_1050&PID_0407\\0001"
+
+    def test_connection_reused_and_rebuilt_after_service_restart(self):
+        """同一线程上反复查询只建一次连接；WMI 服务重启后调用失败，重连一次并重试成功"""
+        module = bench.StandInWMI()
+        module.entities[self.DEVICE_ID] = "YubiKey"
+        backend = al.WMIBackend()
+        with bench.standin_wmi(module):
+            al.WMI_CONNECTIONS.invalidate()
+            self.addCleanup(al.WMI_CONNECTIONS.invalidate)
+            for _ in range(5):
+                self.assertEqual(backend.find_instances("VID_1050", "PID_0407"), [self.DEVICE_ID])
+            self.assertEqual(module.connections, 1)
+
+            module.restart_service()
+            self.assertEqual(backend.find_instances("VID_1050", "PID_0407"), [self.DEVICE_ID])
+            self.assertEqual(module.connections, 2)
+
+
+class AsyncCoreTest(QuietTestCase):
+    """FakeBackend 作为事件源驱动 AsyncCore 的事件循环"""
+
+    def start_core(self, **overrides):
+        self.backend = al.FakeBackend(present=[f"{bench.CORE_VID}&{bench.CORE_PID}"])
+        config_manager = bench._core_config(**overrides)
+        self.locks = []
+        core = al.AsyncCore(config_manager, al.USBMonitor(config_manager, backend=self.backend),
+                            lock_action=lambda: self.locks.append(time.monotonic()), control=False)
+        self.events = []
+        core.subscribe(lambda event: self.events.append(event["event"]))
+        core.start()
+        self.addCleanup(core.stop)
+        return core
+
+    def inject(self, action: str):
+        self.backend.inject(action, bench.CORE_VID, bench.CORE_PID)
+
+    def test_countdown_locks_at_deadline(self):
+        core = self.start_core(countdown_seconds=1)
+        t0 = time.monotonic()
+        self.inject("remove")
+        self.assertTrue(bench._wait_for(lambda: "locked" in self.events, 3.0))
+        self.assertEqual(self.events, ["removed", "countdown", "locked"])
+        self.assertEqual(len(self.locks), 1)
+        self.assertGreaterEqual(self.locks[0] - t0, 0.99)
+        self.assertIsNone(core.call(core.status)["countdown_remaining"])
+
+    def test_reinsert_cancels_countdown(self):
+        self.start_core(countdown_seconds=1, insert_debounce_ms=0)
+        self.inject("remove")
+        self.assertTrue(bench._wait_for(lambda: "countdown" in self.events, 2.0))
+        self.inject("add")
+        time.sleep(1.2)
+        self.assertEqual(self.events, ["removed", "countdown", "inserted", "cancelled"])
+        self.assertFalse(self.locks)
+
+    def test_control_commands_run_on_loop(self):
+        """控制命令经 call 转到事件循环线程执行：禁用后拔出不倒计时、不锁屏"""
+        core = self.start_core(countdown_seconds=0)
+        threads = []
+        core.call(lambda: threads.append(threading.current_thread()))
+        self.assertIs(threads[0], core.thread)
+        self.assertEqual(core.call(core.handle_command, "disable"), {"ok": True, "enabled": False})
+        self.inject("remove")
+        self.assertTrue(bench._wait_for(lambda: "removed" in self.events, 2.0))
+        time.sleep(0.1)
+        self.assertNotIn("countdown", self.events)
+        self.assertFalse(self.locks)
+
+
+class COMThreadTest(QuietTestCase):
+    DEVICE_ID = "USB\\VID_1050&PID_0407\\0001"
+
+    def test_core_loop_thread_queries_wmi(self):
+        """在位检查、reconfigure 在事件循环线程上调用 WMI，该线程须已 CoInitialize"""
+        module = bench.StandInWMI()
+        module.entities[self.DEVICE_ID] = "YubiKey"
+        locks = []
+        with bench.standin_wmi(module):
+            config_manager = bench._core_config(countdown_seconds=0)
+            core = al.AsyncCore(config_manager, al.USBMonitor(config_manager, backend=al.WMIBackend()),
+                                lock_action=lambda: locks.append(1), control=False)
+            core.start()
+            try:
+                self.assertTrue(core.call(lambda: core.usb_monitor.device_present))
+                core.call(core.usb_monitor.reconfigure)
+                self.assertTrue(core.call(lambda: core.usb_monitor.device_present))
+                module.emit("deletion", self.DEVICE_ID)
+                self.assertTrue(bench._wait_for(lambda: bool(locks), 5.0))
+            finally:
+                core.stop()
+
+    def test_broker_loop_thread_queries_wmi(self):
+        module = bench.StandInWMI()
+        module.entities[self.DEVICE_ID] = "YubiKey"
+        with bench.standin_wmi(module):
+            broker = al.DeviceBroker(bench._core_config(broker_port=0), backend=al.WMIBackend())
+            broker.start()
+            try:
+                backend = al.BrokerBackend()
+                backend.port = broker.port
+                self.assertEqual(backend.find_instances("VID_1050", "PID_0407"), [self.DEVICE_ID])
+            finally:
+                broker.stop()
+
+
+class BrokerStartupTest(QuietTestCase):
+    CORE_KEY = f"{bench.CORE_VID}&{bench.CORE_PID}"
+
+    def test_session_started_before_broker_retries(self):
+        """会话先于代理启动：连不上代理时按重建节奏重试，代理起来后拔出仍会锁屏"""
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        locks = []
+        config_manager = bench._core_config(broker_port=port, countdown_seconds=0)
+        core = al.AsyncCore(config_manager, al.USBMonitor(config_manager, backend=al.BrokerBackend()),
+                            lock_action=lambda: locks.append(1), control=False)
+        core.REOPEN_DELAY = 0.1
+        core.start()
+        broker = None
+        try:
+            status = core.call(core.status)
+            self.assertFalse(status["armed"])
+            self.assertTrue(core.usb_monitor.running)
+
+            fake = al.FakeBackend(present=[self.CORE_KEY])
+            broker = al.DeviceBroker(bench._core_config(broker_port=port), backend=fake)
+            broker.start()
+            self.assertTrue(bench._wait_for(lambda: core.call(core.status)["armed"], 5.0))
+            self.assertTrue(bench._wait_for(lambda: core.call(lambda: core.usb_monitor.device_present), 5.0))
+
+            fake.inject("remove", bench.CORE_VID, bench.CORE_PID)
+            self.assertTrue(bench._wait_for(lambda: bool(locks), 5.0))
+        finally:
+            core.stop()
+            if broker:
+                broker.stop()
+
+    @unittest.skipUnless(sys.platform.startswith("linux") and os.geteuid() == 0, "需要 Linux root 以其他用户身份监听")
+    def test_impostor_broker_rejected(self):
+        """其他用户抢先占用代理端口并回复伪造快照：会话拒绝连接，不采信在位状态"""
+        impostor = subprocess.Popen([sys.executable, "-c", (
+            "import json, os, socket\n"
+            "s = socket.socket(); s.bind(('127.0.0.1', 0)); s.listen(); os.setuid(65534)\n"
+            "print(s.getsockname()[1], flush=True)\n"
+            "while True:\n"
+            "    c, _ = s.accept(); c.recv(65536)\n"
+            "    c.sendall((json.dumps({'event': 'snapshot', 'present': {%r: ['fake']}}) + '\\n').encode())\n"
+        ) % self.CORE_KEY], stdout=subprocess.PIPE, text=True)
+        self.addCleanup(impostor.kill)
+        port = int(impostor.stdout.readline())
+        backend = al.BrokerBackend()
+        backend.configure(bench._core_config(broker_port=port).config)
+        with self.assertRaises(ConnectionRefusedError):
+            backend.query([self.CORE_KEY])
+        with self.assertRaises(ConnectionRefusedError):
+            backend.open(bench._core_config(broker_port=port).config)
+
+
+class DrainErrorBackend(al.FakeBackend):
+    """取出一批事件的中途（wait(0)）断开一次"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fail_drain = True
+        self.opens = 0
+
+    def open(self, config):
+        self.opens += 1
+
+    def wait(self, timeout=None):
+        if timeout == 0 and self.fail_drain:
+            self.fail_drain = False
+            raise OSError("模拟断开")
+        return super().wait(timeout)
+
+
+class RemoveDuringQueryBackend(al.FakeBackend):
+    """reconfigure 核对在位实例的同时密钥被拔出：在 find_instances 里注入一次拔出"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.remove_on_query: tuple = ()
+
+    def find_instances(self, vid, pid):
+        if self.remove_on_query:
+            key, self.remove_on_query = self.remove_on_query, ()
+            self.inject("remove", *key)
+        return super().find_instances(vid, pid)
+
+
+class MonitorLoopTest(QuietTestCase):
+    def test_backend_error_during_drain(self):
+        """批量取事件时后端出错：监控线程存活、已取到的拔出照常处理，并重建订阅"""
+        backend = DrainErrorBackend(present=[f"{bench.CORE_VID}&{bench.CORE_PID}"])
+        config_manager = bench._core_config(insert_debounce_ms=0, flap_limit=0)
+        monitor = al.USBMonitor(config_manager, backend=backend)
+        monitor.REOPEN_DELAY = 0.05
+        removed, inserted = [], []
+        monitor.on_device_removed = lambda: removed.append(1)
+        monitor.on_device_inserted = lambda: inserted.append(1)
+        monitor.start()
+        try:
+            backend.inject("remove", bench.CORE_VID, bench.CORE_PID)
+            self.assertTrue(bench._wait_for(lambda: len(removed) == 1 and backend.opens == 2, 5.0))
+            backend.inject("add", bench.CORE_VID, bench.CORE_PID)
+            self.assertTrue(bench._wait_for(lambda: len(inserted) == 1, 5.0))
+            backend.inject("remove", bench.CORE_VID, bench.CORE_PID)
+            self.assertTrue(bench._wait_for(lambda: len(removed) == 2, 5.0))
+            self.assertTrue(monitor.thread.is_alive())
+        finally:
+            monitor.stop()
+
+    def test_removal_during_reconfigure_not_lost(self):
+        """运行中改配置（加一把额外密钥）的同时拔出主密钥：不停止监听，拔出恰好判定一次"""
+        backend = RemoveDuringQueryBackend(present=[f"{bench.CORE_VID}&{bench.CORE_PID}"])
+        config_manager = bench._core_config(insert_debounce_ms=0, flap_limit=0)
+        monitor = al.USBMonitor(config_manager, backend=backend)
+        removed = []
+        monitor.on_device_removed = lambda: removed.append(1)
+        monitor.start()
+        try:
+            thread = monitor.thread
+            config_manager.update(extra_devices=[{"vid": "VID_0001", "pid": "PID_0002", "name": "备用"}], policy="any")
+            backend.remove_on_query = (bench.CORE_VID, bench.CORE_PID)
+            monitor.reconfigure()
+            self.assertTrue(bench._wait_for(lambda: len(removed) == 1, 2.0))
+            time.sleep(0.2)  # 队列里的拔出事件处理完后也不会再判定一次
+            self.assertEqual(len(removed), 1)
+            self.assertIs(monitor.thread, thread)
+        finally:
+            monitor.stop()
+
+
+class ForwarderTest(QuietTestCase):
+    def test_spooled_events_delivered_in_order_after_outage(self):
+        """收集端下线期间的事件写入暂存，恢复后先补发暂存再发新事件：齐全、有序"""
+        collector = bench.StandInCollector()
+        collector.up()
+        self.addCleanup(collector.down)
+        spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spool_dir.cleanup)
+        forwarder = al.EventForwarder(f"tcp://127.0.0.1:{collector.port}", spool_dir.name, batch_size=5, interval=0.05)
+        forwarder.MAX_BACKOFF = 0.2
+        self.addCleanup(forwarder.close)
+        for i in range(5):
+            forwarder.emit("removed", index=i)
+        self.assertTrue(bench._wait_for(lambda: collector.check(forwarder.session, 5)["missing"] == 0, 5.0))
+
+        collector.down()
+        collector.down()  # 重复下线为空操作
+        for i in range(5, 20):
+            forwarder.emit("locked", index=i)
+        self.assertTrue(bench._wait_for(lambda: forwarder.spooled > 0, 5.0))
+        collector.up()
+        for i in range(20, 25):
+            forwarder.emit("inserted", index=i)
+        self.assertTrue(bench._wait_for(lambda: collector.check(forwarder.session, 25)["missing"] == 0, 10.0))
+        self.assertEqual(collector.check(forwarder.session, 25)["out_of_order"], 0)
+
+
+class _StubListener:
+    def __init__(self, callback):
+        self.running = False
+
+    def start(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+
+class CountdownPopupTest(QuietTestCase):
+    def test_stale_close_keeps_next_countdown_hook(self):
+        """取消后"已取消"提示的延迟 close 不能卸下紧接着的新倒计时的键盘钩子"""
+        root = bench.HeadlessRoot()
+        hook = al.ShiftCancelHook(lambda: None, listener_factory=_StubListener)
+        first = bench.HeadlessPopup(root, 30, key_hook=hook)
+        first.show()
+        first.cancel()
+        first._tick()  # 显示"已取消"，1.5 秒后 close
+        first.close()  # 与 _show_countdown 相同：新倒计时前先关掉旧提示
+        second = bench.HeadlessPopup(root, 30, key_hook=hook)
+        second.show()
+        closed_at = time.monotonic() + 1.6
+        root.run_until(lambda: time.monotonic() >= closed_at, timeout=3.0)
+        self.assertTrue(hook.armed)
+        second.close()
+        self.assertFalse(hook.armed)
+
+    def test_countdown_stays_on_tk_thread(self):
+        """到期与提前结束都只在 Tk 线程上调用 after 和 on_complete，弹窗不另起线程"""
+        root = bench.HeadlessRoot()
+        callers = []
+        after = root.after
+        root.after = lambda *args: (callers.append(threading.current_thread()), after(*args))[1]
+        completed = []
+        popup = bench.HeadlessPopup(root, 1, on_complete=lambda: completed.append(threading.current_thread()))
+        threads = threading.active_count()
+        popup.show()
+        self.assertEqual(threading.active_count(), threads)
+        self.assertTrue(root.run_until(lambda: completed, timeout=3.0))
+        self.assertFalse(popup.is_showing)
+
+        flapping = bench.HeadlessPopup(root, 30, on_complete=lambda: completed.append(threading.current_thread()))
+        flapping.show()
+        flapping.expire()
+        self.assertFalse(flapping.is_showing)
+        self.assertFalse(flapping.cancel())
+        self.assertEqual(set(callers + completed), {threading.current_thread()})
+        self.assertEqual(len(completed), 2)
+
+
+class ConfigWriteTest(QuietTestCase):
+    def test_invalid_update_rejected(self):
+        """设置窗口填入不合法的 VID：update 抛出 ConfigError，内存、文件和 .bak 都保持上次的有效配置"""
+        config_manager = bench._core_config()
+        config_manager.update(device_vid="VID_1234")
+        self.assertTrue(config_manager.flush())
+        with self.assertRaises(al.ConfigError):
+            config_manager.update(device_vid="VID_XYZ", countdown_seconds=10)
+        self.assertEqual(config_manager.config.device_vid, "VID_1234")
+        self.assertEqual(config_manager.config.countdown_seconds, bench._core_config().config.countdown_seconds)
+        self.assertTrue(config_manager.flush())
+
+        restarted = al.ConfigManager(config_manager.config_path)
+        self.assertEqual(restarted.config.device_vid, "VID_1234")
+
+    def test_invalid_save_keeps_backup(self):
+        """直接保存不合法的配置被拒绝，.bak 仍是上次有效的配置，主文件损坏后重启回退到它"""
+        config_manager = bench._core_config(device_vid="VID_1234")
+        self.assertTrue(config_manager.save())
+        broken = al.AppConfig(device_vid="VID_XYZ")
+        self.assertFalse(config_manager.save(broken))
+        self.assertEqual(config_manager.config.device_vid, "VID_1234")
+
+        with open(config_manager.config_path, 'w', encoding='utf-8') as f:
+            f.write("{")
+        restarted = al.ConfigManager(config_manager.config_path)
+        self.assertEqual(restarted.config.device_vid, "VID_1234")
+
+
+class LockPipelineTest(QuietTestCase):
+    DEADLINE = 0.2
+
+    def lock(self, hooks, backends=None):
+        backends = backends or [bench.StubLockBackend("stub")]
+        pipeline = al.LockPipeline(backends, hooks, hook_deadline=self.DEADLINE)
+        t0 = time.perf_counter()
+        report = pipeline.lock()
+        return pipeline, report, {r["name"]: r["result"] for r in report["hooks"]}, backends, t0
+
+    def test_slow_hook_does_not_delay_lock_past_deadline(self):
+        """变慢的钩子到截止时间判为超时并立即锁屏；之后跑完也不改写本次结果"""
+        slow = bench.StubHook("slow", delay=self.DEADLINE * 3)
+        pipeline, report, results, backends, t0 = self.lock([bench.StubHook("fast", 0.01), slow])
+        self.assertEqual(results, {"fast": "ok", "slow": "timeout"})
+        self.assertGreaterEqual(backends[0].calls[0] - t0, self.DEADLINE)
+        self.assertLess(backends[0].calls[0] - t0, self.DEADLINE + 0.1)
+        self.assertTrue(slow.finished.wait(2.0))
+        time.sleep(0.05)
+        self.assertEqual(pipeline.history[-1]["hooks"][1]["result"], "timeout")
+        self.assertEqual(pipeline.stats()["slow"]["timeouts"], 1)
+
+    def test_hung_and_failing_hooks_still_lock(self):
+        hung = bench.StubHook("hung", hang=True)
+        self.addCleanup(hung.release.set)
+        _, report, results, backends, _ = self.lock([hung, bench.StubHook("broken", fail=True)])
+        self.assertEqual(results, {"hung": "timeout", "broken": "error"})
+        self.assertEqual(report["backend"], "stub")
+
+    def test_failing_backend_falls_through(self):
+        backends = [bench.StubLockBackend("first", fail=True), bench.StubLockBackend("second")]
+        _, report, _, _, _ = self.lock([], backends)
+        self.assertEqual(report["backend"], "second")
+        self.assertEqual([len(b.calls) for b in backends], [1, 1])
+
+
+class LockPipelineOffLoopTest(QuietTestCase):
+    def test_slow_hook_does_not_block_core_loop(self):
+        """锁屏前动作卡到截止时间：期间事件循环仍响应控制命令和设备事件，锁屏完成后才广播 locked"""
+        hook = bench.StubHook("slow", hang=True)
+        self.addCleanup(hook.release.set)
+        backend_lock = bench.StubLockBackend("stub")
+        pipeline = al.LockPipeline([backend_lock], [hook], hook_deadline=1.0)
+        backend = al.FakeBackend(present=[f"{bench.CORE_VID}&{bench.CORE_PID}"])
+        config_manager = bench._core_config(countdown_seconds=0, insert_debounce_ms=0, flap_limit=0)
+        core = al.AsyncCore(config_manager, al.USBMonitor(config_manager, backend=backend),
+                            lock_action=pipeline, control=False)
+        events = []
+        core.subscribe(lambda event: events.append((event["event"], time.perf_counter())))
+        core.start()
+        try:
+            backend.inject("remove", bench.CORE_VID, bench.CORE_PID)
+            self.assertTrue(bench._wait_for(lambda: any(name == "removed" for name, _ in events), 2.0))
+            time.sleep(0.1)  # 倒计时为 0，流水线已开始等钩子
+            t0 = time.perf_counter()
+            core.call(core.status)
+            backend.inject("add", bench.CORE_VID, bench.CORE_PID)
+            self.assertTrue(bench._wait_for(lambda: any(name == "inserted" for name, _ in events), 0.5))
+            self.assertLess(time.perf_counter() - t0, 0.5)
+            self.assertFalse(backend_lock.calls)  # 流水线仍在等钩子
+
+            self.assertTrue(bench._wait_for(lambda: any(name == "locked" for name, _ in events), 3.0))
+            locked_at = next(at for name, at in events if name == "locked")
+            self.assertEqual(len(backend_lock.calls), 1)
+            self.assertGreaterEqual(locked_at, backend_lock.calls[0])
+        finally:
+            core.stop()
+
+
+
+class AuditConfigTest(QuietTestCase):
+    def test_audit_log_is_opt_in(self):
+        """默认不写审计日志，--audit 查询提示未启用；设置 audit_dir 后才在配置目录下建立日志"""
+        config_manager = bench._core_config()
+        self.assertIsNone(al.AuditLog.from_config(config_manager))
+        with self.assertRaises(SystemExit) as exit_info:
+            al.main(["--config", config_manager.config_path, "--audit"])
+        self.assertEqual(exit_info.exception.code, 2)
+
+        config_manager.config.audit_dir = "audit"
+        log = al.AuditLog.from_config(config_manager)
+        self.addCleanup(log.close)
+        self.assertEqual(log.directory, os.path.join(os.path.dirname(config_manager.config_path), "audit"))
+
+if __name__ == "__main__":
+    unittest.main()